@@ -32,8 +32,13 @@ for importing into spreadsheet applications like Microsft Excel(TM).
 """
 
 import os
+import re
 import math
+import time
+import bisect
+import operator
 import Matfunc
+import Abeexport
 import tkFileDialog
 import string
 from Tkinter import *
@@ -57,8 +62,391 @@ global default_xoff, default_yoff
 default_xoff = 3
 default_yoff = 3
 
+global default_root_options
+default_root_options = {'log':0, 'maxiter':60}
+
+global default_degree_options
+default_degree_options = {'mindeg':3, 'maxdeg':9, 'criterion':'loo'}
+
+global default_robust_options
+default_robust_options = {'loss':'none', 'maxiter':5, 'tol':5.0e-3, 'cutoff':3.0}
+
+global robust_losses
+robust_losses = {'huber':1.345, 'tukey':4.685}
+
+global default_fourp_options
+default_fourp_options = {'ysrch':0.1, 'xsrch':0.1, 'yiter':10, 'eiter':10, 'siter':10, \
+                         'slopemax':10.0, 'isiter':1000}
+
 global abe_help_text, GPL_text
 
+
+class Profiler:
+
+    """Named timers and counters for the stages of ABE's data processing. Timers are
+       inclusive, so a stage that logs to the activity window also counts the display
+       time. While the profiler is off, start, stop and count return at once"""
+
+    def __init__(self):
+        self.on = 0
+        self.reset()
+
+    def reset(self):
+
+        """Clear all the timers and counters"""
+
+        self.timers = {}
+        self.calls = {}
+        self.counters = {}
+        self.started = {}
+
+    def start(self,name):
+
+        """Start (or restart) the named timer"""
+
+        if self.on:
+            self.started[name] = time.time()
+
+    def stop(self,name):
+
+        """Stop the named timer and add the elapsed time to its total"""
+
+        if self.on and self.started.has_key(name):
+            elapsed = time.time() - self.started[name]
+            del self.started[name]
+            self.timers[name] = self.timers.get(name,0.0) + elapsed
+            self.calls[name] = self.calls.get(name,0) + 1
+
+    def count(self,name,n=1):
+
+        """Add n to the named counter"""
+
+        if self.on:
+            self.counters[name] = self.counters.get(name,0) + n
+
+    def report(self):
+
+        """The timers and counters as lines of text for the activity log"""
+
+        lines = []
+        names = self.timers.keys()
+        names.sort()
+        for name in names:
+            lines.append("%-28s %12.4f s  %8i calls" % (name,self.timers[name],self.calls[name]))
+        names = self.counters.keys()
+        names.sort()
+        for name in names:
+            lines.append("%-28s %12i" % (name,self.counters[name]))
+        return lines
+
+    def dump(self,filename):
+
+        """Write the timers and counters to the named file as JSON"""
+
+        import json
+        pfile = open(filename,'w')
+        json.dump({'timers':self.timers, 'calls':self.calls, 'counters':self.counters}, \
+                  pfile,indent=1,sort_keys=True)
+        pfile.close()
+
+
+global profiler
+profiler = Profiler()
+
+
+class MoleculeIndex(dict):
+
+    """The session's molecule records keyed by (bioassay, molecule), together with the
+       keys sorted by molecule name (ignoring case) for prefix and substring searches.
+       The sorted list is only rebuilt when a search follows a change to the index"""
+
+    def __init__(self):
+        dict.__init__(self)
+        self.names = []
+        self.sorted_keys = []
+        self.dirty = 0
+
+    def __setitem__(self,key,record):
+        dict.__setitem__(self,key,record)
+        self.dirty = 1
+
+    def __delitem__(self,key):
+        dict.__delitem__(self,key)
+        self.dirty = 1
+
+    def sort(self):
+
+        """Rebuild the sorted name list if the index has changed"""
+
+        if self.dirty:
+            order = [(string.lower(key[1]),key) for key in self.keys()]
+            order.sort()
+            self.names = [name for (name,key) in order]
+            self.sorted_keys = [key for (name,key) in order]
+            self.dirty = 0
+
+    def search(self,text='',substring=0,tests=[]):
+
+        """The keys, in name order, of the molecules whose names start with text (or
+           contain it, if substring is set) and whose records pass all of the tests"""
+
+        self.sort()
+        text = string.lower(text)
+        names = self.names
+        if substring:
+            found = [self.sorted_keys[n] for n in range(len(names)) if string.find(names[n],text) >= 0]
+        else:
+            n = bisect.bisect_left(names,text)
+            m = n
+            while m < len(names) and names[m][:len(text)] == text:
+                m = m + 1
+            found = self.sorted_keys[n:m]
+        for test in tests:
+            found = [key for key in found if test(self[key])]
+        return found
+
+
+def record_value(record,field):
+
+    """The value of a molecule picker filter field for a molecule record, or None if
+       the molecule has no such value yet"""
+
+    four_param = record['four_param']
+    if field == 'points':
+        return len(record['xdata'])
+    if field in metric_fields:
+        return four_param['metrics'].get(field)
+    if field[:4] == 'poly':
+        return record['metrics'].get(field[4:])
+    if field == 'ed50poly':
+        if record['edfit'] == 0.0:
+            return None
+        return 10.0**record['edfit']
+    if not four_param['fit']:
+        return None
+    return four_param[{'ed50':'c', 'slope':'b', 'ymin':'a', 'ymax':'d'}[field]]
+
+
+global metric_fields, filter_fields, filter_ops
+metric_fields = ['sse', 'rmse', 'r2', 'aic', 'bic']
+filter_fields = ['ed50', 'ed50poly', 'slope', 'ymin', 'ymax', 'points'] + metric_fields + \
+                ['poly' + field for field in metric_fields]
+filter_ops = {'<':operator.lt, '<=':operator.le, '>':operator.gt, '>=':operator.ge, \
+              '=':operator.eq, '!=':operator.ne}
+
+
+def record_filter(text):
+
+    """Parse a molecule picker filter into a list of tests on molecule records. The
+       filter is a comma separated list of conditions, all of which must hold, e.g.
+       "ED50 < 10, fit failed". A condition is either a comparison of one of the
+       fields ED50, ED50poly, slope, ymin, ymax, points or a fit metric (SSE, RMSE,
+       R2, AIC or BIC of the 4-parameter model, or polySSE ... polyBIC of the
+       polynomial) with a number, or one of
+       "fitted", "unfitted" or "fit failed" (the nonlinear regression was unstable).
+       Raises ValueError for a condition that is not understood"""
+
+    tests = []
+    for term in string.split(text,','):
+        term = string.lower(string.join(string.split(term)))
+        if term == '':
+            continue
+        if term == 'fit failed':
+            tests.append(lambda r: r['four_param']['fit'] == 1)
+        elif term == 'fitted':
+            tests.append(lambda r: r['four_param']['fit'] or r['edfit'] != 0.0)
+        elif term == 'unfitted':
+            tests.append(lambda r: not r['four_param']['fit'] and r['edfit'] == 0.0)
+        else:
+            m = re.match(r'^(\w+)\s*(<=|>=|!=|<|>|=)\s*(\S+)$',term)
+            if m == None or not m.group(1) in filter_fields:
+                raise ValueError("Filter condition not understood: " + term)
+            try:
+                limit = string.atof(m.group(3))
+            except ValueError:
+                raise ValueError("Filter condition needs a number: " + term)
+            def test(r,field=m.group(1),op=filter_ops[m.group(2)],limit=limit):
+                value = record_value(r,field)
+                return value != None and op(value,limit)
+            tests.append(test)
+    return tests
+
+
+def fit_metrics(sse,sumy,sumyy,n,k):
+
+    """The goodness of fit of a least-squares model with k parameters, from the sums over
+       its n data points of the squared residuals (sse) and of the responses and their
+       squares (sumy, sumyy, taken about any fixed value to keep them small). AIC and BIC
+       are the least-squares forms n*ln(SSE/n) + 2k and n*ln(SSE/n) + k*ln(n); they, and
+       R2 for responses that are all the same, are None where they are undefined"""
+
+    metrics = {'sse':sse, 'rmse':math.sqrt(sse/n), 'r2':None, 'aic':None, 'bic':None, 'n':n, 'k':k}
+    sst = sumyy - sumy*sumy/n
+    if sst > 0.0:
+        metrics['r2'] = 1.0 - sse/sst
+    if sse > 0.0:
+        loglik = n*math.log(sse/n)
+        metrics['aic'] = loglik + 2*k
+        metrics['bic'] = loglik + k*math.log(n)
+    return metrics
+
+
+def metric_values(metrics):
+
+    """The SSE, RMSE, R2, AIC and BIC of a fitted model, None for any not computed"""
+
+    return tuple([metrics.get(field) for field in metric_fields])
+
+
+def rank_keys(index,keys,field):
+
+    """Sort the keys of a molecule index by a fit metric, worst fit first: lowest R2,
+       otherwise highest metric. Molecules without the metric come last"""
+
+    values = [(record_value(index[key],field),key) for key in keys]
+    missing = [key for (value,key) in values if value == None]
+    values = [(value,key) for (value,key) in values if value != None]
+    values.sort()
+    if field[-2:] != 'r2':
+        values.reverse()
+    return [key for (value,key) in values] + missing
+
+
+def dose_plan(xdata):
+
+    """How a dose series read from a data file is cleaned, which depends on the doses alone
+       and so is worked out once for all the molecules of a plate measured at the same doses.
+       Points with zero or negative doses have no log dose and are dropped; the rest are put
+       in increasing order of dose and the replicates of each dose are grouped. Returns the
+       indexes of the points kept, in order ('order'), the number dropped ('dropped'), the
+       cleaned doses, one per group ('xdata'), and the start ('starts') and number of points
+       ('counts') of each group within the order"""
+
+    x = Numeric.array(xdata)
+    keep = Numeric.compress(x > 0.0,Numeric.arange(len(xdata)))
+    order = Numeric.take(keep,Numeric.argsort(Numeric.take(x,keep)))
+    xs = map(float,Numeric.take(x,order))
+    starts = []
+    n = 0
+    while n < len(xs):
+        if n == 0 or xs[n] != xs[n-1]:
+            starts.append(n)
+        n = n + 1
+    counts = [end - start for (start, end) in zip(starts,starts[1:] + [len(xs)])]
+    return {'order':order, 'dropped':len(xdata)-len(xs), 'xdata':[xs[n] for n in starts], \
+            'starts':Numeric.array(starts), 'counts':counts}
+
+
+def group_means(plan,values):
+
+    """The mean of the values (already in the order of a dose plan) over each group of
+       replicate doses of the plan, from one running sum of the values"""
+
+    sums = Numeric.concatenate((Numeric.array([0.0]),Numeric.add.accumulate(values)))
+    ends = plan['starts'] + Numeric.array(plan['counts'])
+    return (Numeric.take(sums,ends) - Numeric.take(sums,plan['starts']))/Numeric.array(plan['counts'],'d')
+
+
+def clean_responses(plan,ydata,stderr):
+
+    """Clean the responses (and errors, if any) of a molecule read with the doses of a dose
+       plan, without changing the lists given: put them in the plan's order, set negative
+       responses to zero and aggregate the replicates of each dose into their mean, standard
+       deviation (SD) and standard error of the mean (SEM = SD/sqrt(n)), with one pass over
+       the sorted points for the means and a second over their deviations from the means.
+       Returns the cleaned responses (the dose means), the errors and a summary of the
+       cleaning: the numbers of points dropped for their doses ('dropped'), of responses set
+       to zero ('clamped') and of replicate points merged into dose means ('merged'), the
+       number of replicates of each dose ('replicates'), their SD and SEM ('sd', 'sem', None
+       for a dose measured once), the sum of the squared deviations of the replicates from
+       their dose means ('within', 0 without replicates, for weighted_sums) and the range of
+       the cleaned responses ('yrange'). The errors are those of the data file, averaged
+       over the replicates, or if the file has none, the SEM of each dose (0 for a dose
+       measured once)"""
+
+    y = Numeric.take(Numeric.array(ydata),plan['order'])
+    clamped = int(Numeric.sum(y < 0.0))
+    y = Numeric.maximum(y,0.0)
+    counts = plan['counts']
+    sd = sem = [None]*len(counts)
+    within = 0.0
+    if len(y) > len(plan['xdata']):
+        means = group_means(plan,y)
+        dev = y - Numeric.repeat(means,counts)
+        ss = group_means(plan,dev*dev)*Numeric.array(counts,'d')
+        within = float(Numeric.sum(ss))
+        sd = []
+        sem = []
+        n = 0
+        while n < len(counts):
+            if counts[n] > 1:
+                sd.append(math.sqrt(ss[n]/(counts[n]-1)))
+                sem.append(sd[n]/math.sqrt(counts[n]))
+            else:
+                sd.append(None)
+                sem.append(None)
+            n = n + 1
+        y = means
+    ydata = map(float,y)
+    if len(stderr) > 0:
+        err = Numeric.take(Numeric.array(stderr),plan['order'])
+        if len(err) > len(plan['xdata']):
+            err = group_means(plan,err)
+        stderr = map(float,err)
+    elif len(y) < len(plan['order']):
+        stderr = [e or 0.0 for e in sem]
+    else:
+        stderr = []
+    summary = {'dropped':plan['dropped'], 'clamped':clamped, 'merged':len(plan['order'])-len(ydata), \
+               'replicates':counts, 'sd':sd, 'sem':sem, 'within':within, 'yrange':(min(ydata),max(ydata))}
+    return ydata, stderr, summary
+
+
+def dose_table(xdata,counts=None):
+
+    """The tables for a dose series that are shared by all the molecules of a plate measured
+       at the same doses: log10 and natural logs of the doses, the range of log10(dose), the
+       fitting weights and the Chebyshev design matrices for polynomial fits, by degree,
+       which are built (and factored, see Matfunc.chebdesign) once for the whole plate.
+       Where the doses are the means of replicates, the number of replicates of each is its
+       weight ('weights'), with the square roots in 'rootw', so that a least-squares fit to
+       the means is the fit to every replicate at the cost of one point per dose; the
+       designs have their rows scaled by 'rootw'. With no replicates 'weights' is empty and
+       'rootw' is None"""
+
+    logx = [math.log10(x) for x in xdata]
+    table = {'logx':logx, 'lnx':[math.log(x) for x in xdata], 'range':(min(logx),max(logx)), \
+             'weights':[], 'rootw':None, 'designs':{}}
+    if counts != None and max(counts) > 1:
+        table['weights'] = map(float,counts)
+        table['rootw'] = Numeric.sqrt(Numeric.array(table['weights']))
+    return table
+
+
+def weighted_sums(ydata,yfit,weights,within=0.0):
+
+    """The sums over the data points, with the given fitting weights (all 1 if there are
+       none), of the squared residuals and of the responses and their squares (taken about
+       the first response), and the sum of the weights, for fit_metrics. Where the points
+       are dose means weighted by their replicates, adding the replicates' sum of squares
+       about those means (within) to the squared residuals and squared responses makes
+       these the sums over every replicate"""
+
+    if len(weights) == 0:
+        weights = [1.0]*len(ydata)
+    sse = sumyy = within
+    sumy = total = 0.0
+    n = 0
+    while n < len(ydata):
+        w = weights[n]
+        sse = sse + w*(ydata[n]-yfit[n])*(ydata[n]-yfit[n])
+        sumy = sumy + w*(ydata[n]-ydata[0])
+        sumyy = sumyy + w*(ydata[n]-ydata[0])*(ydata[n]-ydata[0])
+        total = total + w
+        n = n + 1
+    return sse, sumy, sumyy, total
+
+
 class Console:
 
     """The ABE console containing the menus and graphical display"""
@@ -66,7 +454,7 @@ class Console:
     def __init__(self,graphpixels):
         self.gsize = graphpixels
         self.root = Tk()
-        self.current = StringVar()
+        self.picker = None
         self.root.resizable(width=0,height=0)
         self.root.geometry('+%d+%d' % (default_xoff,default_yoff))
         self.root.title(AbeTitle)
@@ -79,6 +467,8 @@ class Console:
         self.topmenu['File'].menu=Menu(self.topmenu['File'])
         self.topmenu['File'].menu.add_command(label='Load Bioassay Data', underline=0,command = self.check_load_data)
         self.topmenu['File']['menu'] = self.topmenu['File'].menu
+        self.topmenu['File'].menu.add_command(label='Add Bioassay Data', underline=0,command = self.add_data)
+        self.topmenu['File']['menu'] = self.topmenu['File'].menu
         self.topmenu['File'].menu.add_command(label='Save Activity Log', underline=0,command = self.save_log)
         self.topmenu['File']['menu'] = self.topmenu['File'].menu
         self.topmenu['File'].menu.add_command(label='Save Graph Image', underline=0,command = self.save_graph)
@@ -94,6 +484,8 @@ class Console:
         self.topmenu['Data'].menu=Menu(self.topmenu['Data'])
         self.topmenu['Data'].menu.add_command(label='Process Data', underline=0,command = self.work_data)
         self.topmenu['Data']['menu'] = self.topmenu['Data'].menu
+        self.topmenu['Data'].menu.add_command(label='Pick Molecule', underline=0,command = self.pick_molecule)
+        self.topmenu['Data']['menu'] = self.topmenu['Data'].menu
         self.topmenu['Graph'] = Menubutton(self.menuframe,text='Graph', underline=0)
         self.topmenu['Graph'].pack(side=LEFT,padx=5)
         self.topmenu['Graph'].menu=Menu(self.topmenu['Graph'])
@@ -110,10 +502,13 @@ class Console:
         self.graph_leg_on.set(1)
         self.topmenu['Graph'].menu.add_checkbutton(label=' Show Legend',variable=self.graph_leg_on)
         self.topmenu['Graph']['menu'] = self.topmenu['Graph'].menu
-        self.graph_fourp_on = IntVar()
-        self.graph_fourp_on.set(1)
-        self.topmenu['Graph'].menu.add_checkbutton(label=' Show 4-Parameter Model',variable=self.graph_fourp_on)
-        self.topmenu['Graph']['menu'] = self.topmenu['Graph'].menu
+        self.graph_model_on = {}
+        for model in curve_models:
+            self.graph_model_on[model.key] = IntVar()
+            self.graph_model_on[model.key].set(1)
+            self.topmenu['Graph'].menu.add_checkbutton(label=' Show ' + model.title + ' Model', \
+                                                       variable=self.graph_model_on[model.key])
+            self.topmenu['Graph']['menu'] = self.topmenu['Graph'].menu
         self.graph_poly_on = IntVar()
         self.graph_poly_on.set(1)
         self.topmenu['Graph'].menu.add_checkbutton(label=' Show Polynomial Model',variable=self.graph_poly_on)
@@ -131,7 +526,11 @@ class Console:
         self.topmenu['Data Model'].menu=Menu(self.topmenu['Data Model'])
         self.topmenu['Data Model'].menu.add_command(label='Estimate ED50', underline=0,command = self.pick_root)
         self.topmenu['Data Model']['menu'] = self.topmenu['Data Model'].menu
-        self.topmenu['Data Model'].menu.add_command(label='Fit 4-Parameter Model', underline=0,command = self.fit_fourp)
+        for model in curve_models:
+            self.topmenu['Data Model'].menu.add_command(label='Fit ' + model.title + ' Model', underline=0, \
+                                                        command = lambda model=model: self.fit_model(model))
+            self.topmenu['Data Model']['menu'] = self.topmenu['Data Model'].menu
+        self.topmenu['Data Model'].menu.add_command(label='Fit Global 4-Parameter Model', underline=4,command = self.choose_global)
         self.topmenu['Data Model']['menu'] = self.topmenu['Data Model'].menu
         self.topmenu['Data Model'].menu.add_command(label='Choose Polynomial', underline=0,command = self.choose_polynomial)
         self.topmenu['Data Model']['menu'] = self.topmenu['Data Model'].menu
@@ -144,12 +543,36 @@ class Console:
         self.topmenu['Options'].menu=Menu(self.topmenu['Options'])
         self.topmenu['Options'].menu.add_command(label='4-Parameter Search', underline=0,command = self.set_fourp_opts)
         self.topmenu['Options']['menu'] = self.topmenu['Options'].menu
-        self.fourp_defaults = {'ysrch':0.1, 'xsrch':0.1, 'yiter':10, 'eiter':10, 'siter':10, \
-                              'slopemax':10.0, 'isiter':1000}
-        self.fourp_options = {'ysrch':0.1, 'xsrch':0.1, 'yiter':10, 'eiter':10, 'siter':10, \
-                              'slopemax':10.0, 'isiter':1000}
+        self.fourp_defaults = default_fourp_options.copy()
+        self.fourp_options = default_fourp_options.copy()
         self.topmenu['Options'].menu.add_command(label='Estimate Curve Max/Min', underline=0,command = self.pick_ymaxmin)
         self.topmenu['Options']['menu'] = self.topmenu['Options'].menu
+        self.root_options = default_root_options.copy()
+        self.root_log_on = IntVar()
+        self.root_log_on.set(self.root_options['log'])
+        self.topmenu['Options'].menu.add_checkbutton(label=' Log Root Finding',variable=self.root_log_on, \
+                                                     command = self.toggle_root_log)
+        self.topmenu['Options']['menu'] = self.topmenu['Options'].menu
+        self.topmenu['Options'].menu.add_separator()
+        self.robust_options = default_robust_options.copy()
+        self.robust_loss = StringVar()
+        self.robust_loss.set(self.robust_options['loss'])
+        for (label, loss) in ((' Least Squares','none'),(' Robust Fitting (Huber)','huber'),(' Robust Fitting (Tukey)','tukey')):
+            self.topmenu['Options'].menu.add_radiobutton(label=label,variable=self.robust_loss,value=loss, \
+                                                         command = self.set_robust_loss)
+            self.topmenu['Options']['menu'] = self.topmenu['Options'].menu
+        self.topmenu['Options'].menu.add_separator()
+        self.profile_on = IntVar()
+        self.profile_on.set(0)
+        self.topmenu['Options'].menu.add_checkbutton(label=' Profile Timing',variable=self.profile_on, \
+                                                     command = self.toggle_profile)
+        self.topmenu['Options']['menu'] = self.topmenu['Options'].menu
+        self.topmenu['Options'].menu.add_command(label='Show Profile', underline=0,command = self.show_profile)
+        self.topmenu['Options']['menu'] = self.topmenu['Options'].menu
+        self.topmenu['Options'].menu.add_command(label='Save Profile', underline=0,command = self.save_profile)
+        self.topmenu['Options']['menu'] = self.topmenu['Options'].menu
+        self.topmenu['Options'].menu.add_command(label='Reset Profile', underline=0,command = self.reset_profile)
+        self.topmenu['Options']['menu'] = self.topmenu['Options'].menu
         self.topmenu['Window'] = Menubutton(self.menuframe,text='Window', underline=0)
         self.topmenu['Window'].pack(side=LEFT,padx=5)
         self.topmenu['Window'].menu=Menu(self.topmenu['Window'])
@@ -198,26 +621,40 @@ class Console:
 
     def initialize_data(self):
 
-        """Initialize the bioassay data store, the Data-> menu and the graphical display"""
+        """Initialize the bioassay data store, the molecule picker and the graphical display"""
         
+        self.new_session()
+        self.refresh_picker()
+        self.graph.delete(ALL)
+
+
+    def new_session(self):
+
+        """Start an empty session. A session holds any number of bioassays (plates), each
+           with its own column layout, from any number of files:
+
+           self.data[bioassay][molecule]     the data and data models of each molecule
+           self.index[(bioassay,molecule)]   the same records, for lookup in one step
+                                             and searches by name (see MoleculeIndex)
+           self.plates[bioassay]             file, columns, x, y, err, molecule order and the
+                                             dose tables of the plate's dose series
+           self.molecule_list                the (bioassay,molecule) keys in load order"""
+
         self.data = {}
+        self.index = MoleculeIndex()
+        self.plates = {}
+        self.plate_list = []
+        self.molecule_list = []
+        self.picked = None
+        self.loading = []
         self.bioassay = ''
         self.molecule = ''
-        self.molecule_list = []
         self.in_data = 0
         self.graph_border = default_graph_border
+        self.columns = []
         self.x = None
         self.y = None
         self.stderr = None
-        try:
-            self.topmenu['Data'].menu.delete(2,END)
-            self.topmenu['Data'].menu=Menu(self.topmenu['Data'])
-            self.topmenu['Data'].menu.add_command(label='Process Data', underline=0,command = self.work_data)
-            self.topmenu['Data'].menu.add_separator()
-        except:
-            pass
-        self.graph.delete(ALL)
-        self.current.set('')
 
         
     def set_directory(self):
@@ -233,8 +670,11 @@ class Console:
 
         """Update the text output window of the Abe Console"""
 
+        profiler.start('display')
         self.display.insert(END,fmt % iolist,tag)
         self.display.see(END)
+        profiler.stop('display')
+        profiler.count('display inserts')
 
 
     def keep_display(self):
@@ -288,6 +728,25 @@ class Console:
         xmlfile = tkFileDialog.askopenfilename(title="ABE: Load Bioassay Data",initialdir=self.workdir, \
                     filetypes=[('XML Files', '*.xml'),('All Files','*.*')], defaultextension='.xml')
         if xmlfile == "": return
+        self.read_data(xmlfile)
+
+
+    def add_data(self):
+
+        """Reads the bioassay data from another XML file into the current session,
+           keeping the bioassays and data models that are already loaded"""
+
+        xmlfile = tkFileDialog.askopenfilename(title="ABE: Add Bioassay Data",initialdir=self.workdir, \
+                    filetypes=[('XML Files', '*.xml'),('All Files','*.*')], defaultextension='.xml')
+        if xmlfile == "": return
+        self.read_data(xmlfile)
+
+
+    def read_data(self,xmlfile):
+
+        """Parse the bioassay data in the named XML file into the session and log the
+           records read"""
+
         if os.path.isfile(xmlfile):
             try:
                 self.xmlstream = open(xmlfile, 'r')
@@ -295,18 +754,22 @@ class Console:
                 self.whoops("Unable to open data file:\n" + xmlfile)
                 return
         self.xmlfile = xmlfile
-        self.data = {}
+        self.loading = []
         self.p = xml.parsers.expat.ParserCreate()
         self.p.StartElementHandler = self.start_element
         self.p.EndElementHandler = self.end_element
         self.p.CharacterDataHandler = self.char_data
         pdata = 'Start'
+        profiler.start('xml parse')
         try:
             while pdata != '':
                 pdata = self.xmlstream.readline()
                 self.p.Parse(pdata)
             self.p.Parse(pdata,1)
+            profiler.stop('xml parse')
         except:
+            profiler.stop('xml parse')
+            profiler.stop('data cleaning')
             self.whoops("XML syntax errors in file:\n" + xmlfile)
             self.load_data_cleanup()
             return
@@ -314,18 +777,31 @@ class Console:
         self.update_display("Bioassay data in XML format read from file:")
         self.update_display(xmlfile)
         self.xmlstream.close()
-        xlabel = self.columns[self.x]
-        ylabel = self.columns[self.y]
-        elabel = self.columns[self.stderr]
+        for bioassay in self.loading:
+            self.log_plate(bioassay)
+        self.loading = []
+        self.refresh_picker()
+
+
+    def log_plate(self,bioassay):
+
+        """Write the column selection and data records of a bioassay to the activity log"""
+
+        plate = self.plates[bioassay]
+        xlabel = plate['columns'][plate['x']]
+        ylabel = plate['columns'][plate['y']]
+        self.update_display(bioassay,fmt="\nBioassay: %s\n")
         self.update_display("\nData columns selected:")
         self.update_display(xlabel,fmt="x    = %s\n")
         self.update_display(ylabel,fmt="y    = %s\n")
-        if self.stderr != None:
+        if plate['err'] != None:
+            elabel = plate['columns'][plate['err']]
             self.update_display(elabel,fmt="err  = %s\n")
-        for mol in self.data[self.bioassay]:
-            xdata = self.data[self.bioassay][mol]['xdata']
-            ydata = self.data[self.bioassay][mol]['ydata']
-            stderr = self.data[self.bioassay][mol]['stderr']
+        for mol in plate['molecules']:
+            raw = self.data[bioassay][mol]['raw']
+            xdata = raw['xdata']
+            ydata = raw['ydata']
+            stderr = raw['stderr']
             self.update_display(mol,fmt="\n\nMolecule: %s\n")
             self.update_display(len(xdata),fmt="Number of data records read from bioassay data file = %i \n\n")
             n = 0
@@ -337,20 +813,76 @@ class Console:
                     self.update_display((n+1,xlabel,xdata[n],ylabel,ydata[n]), \
                     fmt="%3i:   %s=%12.3f   %s=%12.3f\n",tag='data')
                 n = n + 1
+            self.log_cleaning(self.data[bioassay][mol])
+
+
+    def log_cleaning(self,record):
+
+        """Write what the cleaning of a molecule's data changed to the activity log"""
+
+        cleaning = record['cleaning']
+        if cleaning['dropped']:
+            self.update_display(cleaning['dropped'],fmt="\nData records with zero or negative doses dropped = %i\n")
+        if cleaning['clamped']:
+            self.update_display(cleaning['clamped'],fmt="\nNegative Y-values reset to zero = %i\n")
+        if cleaning['merged']:
+            self.update_display((cleaning['merged'],len(cleaning['replicates'])), \
+                    fmt="\nReplicate data records merged = %i (%i distinct doses)\n")
+            self.log_replicates(record)
+
+
+    def log_replicates(self,record):
+
+        """Write the per-dose statistics of a molecule's replicates to the activity log"""
+
+        cleaning = record['cleaning']
+        xdata = record['xdata']
+        ydata = record['ydata']
+        self.update_display("\nDose means of replicates:")
+        n = 0
+        while n < len(xdata):
+            if cleaning['sd'][n] == None:
+                self.update_display((n+1,xdata[n],ydata[n],cleaning['replicates'][n]), \
+                fmt="%3i:   dose=%12.3f   mean=%12.3f   n=%3i\n",tag='data')
+            else:
+                self.update_display((n+1,xdata[n],ydata[n],cleaning['replicates'][n], \
+                                     cleaning['sd'][n],cleaning['sem'][n]), \
+                fmt="%3i:   dose=%12.3f   mean=%12.3f   n=%3i   SD=%10.3f   SEM=%10.3f\n",tag='data')
+            n = n + 1
 
 
     def load_data_cleanup(self):
 
-        """Abandon data input, clean up data input errors and re-initialize data"""
+        """Abandon data input, clean up data input errors and drop the bioassays read
+           so far from the file, leaving the rest of the session as it was"""
         
         try:
             self.edialog.update()
         except:
             pass
         self.xmlstream.close()
-        self.initialize_data()
+        for bioassay in self.loading:
+            self.drop_bioassay(bioassay)
+        self.loading = []
+        self.bioassay = ''
+        self.molecule = ''
+        self.picked = None
+        self.in_data = 0
+        self.refresh_picker()
         return
 
+
+    def drop_bioassay(self,bioassay):
+
+        """Remove a bioassay and all of its molecules from the session"""
+
+        for mol in self.plates[bioassay]['molecules']:
+            del self.index[(bioassay,mol)]
+        self.molecule_list = [key for key in self.molecule_list if key[0] != bioassay]
+        del self.data[bioassay]
+        del self.plates[bioassay]
+        self.plate_list.remove(bioassay)
+
         
     def whoops(self,errtext):
 
@@ -416,9 +948,18 @@ class Console:
                 self.whoops("Bioassay data block with no ID (<bioassay id= ...>)")
                 self.load_data_cleanup()
                 return
+            elif self.data.has_key(attrs['id']):
+                self.whoops("Bioassay '" + attrs['id'] + "' is already loaded in this session")
+                self.load_data_cleanup()
+                return
             else:
                 self.bioassay = attrs['id']
                 self.data[self.bioassay] = {}
+                self.plates[self.bioassay] = {'file':self.xmlfile, 'columns':[], 'x':None, 'y':None, \
+                                              'err':None, 'molecules':[], 'plans':{}, 'doses':{}}
+                self.plate_list.append(self.bioassay)
+                self.loading.append(self.bioassay)
+                self.stderr = None
             if not attrs.has_key('columns'):
                 self.whoops("Bioassay data block with no column description (<bioassay columns= ...>)")
                 self.load_data_cleanup()
@@ -454,21 +995,33 @@ class Console:
                     return
                 else:
                     self.stderr = self.columns.index(attrs['err'])
+            plate = self.plates[self.bioassay]
+            plate['columns'] = self.columns
+            plate['x'] = self.x
+            plate['y'] = self.y
+            plate['err'] = self.stderr
         elif name == "molecule":
             if not attrs.has_key('id'):
                 self.whoops("Molecule data block with no ID (<molecule id= ...>)")
                 self.load_data_cleanup()
                 return
+            elif self.data[self.bioassay].has_key(attrs['id']):
+                self.whoops("Molecule '" + attrs['id'] + "' appears twice in bioassay '" + self.bioassay + "'")
+                self.load_data_cleanup()
+                return
             else:
                 self.molecule = attrs['id']
-                self.data[self.molecule] = {}
-                self.molecule_list.append(self.molecule)
+                key = (self.bioassay,self.molecule)
                 self.data[self.bioassay][self.molecule] = {'xdata':[],'ydata':[], \
-                'logx':[],'yfit':[],'polydeg':0, 'poly':[], 'poly1':[], 'poly2':[], \
-                'poly3':[], 'edguess':0.0, 'edfit':0.0, 'stderr':[], 'residual':0.0, \
-                'four_param':{'fit':0,'a':None,'b':None,'c':None,'d':None,'yfit':[]}  }
-                self.topmenu['Data'].menu.add_radiobutton(label=attrs['id'],variable=self.current)
-                self.topmenu['Data']['menu'] = self.topmenu['Data'].menu
+                'logx':[],'doses':None,'yfit':[],'polydeg':0, 'poly':[], 'poly1':[], 'poly2':[], \
+                'poly3':[], 'cheb':[], 'cheb2':[], 'cheb3':[], 'chebrange':(0.0,0.0), \
+                'edguess':0.0, 'edfit':0.0, 'stderr':[], 'metrics':{}, \
+                'raw':{'xdata':[], 'ydata':[], 'stderr':[]}, 'cleaning':None, 'global':None  }
+                for model in curve_models:
+                    self.data[self.bioassay][self.molecule][model.key] = model.empty()
+                self.index[key] = self.data[self.bioassay][self.molecule]
+                self.molecule_list.append(key)
+                self.plates[self.bioassay]['molecules'].append(self.molecule)
         elif name == "data":
             self.in_data = 1
                 
@@ -481,17 +1034,32 @@ class Console:
         if name == "bioassay":
             pass
         elif name == "molecule":
-            if len(self.data[self.bioassay][self.molecule]['xdata']) == 0:
+            record = self.index[(self.bioassay,self.molecule)]
+            raw = record['raw']
+            if len(raw['xdata']) == 0:
                 self.whoops("Molecule: "+self.molecule+" contains no valid data points")
                 self.load_data_cleanup()
                 return
-            if self.data[self.bioassay][self.molecule]['xdata'][0] > \
-               self.data[self.bioassay][self.molecule]['xdata'][-1]:
-                self.data[self.bioassay][self.molecule]['xdata'].reverse()
-                self.data[self.bioassay][self.molecule]['ydata'].reverse()
-                self.data[self.bioassay][self.molecule]['stderr'].reverse()
-            for x in self.data[self.bioassay][self.molecule]['xdata']:
-                self.data[self.bioassay][self.molecule]['logx'].append(math.log10(x))
+            profiler.start('data cleaning')
+            plans = self.plates[self.bioassay]['plans']
+            series = tuple(raw['xdata'])
+            if not plans.has_key(series):
+                plans[series] = dose_plan(raw['xdata'])
+            plan = plans[series]
+            if len(plan['xdata']) == 0:
+                profiler.stop('data cleaning')
+                self.whoops("Molecule: "+self.molecule+" contains no data points with positive doses")
+                self.load_data_cleanup()
+                return
+            (record['ydata'], record['stderr'], record['cleaning']) = clean_responses(plan,raw['ydata'],raw['stderr'])
+            record['xdata'] = plan['xdata']
+            profiler.stop('data cleaning')
+            doses = self.plates[self.bioassay]['doses']
+            series = (tuple(record['xdata']),tuple(plan['counts']))
+            if not doses.has_key(series):
+                doses[series] = dose_table(record['xdata'],plan['counts'])
+            record['doses'] = doses[series]
+            record['logx'] = record['doses']['logx']
             self.molecule = ''
         elif name == "data":
             self.in_data = 0
@@ -502,11 +1070,12 @@ class Console:
 
         if self.bioassay != None and self.molecule != None and self.in_data:
             c = string.split(cdata)
+            raw = self.index[(self.bioassay,self.molecule)]['raw']
             try:
-                self.data[self.bioassay][self.molecule]['xdata'].append(string.atof(c[self.x]))
-                self.data[self.bioassay][self.molecule]['ydata'].append(string.atof(c[self.y]))
+                raw['xdata'].append(string.atof(c[self.x]))
+                raw['ydata'].append(string.atof(c[self.y]))
                 if self.stderr != None:
-                    self.data[self.bioassay][self.molecule]['stderr'].append(string.atof(c[self.stderr]))
+                    raw['stderr'].append(string.atof(c[self.stderr]))
                 return
             except:
                 etext = "Molecule: "+self.molecule + " - Non numerical data encountered in data columns\n" + string.join(c)
@@ -517,30 +1086,217 @@ class Console:
 
     def work_data(self):
 
-        """Set the current molecule to the molecule dataset selected in the Data-> menu"""
+        """Set the current molecule to the molecule dataset selected in the molecule picker"""
         
-        self.molecule = self.current.get()
-        if self.molecule == '':
+        key = self.picked
+        if key == None or not self.index.has_key(key):
             self.whoops("No molecule data currently selected for processing")
             return
+        self.select(key)
         self.update_status("Bioassay=" + self.bioassay + ", Molecule=" + self.molecule)
         self.update_display((self.bioassay,self.molecule), \
                 fmt="\n\nProcessing Data: Bioassay = %s, Molecule = %s\n")
         self.draw_graph()
 
+
+    def pick_molecule(self):
+
+        """The molecule picker: find molecules by name and by their fitted results. Only
+           the visible rows of the list are filled, so very large plates stay responsive"""
+
+        if self.picker != None:
+            self.picker.deiconify()
+            self.picker.lift()
+            return
+        self.pick_name = StringVar()
+        self.pick_filter = StringVar()
+        self.pick_substring = IntVar()
+        self.pick_order = StringVar()
+        self.pick_order.set('name')
+        self.pick_rows = []
+        self.pick_tests = []
+        self.pick_top = 0
+        self.pick_height = 20
+        self.picker = Toplevel(self.root)
+        self.picker.title("ABE: Pick Molecule")
+        self.picker.protocol("WM_DELETE_WINDOW", self.close_picker)
+        Label(self.picker,text="Molecule",font=('Arial',10)).grid(row=0,column=0,padx=5,sticky=W)
+        self.pick_entry = Entry(self.picker,textvariable=self.pick_name,width=30)
+        self.pick_entry.grid(row=0,column=1,pady=5,sticky=EW)
+        self.pick_entry.bind('<KeyRelease>',self.pick_search)
+        Checkbutton(self.picker,text="Substring",variable=self.pick_substring, \
+                    command=self.pick_search).grid(row=0,column=2,padx=5,sticky=W)
+        Label(self.picker,text="Filter",font=('Arial',10)).grid(row=1,column=0,padx=5,sticky=W)
+        self.pick_fentry = Entry(self.picker,textvariable=self.pick_filter,width=30)
+        self.pick_fentry.grid(row=1,column=1,pady=5,sticky=EW)
+        self.pick_fentry.bind('<Return>',self.pick_apply)
+        Button(self.picker,text="Apply",command=self.pick_apply).grid(row=1,column=2,padx=5,sticky=EW)
+        Label(self.picker,text="Order by",font=('Arial',10)).grid(row=2,column=0,padx=5,sticky=W)
+        OptionMenu(self.picker,self.pick_order,'name','r2','rmse','polyr2','polyrmse', \
+                   command=self.pick_search).grid(row=2,column=1,sticky=W)
+        self.pick_list = Listbox(self.picker,height=self.pick_height,width=60, \
+                                 font=('Courier',10),selectmode=SINGLE,exportselection=0)
+        self.pick_list.grid(row=3,column=0,columnspan=3,padx=5,sticky=NSEW)
+        self.pick_scroll = Scrollbar(self.picker,orient=VERTICAL,command=self.pick_yview)
+        self.pick_scroll.grid(row=3,column=3,sticky=NS)
+        self.pick_list.bind('<<ListboxSelect>>',self.pick_choose)
+        self.pick_list.bind('<Double-Button-1>',self.pick_process)
+        self.pick_list.bind('<MouseWheel>',self.pick_wheel)
+        self.pick_list.bind('<Button-4>',self.pick_wheel)
+        self.pick_list.bind('<Button-5>',self.pick_wheel)
+        self.pick_count = Label(self.picker,text='',font=('Arial',8),fg='blue',anchor=W)
+        self.pick_count.grid(row=4,column=0,columnspan=2,padx=5,sticky=EW)
+        Button(self.picker,text="Process",command=self.work_data).grid(row=5,column=0,columnspan=2, \
+                                                                      padx=5,pady=5,sticky=EW)
+        Button(self.picker,text="Close",command=self.close_picker).grid(row=5,column=2,padx=5,pady=5,sticky=EW)
+        self.picker.columnconfigure(1,weight=1)
+        self.pick_entry.focus_set()
+        self.pick_search()
+
+
+    def close_picker(self):
+
+        """Kill the molecule picker window"""
+
+        self.picker.destroy()
+        self.picker = None
+
+
+    def refresh_picker(self):
+
+        """Search again after molecules have been loaded or dropped, if the picker is open"""
+
+        if self.picker != None:
+            self.pick_search()
+
+
+    def pick_search(self,event=None):
+
+        """List the molecules matching the name and the filter in the molecule picker, in
+           name order or ranked worst fit first"""
+
+        self.pick_rows = self.index.search(self.pick_name.get(),self.pick_substring.get(),self.pick_tests)
+        if self.pick_order.get() != 'name':
+            self.pick_rows = rank_keys(self.index,self.pick_rows,self.pick_order.get())
+        self.pick_top = 0
+        self.pick_show()
+
+
+    def pick_apply(self,event=None):
+
+        """Parse the filter entered in the molecule picker and search again"""
+
+        try:
+            self.pick_tests = record_filter(self.pick_filter.get())
+        except ValueError, e:
+            self.picker.bell()
+            self.whoops(str(e))
+            return
+        self.pick_search()
+
+
+    def pick_label(self,key):
+
+        """One row of the molecule picker: the molecule, its bioassay and its ED50 values"""
+
+        record = self.index[key]
+        label = "%-20s %-16s" % (key[1],key[0])
+        if record['four_param']['fit'] == 1:
+            label = label + " 4P: failed"
+        elif record['four_param']['fit']:
+            label = label + " 4P: %10.4g" % record['four_param']['c']
+        if record['edfit'] != 0.0:
+            label = label + " poly: %10.4g" % 10.0**record['edfit']
+        return label
+
+
+    def pick_show(self):
+
+        """Fill the molecule picker's list box with the rows in view, from pick_top down"""
+
+        nrows = len(self.pick_rows)
+        self.pick_top = max(0,min(self.pick_top,nrows-self.pick_height))
+        bottom = min(nrows,self.pick_top+self.pick_height)
+        self.pick_list.delete(0,END)
+        n = self.pick_top
+        while n < bottom:
+            self.pick_list.insert(END,self.pick_label(self.pick_rows[n]))
+            if self.pick_rows[n] == self.picked:
+                self.pick_list.selection_set(n-self.pick_top)
+            n = n + 1
+        if nrows > 0:
+            self.pick_scroll.set(float(self.pick_top)/nrows,float(bottom)/nrows)
+        else:
+            self.pick_scroll.set(0.0,1.0)
+        self.pick_count.configure(text="%i of %i molecules" % (nrows,len(self.index)))
+
+
+    def pick_yview(self,*args):
+
+        """Scroll the molecule picker's rows in response to its scroll bar"""
+
+        if args[0] == 'moveto':
+            self.pick_top = int(float(args[1])*len(self.pick_rows) + 0.5)
+        elif args[0] == 'scroll':
+            step = string.atoi(args[1])
+            if args[2] == 'pages':
+                step = step * (self.pick_height-1)
+            self.pick_top = self.pick_top + step
+        self.pick_show()
+
+
+    def pick_wheel(self,event):
+
+        """Scroll the molecule picker's rows with the mouse wheel"""
+
+        if event.num == 5 or event.delta < 0:
+            self.pick_yview('scroll','3','units')
+        else:
+            self.pick_yview('scroll','-3','units')
+        return "break"
+
+
+    def pick_choose(self,event=None):
+
+        """Make the selected row of the molecule picker the molecule to process"""
+
+        chosen = self.pick_list.curselection()
+        if len(chosen) > 0:
+            self.picked = self.pick_rows[self.pick_top + int(chosen[0])]
+
+
+    def pick_process(self,event):
+
+        """Process the molecule double-clicked in the molecule picker"""
+
+        self.pick_choose()
+        self.work_data()
+
     
+    def select(self,key):
+
+        """Make the (bioassay,molecule) key the current molecule, with its bioassay's columns"""
+
+        (self.bioassay, self.molecule) = key
+        plate = self.plates[self.bioassay]
+        self.columns = plate['columns']
+        self.x = plate['x']
+        self.y = plate['y']
+        self.stderr = plate['err']
+
+
     def get_current(self,field):
 
         """Return the data for the specified field, from the current molecule"""
         
-        return self.data[self.bioassay][self.molecule][field]
+        return self.index[(self.bioassay,self.molecule)][field]
 
 
     def put_current(self,field,value):
 
         """Set the data for the specified field, in the current molecule"""
         
-        self.data[self.bioassay][self.molecule][field] = value
+        self.index[(self.bioassay,self.molecule)][field] = value
 
     
     def update_status(self,stext):
@@ -560,32 +1316,26 @@ class Console:
         self.graph.delete(ALL)
         xdata = self.get_current('xdata')
         ydata = self.get_current('ydata')
-        if min(ydata) < 0.0:
-            ny = 0
-            while ny < len(ydata):
-                if ydata[ny] < 0.0:
-                    ydata[ny] = 0.0
-                ny = ny + 1
-            self.put_current('ydata',ydata)
-            self.whoops("Negative Y-values in this data have been reset to zero")
         yfit = self.get_current('yfit')
         logx = self.get_current('logx')
         stderr = self.get_current('stderr')
         edguess = self.get_current('edguess')
         edfit = self.get_current('edfit')
-        four_param = self.get_current('four_param')
-        yfourp = four_param['yfit']
+        fits = []
+        for model in curve_models:
+            fit = self.get_current(model.key)
+            if len(fit['yfit']) > 0:
+                fits.append((model,fit))
         ygmin = 0.0
-        ygmax = max(ydata)
-        dymin = min(ydata)
+        (dymin, ygmax) = self.get_current('cleaning')['yrange']
         self.update_status("["+self.bioassay+"]   ["+self.molecule+ \
                            "]   Ymin=%.1f, Ymax=%.1f" % (dymin,ygmax))
         if len(yfit) > 0:
             if max(yfit) > ygmax:
                 ygmax = max(yfit)
-        if len(yfourp) > 0:
-            if max(yfourp) > ygmax:
-                ygmax = max(yfourp)
+        for (model, fit) in fits:
+            if max(fit['yfit']) > ygmax:
+                ygmax = max(fit['yfit'])
         yscale = (self.gsize-self.graph_border*2)/ygmax
         xgmin = min(logx)
         xgmax = max(logx)
@@ -593,9 +1343,10 @@ class Console:
             self.whoops("Invalid X-range for molecule: "+self.molecule)
             return
         xscale = abs((self.gsize-self.graph_border*2)/(xgmax-xgmin))
+        profiler.start('draw graph')
         datpoints = []
         fitpoints = []
-        fppoints = []
+        modelpoints = [[] for (model, fit) in fits]
         errpoints = []
         n = 0
         while n < len(logx):
@@ -605,9 +1356,9 @@ class Console:
             if len(yfit) > 0:
                 yf = int(self.gsize - (yfit[n]-ygmin)*yscale) - self.graph_border
                 fitpoints.append((xd,yf))
-            if len(yfourp) > 0:
-                yf = int(self.gsize - (yfourp[n]-ygmin)*yscale) - self.graph_border
-                fppoints.append((xd,yf))
+            for m in range(len(fits)):
+                yf = int(self.gsize - (fits[m][1]['yfit'][n]-ygmin)*yscale) - self.graph_border
+                modelpoints[m].append((xd,yf))
             if len(stderr) > 0:
                 yhi = int(self.gsize - (ydata[n]-ygmin-(stderr[n]/2.0))*yscale) - self.graph_border
                 ylo = int(self.gsize - (ydata[n]-ygmin+(stderr[n]/2.0))*yscale) - self.graph_border
@@ -622,6 +1373,15 @@ class Console:
                 self.graph.create_line(x-3,errpoints[nerr][0],x+3,errpoints[nerr][0],fill='blue')
                 self.graph.create_line(x-3,errpoints[nerr][1],x+3,errpoints[nerr][1],fill='blue')
                 nerr = nerr + 1
+        raw = self.get_current('raw')
+        for (model, fit) in fits:
+            if self.graph_model_on[model.key].get():
+                for n in fit['outliers']:
+                    if len(self.get_current('doses')['weights']) > 0:
+                        n = xdata.index(raw['xdata'][n])        # A flagged well is crossed on its dose mean
+                    (x, y) = datpoints[n]
+                    self.graph.create_line(x-5,y-5,x+6,y+6,width=2,fill=model.colour)
+                    self.graph.create_line(x-5,y+5,x+6,y-6,width=2,fill=model.colour)
         if edguess != 0.0:
             n = default_border_offset
             xd = self.graph_border + int((edguess-xgmin)*xscale)
@@ -634,14 +1394,18 @@ class Console:
                 n = default_border_offset
                 xd = self.graph_border + int((edfit-xgmin)*xscale)
                 self.graph.create_line(xd,n,xd,self.gsize-n,fill='red')
-        if len(yfourp) > 0 and self.graph_fourp_on.get():
-            for x,y in fppoints:
-                self.graph.create_oval(x-3,y-3,x+3,y+3,width=1,outline='dark green')
-                self.graph.create_line(fppoints,fill='dark green',smooth=1)
-            n = default_border_offset
-            edfourp = math.log10(four_param['c'])
-            xd = self.graph_border + int((edfourp-xgmin)*xscale)
-            self.graph.create_line(xd,n,xd,self.gsize-n,fill='dark green')
+        for m in range(len(fits)):
+            (model, fit) = fits[m]
+            if not self.graph_model_on[model.key].get():
+                continue
+            for x,y in modelpoints[m]:
+                self.graph.create_oval(x-3,y-3,x+3,y+3,width=1,outline=model.colour)
+                self.graph.create_line(modelpoints[m],fill=model.colour,smooth=1)
+            ed50 = model.ed50(model.params(fit))
+            if ed50 != None:
+                n = default_border_offset
+                xd = self.graph_border + int((math.log10(ed50)-xgmin)*xscale)
+                self.graph.create_line(xd,n,xd,self.gsize-n,fill=model.colour)
         if self.graph_key_on.get():
             self.update_graph_key()
         if self.graph_leg_on.get():
@@ -652,6 +1416,9 @@ class Console:
             self.graph.create_line(n,self.gsize-n,self.gsize-n,self.gsize-n,fill='black')
             self.graph.create_line(self.gsize-n,self.gsize-n,self.gsize-n,n,fill='black')
             self.graph.create_line(self.gsize-n,n,n,n,fill='black')
+        profiler.stop('draw graph')
+        if profiler.on:
+            profiler.count('canvas items',len(self.graph.find_all()))
 
 
     def update_graph_key(self):
@@ -663,8 +1430,7 @@ class Console:
         polydeg = self.get_current('polydeg')
         edguess = self.get_current('edguess')
         edfit = self.get_current('edfit')
-        residual = self.get_current('residual')
-        four_param = self.get_current('four_param')
+        metrics = self.get_current('metrics')
         n = default_border_offset
         yinc = 14
         ny = n+yinc
@@ -684,15 +1450,28 @@ class Console:
             ny = ny + yinc
             self.graph.create_text(n+5,ny,text="ED50(Estd) = %.3f" % edg, \
                                    font=('Courier',10,'bold'),fill='blue',anchor=W)
-        if four_param['fit'] and self.graph_fourp_on.get():
-            ny = ny + yinc
-            self.graph.create_text(n+5,ny,text="ED50(4Par) = %.3f" % four_param['c'], \
-                                   font=('Courier',10,'bold'),fill='dark green',anchor=W)
+        for model in curve_models:
+            fit = self.get_current(model.key)
+            if not fit['fit'] or not self.graph_model_on[model.key].get():
+                continue
+            ed50 = model.ed50(model.params(fit))
+            if ed50 != None:
+                ny = ny + yinc
+                self.graph.create_text(n+5,ny,text="ED50(%s) = %.3f" % (model.short,ed50), \
+                                       font=('Courier',10,'bold'),fill=model.colour,anchor=W)
+            if fit['metrics'].get('r2') != None:
+                ny = ny + yinc
+                self.graph.create_text(n+5,ny,text="R2(%s)   = %.4f" % (model.short,fit['metrics']['r2']), \
+                                       font=('Courier',10,'bold'),fill=model.colour,anchor=W)
         if edfit != 0.0 and self.graph_poly_on.get():
             edf = 10.0**edfit
             ny = ny + yinc
             self.graph.create_text(n+5,ny,text="ED50(Poly) = %.3f" % edf, \
                                    font=('Courier',10,'bold'),fill='red',anchor=W)
+            if metrics.get('r2') != None:
+                ny = ny + yinc
+                self.graph.create_text(n+5,ny,text="R2(Poly)   = %.4f" % metrics['r2'], \
+                                       font=('Courier',10,'bold'),fill='red',anchor=W)
 
 
     def update_graph_legend(self):
@@ -704,41 +1483,32 @@ class Console:
         polydeg = self.get_current('polydeg')
         edguess = self.get_current('edguess')
         edfit = self.get_current('edfit')
-        residual = self.get_current('residual')
-        four_param = self.get_current('four_param')
+        metrics = self.get_current('metrics')
         n = default_border_offset
         yinc = 14
         nx = self.gsize - n - 190
         dopoly = 0
-        do4p = 0
+        lines = 1
         if edfit != 0.0 and self.graph_poly_on.get():
             dopoly = 1
-        if four_param['fit'] and self.graph_fourp_on.get():
-            do4p = 1
-        if dopoly and do4p:
-            ny1 = self.gsize - n - (polydeg+8)*yinc
-        elif do4p:
-            ny1 = self.gsize - n - 6*yinc
-        elif dopoly:
-            ny1 = self.gsize - n - (polydeg+3)*yinc
-        else:
+            lines = lines + polydeg + 2
+        fits = []
+        for model in curve_models:
+            fit = self.get_current(model.key)
+            if fit['fit'] and self.graph_model_on[model.key].get():
+                fits.append((model,fit))
+                lines = lines + len(model.names) + 1
+        if lines == 1:
             return
-        if do4p:
+        ny1 = self.gsize - n - lines*yinc
+        for (model, fit) in fits:
             ny1 = ny1 + yinc
-            self.graph.create_text(nx,ny1,text="4-Parameter Fit:", \
-                                   font=('Courier',10,'bold'),fill='dark green',anchor=W)
-            ny1 = ny1 + yinc
-            self.graph.create_text(nx,ny1,text="a (ymin)  =%12.3f" % four_param['a'], \
-                                   font=('Courier',10,'bold'),fill='dark green',anchor=W)
-            ny1 = ny1 + yinc
-            self.graph.create_text(nx,ny1,text="b (slope) =%12.3f" % four_param['b'], \
-                                   font=('Courier',10,'bold'),fill='dark green',anchor=W)
-            ny1 = ny1 + yinc
-            self.graph.create_text(nx,ny1,text="c (ED50)  =%12.3f" % four_param['c'], \
-                                   font=('Courier',10,'bold'),fill='dark green',anchor=W)
-            ny1 = ny1 + yinc
-            self.graph.create_text(nx,ny1,text="d (ymax)  =%12.3f" % four_param['d'], \
-                                   font=('Courier',10,'bold'),fill='dark green',anchor=W)
+            self.graph.create_text(nx,ny1,text="%s Fit:" % model.label, \
+                                   font=('Courier',10,'bold'),fill=model.colour,anchor=W)
+            for (label, value) in zip(model.labels,model.params(fit)):
+                ny1 = ny1 + yinc
+                self.graph.create_text(nx,ny1,text="%-10s=%12.3f" % (label,value), \
+                                       font=('Courier',10,'bold'),fill=model.colour,anchor=W)
         if dopoly:
             ny1 = ny1 + yinc
             self.graph.create_text(nx,ny1,text="Polynomial (n=%d):" % polydeg, \
@@ -766,13 +1536,15 @@ class Console:
         self.polyfit.title("ABE: Fit Polynomial")
         mtext = "Enter degree of polynomial to be fitted (3 - " + str(len(xdata)-1) + ")"
         self.cdeg = Label(self.polyfit,text=mtext,font=('Arial',10),padx=5)
-        self.cdeg.grid(row=0,column=0,columnspan=2,pady=5)
+        self.cdeg.grid(row=0,column=0,columnspan=3,pady=5)
         self.getd = Entry(self.polyfit,textvariable=self.pdeg,width=20)
-        self.getd.grid(row=1,column=0,columnspan=2)
+        self.getd.grid(row=1,column=0,columnspan=3)
         self.setd = Button(self.polyfit,text="Accept",command=self.gotpolydeg)
         self.setd.grid(row=2,column=0,padx=5,pady=5,sticky=EW)
+        self.autod = Button(self.polyfit,text="Automatic",command=self.gotautodeg)
+        self.autod.grid(row=2,column=1,padx=5,pady=5,sticky=EW)
         self.fpfun = Button(self.polyfit,text="Cancel",command=self.cancel_degree)
-        self.fpfun.grid(row=2,column=1,padx=5,pady=5,sticky=EW)
+        self.fpfun.grid(row=2,column=2,padx=5,pady=5,sticky=EW)
 
 
     def gotpolydeg(self):
@@ -800,6 +1572,50 @@ class Console:
             return
 
 
+    def gotautodeg(self):
+
+        """Choose the degree of polynomial automatically, from the degree selection dialog"""
+
+        if self.auto_degree():
+            self.polyfit.destroy()
+
+
+    def auto_degree(self,options=default_degree_options):
+
+        """Choose the degree of polynomial for the current molecule by cross-validation: every
+           degree in the range of the options is scored by leave-one-out (criterion 'loo') or
+           generalized ('gcv') cross-validation, all from one factorization (Matfunc.chebselect),
+           and the best scoring degree is kept along with its fitted Chebyshev series. GCV
+           favours the highest degrees on short dilution series, so leave-one-out is the default.
+           Returns the degree, or 0 if the data are too few to choose one"""
+
+        logx = self.get_current('logx')
+        ydata = self.get_current('ydata')
+        maxdeg = min(options['maxdeg'],len(logx)-2)
+        if maxdeg < options['mindeg']:
+            self.whoops("Your data do not support choosing the degree of polynomial automatically")
+            return 0
+        profiler.start('degree selection')
+        (lo, hi) = self.get_current('doses')['range']
+        (ndeg, cheb, scores) = Matfunc.chebselect((Matfunc.Vec(logx),self.poly_responses(ydata)),maxdeg, \
+                                                  low=lo,high=hi,mindegree=options['mindeg'], \
+                                                  criterion=options['criterion'], \
+                                                  design=self.poly_design(maxdeg))
+        profiler.stop('degree selection')
+        self.put_current('polydeg',ndeg)
+        self.put_current('cheb',cheb)
+        self.put_current('chebrange',(lo,hi))
+        self.update_display(string.upper(options['criterion']), \
+                fmt="\nAutomatic choice of polynomial degree by %s cross-validation:\n")
+        n = options['mindeg']
+        while n <= maxdeg:
+            if scores[n] != None:
+                self.update_display((n,scores[n]),fmt="degree %2i:   score = %18.6g\n",tag='data')
+            n = n + 1
+        self.update_display(ndeg,fmt="Polynomial of degree = %i selected\n")
+        return ndeg
+
+
     def cancel_degree(self):
 
         """Cancel choice of degree of fitted polynomial"""
@@ -851,29 +1667,47 @@ class Console:
 
     def fit_polynomial(self):
 
-        """ Fit the chosen polynomial to the data, compute polynomial derivatives and use
-            them in Newton-Raphson iterations from the initial ED50 estimate, to solve
-            the polynomial for the ED50 value at the local point of inflexion (d2y/dx2=0)"""
+        """ Fit the chosen polynomial to the data, compute polynomial derivatives and
+            solve the polynomial for the ED50 value at the point of inflexion (d2y/dx2=0)
+            nearest the initial ED50 estimate.
+            The fit is done in a Chebyshev basis over the range of log(dose), which stays
+            well conditioned where the Vandermonde solve of polyfit does not, with the
+            design matrix shared by the molecules of the plate at the same doses;
+            the monomial coefficients are kept in 'poly' for display and export.
+            A series of the chosen degree already fitted by auto_degree is used as it is"""
 
         if self.molecule == '':
             self.whoops("No molecule data currently selected for processing")
             return
-        xdata = self.get_current('xdata')
-        ydata = self.get_current('ydata')
-        logx = self.get_current('logx')
-        polydeg = self.get_current('polydeg')
-        edguess = self.get_current('edguess')
-        if polydeg == 0:
+        if self.get_current('polydeg') == 0:
             self.whoops("No polynomial chosen for fitting")
             return
-        if edguess == 0.0:
+        if self.get_current('edguess') == 0.0:
             self.whoops("No initial estimate for ED50 supplied")
             return
-        x = Matfunc.Vec(logx)
-        y = Matfunc.Vec(ydata)
-        xy = Matfunc.Table([x, y])
-        poly = Matfunc.polyfit(xy,degree=polydeg)
+        self.poly_fit()
+        self.find_root(default_precision)
+        self.draw_graph()
+
+
+    def poly_fit(self):
+
+        """Fit the chosen polynomial to the current molecule, with its derivatives and fit
+           metrics, but without solving it for the ED50; fit_polynomial solves one molecule
+           and a batch of fitted molecules is solved at once by find_roots"""
+
+        ydata = self.get_current('ydata')
+        logx = self.get_current('logx')
+        polydeg = self.get_current('polydeg')
+        profiler.start('polynomial fit')
+        (lo, hi) = self.get_current('doses')['range']
+        cheb = self.get_current('cheb')
+        if len(cheb) != polydeg+1 or self.get_current('chebrange') != (lo,hi):
+            cheb = self.poly_design(polydeg).solve(self.poly_responses(ydata))
+        poly = cheb.cheb2poly(lo,hi)
         poly.reverse()
+        self.put_current('cheb',cheb)
+        self.put_current('chebrange',(lo,hi))
         self.put_current('poly',poly)
         self.update_display("\nFitted polynomial coefficients:")
         n = 0
@@ -881,14 +1715,39 @@ class Console:
             self.update_display((n,poly[n]),fmt="a(%2i) = %18.6f\n",tag='data')
             n = n + 1
         self.get_derivatives()
-        self.find_root(default_precision)
-        yfit = []
-        n = 0
-        while n < len(logx):
-                yfit.append(self.eval_polynomial(poly,logx[n]))
-                n = n + 1
+        yfit = [cheb.chebval(x,lo,hi) for x in logx]
+        (sse, sumy, sumyy, total) = weighted_sums(ydata,yfit,self.get_current('doses')['weights'], \
+                                                   self.get_current('cleaning')['within'])
         self.put_current('yfit',yfit)
-        self.draw_graph()
+        self.put_current('metrics',fit_metrics(sse,sumy,sumyy,total,polydeg+1))
+        profiler.stop('polynomial fit')
+        self.show_metrics("Polynomial",self.get_current('metrics'))
+
+
+    def poly_design(self,degree):
+
+        """The Chebyshev design matrix of the given degree for the current molecule's doses,
+           from the dose table it shares with the other molecules at the same doses, with
+           its rows weighted for dose means of replicates"""
+
+        doses = self.get_current('doses')
+        if not doses['designs'].has_key(degree):
+            (lo, hi) = doses['range']
+            design = Matfunc.chebdesign(doses['logx'],degree,lo,hi)
+            if doses['rootw'] is not None:
+                design = Matfunc.Mat([row*w for (row, w) in zip(design,map(float,doses['rootw']))])
+            doses['designs'][degree] = design
+        return doses['designs'][degree]
+
+
+    def poly_responses(self,ydata):
+
+        """The responses as the right hand side for the current molecule's poly_design"""
+
+        rootw = self.get_current('doses')['rootw']
+        if rootw is None:
+            return Matfunc.Vec(ydata)
+        return Matfunc.Vec([y*w for (y, w) in zip(ydata,map(float,rootw))])
 
 
     def eval_polynomial(self,coefs,x):
@@ -905,7 +1764,8 @@ class Console:
 
     def get_derivatives(self):
 
-        """Compute 1st, 2nd and 3rd derivatives of the fitted polynomial"""
+        """Compute 1st, 2nd and 3rd derivatives of the fitted polynomial, both as
+            monomial coefficients and as Chebyshev series for the root finder"""
 
         poly = self.get_current('poly')
         poly1 = []
@@ -926,41 +1786,68 @@ class Console:
         self.put_current('poly1',poly1)
         self.put_current('poly2',poly2)
         self.put_current('poly3',poly3)
+        cheb = self.get_current('cheb')
+        (lo, hi) = self.get_current('chebrange')
+        cheb2 = cheb.chebder(lo,hi).chebder(lo,hi)
+        self.put_current('cheb2',cheb2)
+        self.put_current('cheb3',cheb2.chebder(lo,hi))
 
 
     def find_root(self,precision):
 
-        """Solve local 2nd derivative root using Newton-Raphson method"""
-
-        xdata = self.get_current('xdata')
-        poly = self.get_current('poly')
-        poly1 = self.get_current('poly1')
-        poly2 = self.get_current('poly2')
-        poly3 = self.get_current('poly3')
-        edguess = self.get_current('edguess')
-        self.update_display("\nNewton-Raphson iterations to solve local root of polynomial:")
-        edfit = 0.0
-        xmax = max(xdata)
-        xmin = min(xdata)
-        x = edguess
-        f = self.eval_polynomial(poly2,x)
-        fd = self.eval_polynomial(poly3,x)
+        """Solve the polynomial of the current molecule for its ED50 (see find_roots)"""
+
+        if len(self.find_roots([(self.bioassay,self.molecule)],precision)) > 0:
+            self.whoops("No point of inflexion of the polynomial within the dose range for:\n" + \
+                        self.molecule)
+
+
+    def find_roots(self,keys,precision):
+
+        """Solve the fitted polynomials of a batch of molecules for their ED50s, at the
+           points of inflexion (d2y/dx2=0) nearest their ED50 estimates. All the points of
+           inflexion within each molecule's range of log(dose) are found in one call to
+           Matfunc.chebroots, which takes a capped number of safeguarded Newton steps and
+           so always returns; the steps are counted by the profiler. A molecule whose
+           polynomial has no point of inflexion in its dose range is left without a fitted
+           ED50 (edfit 0) and logged, and the names of those molecules are returned, so
+           that one such molecule does not stop a batch. The points of inflexion are only
+           logged when Options-> Log Root Finding is on"""
+
+        series = []
+        lows = []
+        highs = []
+        for key in keys:
+            record = self.index[key]
+            series.append(record['cheb2'])
+            lows.append(record['chebrange'][0])
+            highs.append(record['chebrange'][1])
+        profiler.start('root finding')
+        (roots, steps) = Matfunc.chebroots(series,lows,highs,tol=precision, \
+                                           maxiter=self.root_options['maxiter'],WithSteps=1)
+        profiler.stop('root finding')
+        profiler.count('polynomials solved',len(keys))
+        profiler.count('Newton and bisection steps',steps)
+        missing = []
         n = 0
-        while 1:
-            dx = f / fd
-            if abs(dx) < precision * (1 + abs(x)):
-                edfit = x - dx
-                self.put_current('edfit',edfit)
-                edf = 10**edfit
-                self.update_display(edf,fmt="\nNewton-Raphson solution for fitted ED50 = %12.3f\n")
-                return
-            x = x - dx
-            f = self.eval_polynomial(poly2,x)
-            fd = self.eval_polynomial(poly3,x)
+        while n < len(keys):
+            record = self.index[keys[n]]
+            if len(keys) > 1:
+                self.update_display(keys[n],fmt="\nBioassay = %s, Molecule = %s")
+            if self.root_options['log']:
+                self.update_display("\nPoints of inflexion of the polynomial in the dose range:")
+                for x in roots[n]:
+                    self.update_display((x,10.0**x),fmt="log(x) = %15.6f,   x = %15.6f\n",tag='data')
+            if len(roots[n]) == 0:
+                record['edfit'] = 0.0
+                missing.append(keys[n][1])
+                self.update_display("\nNo point of inflexion of the polynomial within the dose range")
+            else:
+                nearest = min([(abs(x-record['edguess']),x) for x in roots[n]])[1]
+                record['edfit'] = nearest
+                self.update_display(10.0**nearest,fmt="\nPolynomial solution for fitted ED50 = %12.3f\n")
             n = n + 1
-            lx = 10.0**x
-            self.update_display((n, f, lx),fmt="Newton-Raphson iteration(%3i):   f(x)=%15.6f,   x=%15.6f\n", \
-                                tag='data')
+        return missing
 
 
     def set_graph_border(self):
@@ -1013,6 +1900,62 @@ class Console:
         self.gborder.destroy()
 
 
+    def toggle_root_log(self):
+
+        """Switch the logging of the points of inflexion found by the root finder on or off"""
+
+        self.root_options['log'] = self.root_log_on.get()
+
+
+    def set_robust_loss(self):
+
+        """Choose least squares or one of the robust losses for the curve model fits"""
+
+        self.robust_options['loss'] = self.robust_loss.get()
+
+
+    def toggle_profile(self):
+
+        """Switch the profiling timers and counters on or off"""
+
+        profiler.on = self.profile_on.get()
+        if profiler.on:
+            self.update_display("\nProfiling timers and counters switched on")
+        else:
+            self.update_display("\nProfiling timers and counters switched off")
+
+
+    def show_profile(self):
+
+        """Write the profiling timers and counters to the activity log"""
+
+        lines = profiler.report()
+        if len(lines) == 0:
+            self.update_display("\nNo profiling data (switch on Options-> Profile Timing)")
+            return
+        self.update_display("\nProfile timers and counters:")
+        for line in lines:
+            self.update_display(line,tag='data')
+
+
+    def save_profile(self):
+
+        """Save the profiling timers and counters to file in JSON format"""
+
+        pfile = tkFileDialog.asksaveasfilename(title="ABE: Save Profile",initialdir=self.workdir, \
+                    filetypes=[('JSON Files', '*.json'),('All Files','*.*')],defaultextension='.json')
+        if pfile != None and pfile != '':
+            profiler.dump(pfile)
+
+
+    def reset_profile(self):
+
+        """Clear the profiling timers and counters"""
+
+        profiler.reset()
+        self.update_display("\nProfiling timers and counters reset")
+
+
     def toggle_al(self):
 
         """Toggle the visibility status of the activity log window"""
@@ -1050,38 +1993,57 @@ class Console:
 
     def export_results(self):
 
-        """Export data models as a tab-delimited table for input to Excel"""
+        """Export the data models as a results table, in the format chosen by the file extension:
+           tab delimited text (.txt) for input to Excel, comma separated values (.csv) or the
+           compact binary columnar format (.abec) described in the Abeexport module"""
         
-        exfile = tkFileDialog.asksaveasfile(title="ABE: Export Results Table",initialdir=self.workdir, \
-                    filetypes=[('Text Files', '*.txt'),('All Files','*.*')],defaultextension='.txt')
-        if exfile != None and exfile != '':
-            exfile.write("ABE: Data modeling results\n")
-            for mol in self.molecule_list:
-                edfit = self.data[self.bioassay][mol]['edfit']
-                edf = 10.0**edfit
-                poly = self.data[self.bioassay][mol]['poly']
-                four_param = self.data[self.bioassay][mol]['four_param']
-                ffourp = four_param['fit']
-                afourp = four_param['a']
-                bfourp = four_param['b']
-                cfourp = four_param['c']
-                dfourp = four_param['d']
-                if ffourp == 2:
-                    exfile.write("%s \t %s \t'Four parameter fitted ED50'\t %.6f" % (self.bioassay,mol,cfourp))
-                    exfile.write("\t'a(ymin)'\t%.6f\t'b(slope)'\t%.6f\t'c(ED50)'\t%.6f\t'd(ymax)'\t%.6f\n" \
-                                  % (afourp,bfourp,cfourp,dfourp))
-                elif ffourp == 1:
-                    exfile.write("%s \t %s \t'Four parameter search ED50'\t %.6f" % (self.bioassay,mol,cfourp))
-                    exfile.write("\t'a(ymin)'\t%.6f\t'b(slope)'\t%.6f\t'c(ED50)'\t%.6f\t'd(ymax)'\t%.6f\n" \
-                                  % (afourp,bfourp,cfourp,dfourp))
-                if edfit != 0.0:
-                    exfile.write("%s \t %s \t'Polynomial fitted ED50'\t %.6f" % (self.bioassay,mol,edf))
-                    n = 0
-                    while n < len(poly):
-                        exfile.write("\t a[%i] \t %.6f" % (n,poly[n]))
-                        n = n + 1
-                    exfile.write("\n")
-            exfile.close()
+        exname = tkFileDialog.asksaveasfilename(title="ABE: Export Results Table",initialdir=self.workdir, \
+                    filetypes=[('Text Files', '*.txt'),('CSV Files', '*.csv'),('ABE Columnar Files', '*.abec'), \
+                               ('All Files','*.*')],defaultextension='.txt')
+        if exname != None and exname != '':
+            format = Abeexport.format_for(exname)
+            try:
+                exfile = open(exname,'wb')
+                nrows = self.write_results(exfile,format)
+                exfile.close()
+            except IOError, e:
+                self.whoops("Unable to export results to " + exname + "\n" + str(e))
+                return
+            self.update_display((nrows,exname),fmt="\n%i result rows exported to %s\n")
+
+
+    def write_results(self,exfile,format='text'):
+
+        """Write the data models to an open file in one of the Abeexport formats and
+           return the number of rows written"""
+
+        return Abeexport.write(self.result_rows(),exfile,format)
+
+
+    def result_rows(self):
+
+        """Generate the rows of the results table (see Abeexport) molecule by molecule,
+           one row for each model fitted to a molecule"""
+
+        for (bioassay, mol) in self.molecule_list:
+            record = self.index[(bioassay,mol)]
+            for model in curve_models:
+                fit = record[model.key]
+                if fit['fit']:
+                    if fit['fit'] == 2:
+                        tag = model.tag
+                    else:
+                        tag = model.tag + ' search'
+                    yield (bioassay, mol, tag, fit.get('a'), fit.get('b'), fit.get('c'), fit.get('d'), \
+                           fit.get('e'), model.ed50(model.params(fit))) + metric_values(fit['metrics']) + \
+                           ([], [float(n+1) for n in fit['outliers']])
+            fit = record['global']
+            if fit != None:
+                yield (bioassay, mol, '4PL global', fit['a'], fit['b'], fit['c'], fit['d'], None, fit['c']) + \
+                      metric_values(fit['metrics']) + ([], [])
+            if record['edfit'] != 0.0:
+                yield (bioassay, mol, 'poly', None, None, None, None, None, 10.0**record['edfit']) + \
+                      metric_values(record['metrics']) + (list(record['poly']), [])
 
 
     
@@ -1093,31 +2055,49 @@ class Console:
             self.whoops("No molecule data currently selected for processing")
             return
         yfit = self.get_current('yfit')
-        four_param=self.get_current('four_param')
-        yfp = four_param['yfit']
-        if len(yfit) == 0 and len(yfp) == 0:
+        columns = []
+        if len(yfit) > 0:
+            columns.append(('Poly',yfit))
+        fits = []
+        for model in curve_models:
+            fit = self.get_current(model.key)
+            if len(fit['yfit']) > 0:
+                columns.append((model.short,fit['yfit']))
+                fits.append((model,fit))
+        if len(columns) == 0:
             self.whoops("No fitting has yet been applied to this data")
             return
         xdata = self.get_current('xdata')
         ydata = self.get_current('ydata')
-        logx = self.get_current('logx')
         self.update_display("\nShow Fitted Data:")       
         xlabel = self.columns[self.x]
         ylabel = self.columns[self.y]
-        plabel = 'Poly'
-        flabel = '4Par'
         n = 0
         for x in xdata:
-            if len(yfp) > 0 and len(yfit) > 0:
-                self.update_display((n+1,xlabel,xdata[n],ylabel,ydata[n],plabel,yfit[n],flabel,yfp[n]), \
-                fmt="%3i:   %s=%12.3f   %s=%12.3f   %s=%12.3f  %s=%12.3f\n",tag='data')
-            elif len(yfp) == 0 and len(yfit) > 0:
-                self.update_display((n+1,xlabel,xdata[n],ylabel,ydata[n],plabel,yfit[n]), \
-                fmt="%3i:   %s=%12.3f   %s=%12.3f   %s=%12.3f\n",tag='data')
-            elif len(yfp) > 0 and len(yfit) == 0:
-                self.update_display((n+1,xlabel,xdata[n],ylabel,ydata[n],flabel,yfp[n]), \
-                fmt="%3i:   %s=%12.3f   %s=%12.3f   %s=%12.3f\n",tag='data')
+            line = "%3i:   %s=%12.3f   %s=%12.3f" % (n+1,xlabel,xdata[n],ylabel,ydata[n])
+            for (label, yf) in columns:
+                line = line + "   %s=%12.3f" % (label,yf[n])
+            self.update_display(line,tag='data')
             n = n + 1
+        for (model, fit) in fits:
+            self.show_metrics(model.label,fit['metrics'])
+        if len(yfit) > 0:
+            self.show_metrics("Polynomial",self.get_current('metrics'))
+
+
+    def show_metrics(self,model,metrics):
+
+        """Display the goodness-of-fit metrics of a fitted model in the activity log window"""
+
+        if len(metrics) == 0:
+            return
+        self.update_display((model,metrics['n'],metrics['k']), \
+                fmt="\n%s model goodness of fit (%i points, %g parameters):\n")
+        for (label, field) in (('SSE','sse'),('RMSE','rmse'),('R2','r2'),('AIC','aic'),('BIC','bic')):
+            if metrics[field] == None:
+                self.update_display(label,fmt="%-4s = %18s\n",tag='data')
+            else:
+                self.update_display((label,metrics[field]),fmt="%-4s = %18.6g\n",tag='data')
 
 
     def pick_ymaxmin(self):
@@ -1223,19 +2203,9 @@ class Console:
             return
         self.fourp_kill = 0
         four_param = self.get_current('four_param')
-        xdata = self.get_current('xdata')
-        ydata = self.get_current('ydata')
-        logx = self.get_current('logx')
         if four_param['c'] == None:
             self.whoops("No initial estimate for ED50 supplied")
             return
-        ysrchfrac = self.fourp_options['ysrch']
-        xsrchfrac = self.fourp_options['xsrch']
-        ysi = self.fourp_options['yiter']
-        esi = self.fourp_options['eiter']
-        ssi = self.fourp_options['siter']
-        isi = self.fourp_options['isiter']
-        slpmax = self.fourp_options['slopemax']
         self.pccomplete = 0
         self.fpdialog = Toplevel(self.root)
         self.fpdialog.resizable(width=0,height=0)
@@ -1247,6 +2217,53 @@ class Console:
         self.fpkill = Button(self.fpdialog,text="Cancel 4-parameter fitting",command=self.set_fourp_kill)
         self.fpkill.pack(pady=5)
         self.fpdialog.update()
+        if not self.fourp_fit():
+            self.fpdialog.destroy()
+            return
+        four_param = self.get_current('four_param')
+        dtext = "Four-parameter data fitting completed\n\na = %15.3f\nb = %15.3f\nc = %15.3f\nd = %15.3f" % \
+                (four_param['a'],four_param['b'],four_param['c'],four_param['d'])
+        self.fphead.configure(text=dtext,font=('Courier',10,'bold'))
+        self.fpkill.configure(text="OK")
+        self.fourp_kill = 1
+        self.fpdialog.update()
+        self.draw_graph()
+
+
+    def fourp_progress(self):
+
+        """Show the progress of the 4-parameter search in the fitting dialog"""
+
+        self.fphead.configure(text="Fitting four-parameter model, please wait ...\nFitting %d percent complete" \
+                                % self.pccomplete)
+        self.fpdialog.update()
+
+
+    def fourp_fit(self):
+
+        """The 4-parameter model search and nonlinear regression for the current molecule.
+           Returns 0 if the fit was cancelled from the fitting dialog, otherwise 1"""
+
+        return self.curve_fit(four_param_model)
+
+
+    def fourp_search(self):
+
+        """The 4-parameter model initialization search for the current molecule: a slope
+           search followed by a grid search over ymin, ymax, ED50 and slope about the ED50
+           estimate. Returns the best (a, b, c, d) of the grid, or None if the fit was
+           cancelled from the fitting dialog"""
+
+        four_param = self.get_current('four_param')
+        xdata = self.get_current('xdata')
+        ydata = self.get_current('ydata')
+        ysrchfrac = self.fourp_options['ysrch']
+        xsrchfrac = self.fourp_options['xsrch']
+        ysi = self.fourp_options['yiter']
+        esi = self.fourp_options['eiter']
+        ssi = self.fourp_options['siter']
+        isi = self.fourp_options['isiter']
+        slpmax = self.fourp_options['slopemax']
         xmax = max(xdata)
         xmin = min(xdata)
         xr = xmax - xmin
@@ -1283,15 +2300,19 @@ class Console:
             ymaxsp.append(ymax1 + n*incymax)
         for n in range(0,esi):
             esp.append(emin1 + n*ince)
+        profiler.start('4-parameter search')
+        lnx = self.get_current('doses')['lnx']
+        wts = self.get_current('doses')['weights'] or [1.0]*len(lnx)
+        lnedg = math.log(edg)
         nsmin = 0
         isinc = 1.0/isi
         for ns in range(0,isi):
+            slope = ns * isinc * slpmax
             yd = 0.0
             n = 0
-            while n < len(xdata):
-                slope = ns * isinc * slpmax
-                yc = self.eval_four_param_model(xdata[n],ymin,ymax,slope,edg)
-                yd = yd + (ydata[n]-yc)*(ydata[n]-yc)
+            while n < len(lnx):
+                yc = ymax + (ymin-ymax)/(1.0 + math.exp(slope*(lnx[n]-lnedg)))
+                yd = yd + wts[n]*(ydata[n]-yc)*(ydata[n]-yc)
                 n = n + 1
             if ns == 0:
                 ydmin = yd
@@ -1299,9 +2320,10 @@ class Console:
                 if yd < ydmin:
                     ydmin = yd
                     nsmin = ns
+        profiler.count('model evaluations',isi*len(xdata))
         if self.fourp_kill:
-            self.fpdialog.destroy()
-            return
+            profiler.stop('4-parameter search')
+            return None
         sguess = nsmin * isinc * slpmax
         smin = sguess - (ysrchfrac/2.0)*sguess
         smax = sguess + (ysrchfrac/2.0)*sguess
@@ -1309,80 +2331,278 @@ class Console:
         ssp = []
         for n in range(0,ssi):
             ssp.append(smin + n*incs)
+        # The model is y = d + (a-d)*s(x), where the shape s = 1/(1 + (x/c)**b) depends on c and b
+        # alone. With the sums of s, s*s and y*s over the data for each (c,b) of the grid, the
+        # sum of squares of any (a,d) follows without touching the data again: for responses
+        # y taken about their mean, with u = a-d and e = d-mean, it is
+        #     sum(y*y) - 2*u*sum(y*s) + n*e*e + 2*e*u*sum(s) + u*u*sum(s*s)
+        # where, for dose means of replicates, every sum is weighted by the number of
+        # replicates, the mean is the weighted mean and n is the number of replicates in all
+        npts = len(lnx)
+        wtot = sum(wts)
+        ymean = sum([w*y for (w, y) in zip(wts,ydata)])/wtot
+        yc = [y - ymean for y in ydata]
+        syy = 0.0
+        n = 0
+        while n < npts:
+            syy = syy + wts[n]*yc[n]*yc[n]
+            n = n + 1
+        shapes = []
+        for cedg in esp:
+            lnc = math.log(cedg)
+            for cslp in ssp:
+                s1 = s2 = sy = 0.0
+                n = 0
+                while n < npts:
+                    sn = 1.0/(1.0 + math.exp(cslp*(lnx[n]-lnc)))
+                    wsn = wts[n]*sn
+                    s1 = s1 + wsn
+                    s2 = s2 + wsn*sn
+                    sy = sy + yc[n]*wsn
+                    n = n + 1
+                shapes.append((s1,s2,sy,cedg,cslp))
+        profiler.count('model evaluations',len(shapes)*npts)
         ydmin = 9.9E+20
         pcinc = int(100.0/ysi)
         for cymax in ymaxsp:
             self.pccomplete = self.pccomplete + pcinc
-            self.fphead.configure(text="Fitting four-parameter model, please wait ...\nFitting %d percent complete" \
-                                    % self.pccomplete)
-            self.fpdialog.update()
+            self.fourp_progress()
             if self.fourp_kill:
-                self.fpdialog.destroy()
-                return
+                profiler.stop('4-parameter search')
+                return None
+            e = cymax - ymean
+            ne2 = wtot*e*e
             for cymin in yminsp:
-                for cedg in esp:
-                    for cslp in ssp:
-                        yd = 0.0
-                        n = 0
-                        while n < len(xdata):
-                            yc = self.eval_four_param_model(xdata[n],cymin,cymax,cslp,cedg)
-                            yd = yd + (ydata[n]-yc)*(ydata[n]-yc)
-                            n = n + 1
-                        if yd < ydmin:
-                            ydmin = yd
-                            optymax = cymax
-                            optymin = cymin
-                            opted50 = cedg
-                            optslope = cslp
-        fa = (xdata,ydata)
-        x0 = [0, 0, 0, 0]
-        x0[0] = optymin
-        x0[1] = optslope
-        x0[2] = opted50
-        x0[3] = optymax
-        fcn = four_param_model1
+                u = cymin - cymax
+                for (s1,s2,sy,cedg,cslp) in shapes:
+                    yd = syy - 2.0*u*sy + ne2 + 2.0*e*u*s1 + u*u*s2
+                    if yd < ydmin:
+                        ydmin = yd
+                        optymax = cymax
+                        optymin = cymin
+                        opted50 = cedg
+                        optslope = cslp
+            profiler.count('grid cells scored',len(yminsp)*len(shapes))
+        profiler.stop('4-parameter search')
+        return [optymin, optslope, opted50, optymax]
+
+
+    def fit_model(self,model):
+
+        """Fit a registered curve model to the current molecule (the Data Model menu action)"""
+
+        if self.molecule == '':
+            self.whoops("No molecule data currently selected")
+            return
+        model.fit(self)
+
+
+    def wells(self):
+
+        """The doses and cleaned responses of every well of the current molecule, in the
+           order of its dose plan (see dose_plan and clean_responses), with the indexes of
+           the wells in the data file"""
+
+        raw = self.get_current('raw')
+        plan = self.plates[self.bioassay]['plans'][tuple(raw['xdata'])]
+        order = plan['order']
+        x = Numeric.take(Numeric.array(raw['xdata']),order)
+        y = Numeric.maximum(Numeric.take(Numeric.array(raw['ydata']),order),0.0)
+        return x, map(float,y), order
+
+
+    def curve_fit(self,model):
+
+        """Fit a registered curve model to the current molecule by nonlinear least squares
+           from the starting values of the model's seed, with the model's analytic Jacobian
+           (and in the logs of the parameters the model keeps positive; see regression_params).
+           If the regression fails the seed values are kept and the fit is marked unstable
+           (fit 1 rather than 2). Dose means of replicates are weighted by their numbers of
+           replicates (see dose_table). With a robust loss chosen in the options, a successful
+           regression is followed by robust_fit, which keeps the weights of the data points
+           and the outliers it flags with the fit. On a plate with replicates the robust
+           refit is over every well (see wells), so that one bad well is not hidden in its
+           dose mean, and the outliers are the indexes of the wells in the data file.
+           Returns 0 if there were no starting values (the seeding search was cancelled),
+           otherwise 1"""
+
+        x0 = model.seed(self)
+        if x0 == None:
+            return 0
+        fit = self.get_current(model.key)
+        xdata = Numeric.array(self.get_current('xdata'))
+        ydata = self.get_current('ydata')
+        doses = self.get_current('doses')
+        profiler.start('leastsq')
         try:
-            fp = scipy.optimize.minpack.leastsq(fcn,x0,args=fa)
-            four_param['a'] = fp[0][0]
-            four_param['b'] = fp[0][1]
-            four_param['c'] = fp[0][2]
-            four_param['d'] = fp[0][3]
-            four_param['fit'] = 2
+            fp = scipy.optimize.minpack.leastsq(model_residuals,regression_params(model,x0), \
+                                                args=(model,xdata,ydata,doses['rootw']), \
+                                                Dfun=model_jacobian,col_deriv=1)
+            params = model_params(model,map(float,fp[0]))
+            for value in params:
+                if math.isnan(value) or math.isinf(value):
+                    raise ValueError("Nonlinear regression diverged")
+            if model.ed50(params) == None:
+                raise ValueError("Nonlinear regression gave no ED50")
+            fit['fit'] = 2
         except:
-            four_param['a'] = optymin
-            four_param['b'] = optslope
-            four_param['c'] = opted50
-            four_param['d'] = optymax
-            four_param['fit'] = 1
+            params = x0
+            fit['fit'] = 1
+        profiler.stop('leastsq')
+        fit['weights'] = []
+        fit['outliers'] = []
+        loss = self.robust_options['loss']
+        if fit['fit'] == 2 and loss != 'none':
+            profiler.start('robust refit')
+            if len(doses['weights']) > 0:
+                (xwells, ywells, order) = self.wells()
+                (params, fit['weights'], outliers, solves, capped) = \
+                         robust_fit(model,params,xwells,ywells,self.robust_options)
+                fit['outliers'] = [int(order[n]) for n in outliers]
+                fit['outliers'].sort()
+            else:
+                (params, fit['weights'], fit['outliers'], solves, capped) = \
+                         robust_fit(model,params,xdata,ydata,self.robust_options)
+            profiler.stop('robust refit')
+            if capped:
+                profiler.count('robust refits stopped at maxiter')
         n = 0
-        a = four_param['a']
-        b = four_param['b']
-        c = four_param['c']
-        d = four_param['d']
-        four_param['yfit'] = []
-        while n < len(xdata):
-            yf = self.eval_four_param_model(xdata[n],a,d,b,c)
-            four_param['yfit'].append(yf)
+        while n < len(model.names):
+            fit[model.names[n]] = params[n]
             n = n + 1
-        self.put_current('four_param',four_param)
-        self.update_display("\nFitted four-parameter model:")
-        if four_param['fit'] == 1:
+        fit['yfit'] = map(float,model.evaluate(xdata,params))
+        (sse, sumy, sumyy, total) = weighted_sums(ydata,fit['yfit'],doses['weights'], \
+                                                   self.get_current('cleaning')['within'])
+        fit['metrics'] = fit_metrics(sse,sumy,sumyy,total,len(model.names))
+        self.put_current(model.key,fit)
+        self.update_display("\nFitted " + string.lower(model.label) + " model:")
+        if fit['fit'] == 1:
             self.update_display("Nonlinear least-squares regression was unstable")
-            self.update_display("Using parameters derived from 4-D initialization search")
+            self.update_display("Using parameters derived from " + model.seeding)
         else:
             self.update_display("Nonlinear least-squares regression was stable")
             self.update_display("Using parameters derived from nonlinear least-squares regression")
-        self.update_display(a,fmt="a (ymin)  = %18.3f\n",tag='data')
-        self.update_display(b,fmt="b (slope) = %18.3f\n",tag='data')
-        self.update_display(c,fmt="c (ED50)  = %18.3f\n",tag='data')
-        self.update_display(d,fmt="d (ymax)  = %18.3f\n",tag='data')
-        self.update_display(c,fmt="\nFour-parameter data model solution for fitted ED50 = %12.3f\n")
-        dtext = "Four-parameter data fitting completed\n\na = %15.3f\nb = %15.3f\nc = %15.3f\nd = %15.3f" % (a,b,c,d)
-        self.fphead.configure(text=dtext,font=('Courier',10,'bold'))
-        self.fpkill.configure(text="OK")
-        self.fourp_kill = 1
-        self.fpdialog.update()
-        self.draw_graph()
+        if len(fit['weights']) > 0:
+            self.update_display((string.capitalize(loss),solves), \
+                    fmt="%s robust refit by %i reweighted least-squares solves\n")
+            if capped:
+                self.update_display(self.robust_options['maxiter'], \
+                        fmt="Robust refit stopped after %i solves without converging\n")
+            if len(fit['outliers']) > 0 and len(doses['weights']) > 0:
+                self.update_display(string.join([str(n+1) for n in fit['outliers']],', '), \
+                        fmt="Outliers flagged at wells %s of the data file\n")
+            elif len(fit['outliers']) > 0:
+                self.update_display(string.join([str(n+1) for n in fit['outliers']],', '), \
+                        fmt="Outliers flagged at data points %s\n")
+            else:
+                self.update_display("No outliers flagged")
+        n = 0
+        while n < len(model.names):
+            self.update_display((model.labels[n],params[n]),fmt="%-9s = %18.3f\n",tag='data')
+            n = n + 1
+        ed50 = model.ed50(params)
+        if ed50 != None:
+            self.update_display((model.label,ed50),fmt="\n%s data model solution for fitted ED50 = %12.3f\n")
+        self.show_metrics(model.label,fit['metrics'])
+        return 1
+
+
+    def choose_global(self):
+
+        """Dialog to choose the parameters shared by every molecule of the current bioassay
+           in a global 4-parameter fit"""
+
+        if self.bioassay == '':
+            self.whoops("No bioassay data currently selected for processing")
+            return
+        self.globfit = Toplevel(self.root)
+        self.globfit.resizable(width=0,height=0)
+        self.globfit.title("ABE: Global 4-Parameter Fit")
+        mtext = "Parameters shared by all molecules of bioassay '" + self.bioassay + "'"
+        Label(self.globfit,text=mtext,font=('Arial',10),padx=5).grid(row=0,column=0,columnspan=4,pady=5)
+        self.global_shared = {}
+        n = 0
+        for (name, label) in (('a','a (ymin)'),('b','b (slope)'),('c','c (ED50)'),('d','d (ymax)')):
+            self.global_shared[name] = IntVar()
+            self.global_shared[name].set(name != 'c')
+            Checkbutton(self.globfit,text=label,variable=self.global_shared[name]).grid(row=1,column=n,padx=5)
+            n = n + 1
+        Button(self.globfit,text="Fit",command=self.gotglobal).grid(row=2,column=0,columnspan=2,padx=5,pady=5,sticky=EW)
+        Button(self.globfit,text="Cancel",command=self.globfit.destroy).grid(row=2,column=2,columnspan=2,padx=5,pady=5,sticky=EW)
+
+
+    def gotglobal(self):
+
+        """Run the global fit chosen in the dialog over the molecules of the current bioassay"""
+
+        shared = [name for name in ('a','b','c','d') if self.global_shared[name].get()]
+        if len(shared) == 0 or len(shared) == 4:
+            self.globfit.bell()
+            self.whoops("Share between one and three of the parameters in a global fit")
+            return
+        self.globfit.destroy()
+        keys = [(self.bioassay,mol) for mol in self.plates[self.bioassay]['molecules']]
+        if self.fit_global(keys,shared) and self.molecule != '':
+            self.draw_graph()
+
+
+    def fit_global(self,keys,shared):
+
+        """Fit the 4-parameter model to the molecules with the given keys at once, with the
+           parameters named in shared common to all of them (see global_four_param_fit).
+           Each molecule starts from its own 4-parameter fit if it has one, otherwise from
+           its first and last responses, unit slope and its ED50 estimate (or the middle
+           dose). The fit is kept in each record as 'global', with goodness-of-fit metrics
+           that count each molecule's own parameters and its share of the common ones.
+           Returns 1 on success"""
+
+        if len(keys) < 2:
+            self.whoops("A global fit needs at least two molecules")
+            return 0
+        profiler.start('global 4-parameter fit')
+        curves = []
+        for key in keys:
+            record = self.index[key]
+            four_param = record['four_param']
+            if four_param['fit']:
+                start = (four_param['a'],four_param['b'],four_param['c'],four_param['d'])
+            else:
+                xdata = record['xdata']
+                if record['edguess'] != 0.0:
+                    c = 10.0**record['edguess']
+                else:
+                    c = xdata[len(xdata)/2]
+                start = (record['ydata'][0],1.0,c,record['ydata'][-1])
+            curves.append({'lnx':record['doses']['lnx'], 'y':record['ydata'], 'w':record['doses']['weights'], \
+                           'start':start})
+        (fitted, sses, iterations, converged) = global_four_param_fit(curves,shared)
+        profiler.stop('global 4-parameter fit')
+        k = 4 - len(shared) + len(shared)/float(len(keys))
+        n = 0
+        while n < len(keys):
+            record = self.index[keys[n]]
+            (a, b, c, d) = fitted[n]
+            yfit = [self.eval_four_param_model(x,a,d,b,c) for x in record['xdata']]
+            within = record['cleaning']['within']
+            (sse, sumy, sumyy, total) = weighted_sums(record['ydata'],yfit,record['doses']['weights'],within)
+            sses[n] = sses[n] + within
+            record['global'] = {'a':a, 'b':b, 'c':c, 'd':d, 'shared':shared, 'yfit':yfit, 'fit':converged, \
+                                'metrics':fit_metrics(sses[n],sumy,sumyy,total,k)}
+            n = n + 1
+        self.update_display((len(keys),string.join(shared,', ')), \
+                fmt="\nGlobal four-parameter model of %i molecules, sharing %s:\n")
+        if converged:
+            self.update_display(iterations,fmt="Converged in %i iterations\n")
+        else:
+            self.update_display(iterations,fmt="Not converged after %i iterations\n")
+        (a, b, c, d) = fitted[0]
+        for (name, label, value) in (('a','a (ymin)',a),('b','b (slope)',b),('c','c (ED50)',c),('d','d (ymax)',d)):
+            if name in shared:
+                self.update_display((label,value),fmt="%-9s = %18.3f (shared)\n",tag='data')
+        self.update_display(sum(sses),fmt="SSE       = %18.6g (all molecules)\n",tag='data')
+        for n in range(len(keys)):
+            self.update_display((keys[n][1],fitted[n][2],sses[n]),fmt="%-20s ED50 = %12.3f  SSE = %12.6g\n",tag='data')
+        return 1
 
 
     def eval_four_param_model(self,x,ymin,ymax,slope,ed50):
@@ -1719,7 +2939,25 @@ ABE's Menu Functions:
 File->
 
 File-> Load Bioassay Data->
-Loads the selected bioassay data file for processing
+Loads the selected bioassay data file for processing,
+replacing any data that are currently loaded. Each
+molecule's data are cleaned once as they are read:
+records with zero or negative doses (which have no
+log dose) are dropped, the records are sorted by
+dose, negative Y-values are reset to zero and the
+replicates of a dose are averaged. The records read
+and what the cleaning changed are listed in the
+activity log; the graph shows the cleaned data.
+The mean, SD, SEM and number of replicates of each
+dose are listed too; the SEM is used for the error
+bars if the file has no error column, and every
+model is fitted to the dose means weighted by their
+numbers of replicates, which gives the same fit as
+all of the replicates at a fraction of the cost
+
+File-> Add Bioassay Data->
+Adds the bioassays in another data file to those
+already loaded, keeping all of the current data models
 
 File-> Save Activity Log->
 Saves the log of activity and results as a text file
@@ -1728,8 +2966,14 @@ File-> Save Graph Image->
 Saves the CURRENTLY DISPLAYED graph as a postscript file
 
 File-> Export Results Table->
-Saves any current data models in tabular format for
-input into MS Excel
+Saves any current data models as a table with one row
+for each model of each molecule and the columns
+bioassay, molecule, model, a, b, c, d, ED50, residual
+(SSE), RMSE, R2, AIC, BIC and coefficients. The format
+follows the file name:
+tab delimited text (.txt) for input into MS Excel,
+comma separated values (.csv) or the compact binary
+columnar format (.abec) of the Abeexport module
 
 File-> Set Working Directory
 Set the default current working directory (which
@@ -1741,14 +2985,29 @@ Exits the ABE program and ends the data analysis
 
 
 Data->
-Once the bioassay data are loaded, this menu contains
-an entry for each molecule found in the data file
 
 Data-> Process Data->
-Load and process the currently selected molecule
-
-Data-> [molecule-name]->
-Selects the molecule [molecule-name] for processing
+Load and process the molecule selected in the
+molecule picker
+
+Data-> Pick Molecule->
+Opens the molecule picker, which lists the molecules
+of every loaded bioassay in name order. Typing in the
+Molecule box shows the molecules whose names start
+with the text typed (or contain it, if Substring is
+checked). The Filter box narrows the list by fitted
+results: a comma separated list of conditions such as
+"ED50 < 10, slope > 0.5" compares the fields ED50 (the
+4-parameter fit), ED50poly (the polynomial fit),
+slope, ymin, ymax, points or a goodness-of-fit metric
+with a number; "fitted", "unfitted" and "fit failed"
+select by the state of the fits. The metrics are SSE,
+RMSE, R2, AIC and BIC of the 4-parameter fit, and
+polySSE, polyRMSE, polyR2, polyAIC and polyBIC of the
+polynomial fit. Order by ranks the list worst fit
+first by one of the metrics. Click a molecule to
+select it, then press Process (or double-click the
+molecule) to process it
 
 
 Graph->
@@ -1769,6 +3028,10 @@ Graph-> Show 4-parameter Model->
 Toggles the option to display the fitted 4-parameter
 model on the graph [Default=on]
 
+Graph-> Show 5-parameter Model->
+Toggles the option to display the fitted 5-parameter
+model on the graph [Default=on]
+
 Graph-> Show polynomial Model->
 Toggles the option to display the fitted polynomial
 model on the graph [Default=on]
@@ -1793,17 +3056,41 @@ for the ED50 by clicking on the graph
 Data Model-> Fit 4-Parameter Model->
 Fits a 4-parameter model to the current data
 
+Data Model-> Fit 5-Parameter Model->
+Fits the asymmetric 5-parameter model
+y = d + (a-d)/(1 + (x/c)**b)**e to the current data,
+starting from its 4-parameter model (e = 1) if it
+has been fitted. Its ED50 is the dose giving the
+response midway between a and d, which is c only
+when e = 1
+
+Data Model-> Fit Global 4-Parameter Model->
+Fits the 4-parameter model to every molecule of
+the current bioassay at once, with the parameters
+ticked in the dialog (by default a, b and d)
+shared by all of the molecules and the others
+fitted to each one. The work grows only linearly
+with the number of molecules
+
 Data Model-> Choose Polynoimial->
 Choose degree of polynomial to be fitted to
-the current data
+the current data. Automatic chooses the degree
+(from 3 to 9, at most the number of data points
+less 2) that scores best in leave-one-out
+cross-validation, which predicts how well each
+degree would fit data points left out of the fit
 
 Data Model-> Fit Polynomial Model->
 Fits a polynomial model of the chosen degree, to
-the current data
+the current data, and takes as its ED50 the point of
+inflexion of the polynomial nearest the ED50 estimate
 
 Data Model-> Show Fitted Data->
 Displays a table of the model(s) for the current
-data set in the activity log
+data set in the activity log, followed by the
+goodness of fit of each model: the residual sum of
+squares (SSE), the root mean square residual (RMSE),
+R2 and the information criteria AIC and BIC
 
 
 Options->
@@ -1821,6 +3108,43 @@ Sets the initial estimates of the curve y-limits
 (y as x -> 0 and x -> infinity) for the nonlinear
 regression (see manual for details)
 
+Options-> Log Root Finding
+Lists every point of inflexion of the fitted
+polynomial within the dose range in the activity log,
+before the one nearest the ED50 estimate is chosen as
+the polynomial's ED50
+
+Options-> Least Squares / Robust Fitting (Huber) /
+Robust Fitting (Tukey)
+Chooses how the curve models (4- and 5-parameter)
+are fitted. After the least-squares fit, a robust
+fit reweights the data points by the Huber or Tukey
+loss of their residuals (scaled by the median
+absolute residual) and refits, a few times, so that
+a bad well cannot drag the curve. Points whose
+scaled residual exceeds 3 are flagged as outliers
+in the activity log and crossed on the graph. With
+replicates, every well is reweighted on its own and
+the log numbers flagged wells as in the data file
+[Default=Least Squares]
+
+Options-> Profile Timing
+Switches on timers and counters for the slow parts
+of the data processing (XML parsing, activity log,
+4-parameter search, nonlinear regression, polynomial
+fit, root finding and graph drawing) to help track
+down delays
+
+Options-> Show Profile->
+Lists the profiling timers and counters in the
+activity log
+
+Options-> Save Profile->
+Saves the profiling timers and counters as a JSON file
+
+Options-> Reset Profile->
+Clears the profiling timers and counters
+
 
 Window->
 
@@ -1867,25 +3191,487 @@ Boston, MA  02111-1307, USA.
 HTML version of the ABE manual, included with this software)
 """
 
-def four_param_model1(p,*args):
+def four_param_curve(lnx,y,p,weights=[]):
 
-    """Four parameter evaluation function supplied to the nonlinear regression function"""
-    
-    a = p[0]
-    b = p[1]
-    c = p[2]
-    d = p[3]
-    x = args[0]
-    y = args[1]
-    ydiff = []
-    ydtot = 0.0
+    """Residuals (model - data) and Jacobian rows of the 4-parameter model for one curve at the
+       parameters p = (a, b, ln(c), d), with the SSE. The shape s = 1/(1 + exp(b*(ln(x)-ln(c))))
+       gives dy/da = s, dy/dd = 1-s and, with w = (a-d)*s*(1-s), dy/db = -w*(ln(x)-ln(c)) and
+       dy/dln(c) = w*b, so no powers of the doses are taken. Given fitting weights, the
+       residuals and rows are scaled by their square roots"""
+
+    (a, b, lnc, d) = p
+    resid = []
+    jac = []
+    sse = 0.0
     n = 0
-    for xi in x:
-        yi = d + ( (a-d)/(1 + (xi/c)**b) )
-        ydiff.append(yi - y[n])
-        ydtot = ydtot + ydiff[n]
+    while n < len(lnx):
+        z = min(max(b*(lnx[n]-lnc),-700.0),700.0)
+        s = 1.0/(1.0 + math.exp(z))
+        w = (a-d)*s*(1.0-s)
+        r = d + (a-d)*s - y[n]
+        if weights:
+            rw = math.sqrt(weights[n])
+            r = r*rw
+            jac.append((s*rw, -w*(lnx[n]-lnc)*rw, w*b*rw, (1.0-s)*rw))
+        else:
+            jac.append((s, -w*(lnx[n]-lnc), w*b, 1.0-s))
+        resid.append(r)
+        sse = sse + r*r
         n = n + 1
-    yda = Numeric.array(ydiff)
-    return yda
+    return resid, jac, sse
+
+
+def global_four_param_fit(curves,shared,maxiter=100,tol=1.0e-10):
+
+    """Fit the 4-parameter model to a set of curves at once, with the parameters named in shared
+       (any of 'a', 'b', 'c' and 'd', but not all of them) common to every curve and the rest
+       fitted to each curve. Each curve is a dictionary of the natural logs of its doses 'lnx',
+       its responses 'y', optionally their fitting weights 'w', and starting values 'start' =
+       (a,b,c,d); the shared parameters start from the mean over the curves (geometric mean
+       for c).
+
+       Levenberg-Marquardt iterations work in a, b, ln(c) and d with the analytic Jacobian. The
+       Jacobian rows of a curve are non-zero only in the shared columns and in the curve's own
+       columns, so the normal equations are a block arrow system, kept as its blocks and solved
+       by Matfunc.blockarrow in time linear in the number of curves.
+
+       Returns the fitted (a,b,c,d) of each curve, the SSE of each curve, the number of
+       iterations and 1 if the iterations converged within maxiter, otherwise 0 (as when no
+       damped step reduces the SSE)"""
+
+    names = ['a', 'b', 'c', 'd']
+    sidx = [k for k in range(4) if names[k] in shared]
+    lidx = [k for k in range(4) if not names[k] in shared]
+    params = []
+    for curve in curves:
+        (a, b, c, d) = curve['start']
+        params.append([a, b, math.log(c), d])
+    for k in sidx:
+        mean = sum([p[k] for p in params])/len(params)
+        for p in params:
+            p[k] = mean
+    evals = [four_param_curve(curves[i]['lnx'],curves[i]['y'],params[i],curves[i].get('w',[])) for i in range(len(curves))]
+    sse = sum([e[2] for e in evals])
+    lam = 1.0e-3
+    converged = 0
+    stalled = 0
+    iteration = 0
+    while iteration < maxiter and not converged and not stalled:
+        iteration = iteration + 1
+        profiler.count('global 4-parameter iterations')
+        A = [[0.0]*len(sidx) for k in sidx]
+        g = [0.0]*len(sidx)
+        B = []
+        C = []
+        h = []
+        for (resid, jac, csse) in evals:
+            Bi = [[0.0]*len(lidx) for k in sidx]
+            Ci = [[0.0]*len(lidx) for k in lidx]
+            hi = [0.0]*len(lidx)
+            n = 0
+            while n < len(resid):
+                row = jac[n]
+                js = [row[k] for k in sidx]
+                jl = [row[k] for k in lidx]
+                for i in range(len(sidx)):
+                    g[i] = g[i] + js[i]*resid[n]
+                    for j in range(len(sidx)):
+                        A[i][j] = A[i][j] + js[i]*js[j]
+                    for j in range(len(lidx)):
+                        Bi[i][j] = Bi[i][j] + js[i]*jl[j]
+                for i in range(len(lidx)):
+                    hi[i] = hi[i] + jl[i]*resid[n]
+                    for j in range(len(lidx)):
+                        Ci[i][j] = Ci[i][j] + jl[i]*jl[j]
+                n = n + 1
+            B.append(Bi)
+            C.append(Ci)
+            h.append(hi)
+        Bm = [Matfunc.Mat(map(Matfunc.Vec,Bi)) for Bi in B]
+        gv = Matfunc.Vec(g)
+        hv = [Matfunc.Vec(hi) for hi in h]
+        while 1:
+            Ad = damped(A,lam)
+            Cd = [damped(Ci,lam) for Ci in C]
+            try:
+                (ds, dl) = Matfunc.blockarrow(Ad,Bm,Cd,gv,hv)
+                solved = 1
+            except (AssertionError, ArithmeticError):
+                solved = 0
+            if solved:
+                trial = []
+                for i in range(len(params)):
+                    p = params[i][:]
+                    for j in range(len(sidx)):
+                        p[sidx[j]] = p[sidx[j]] - ds[j]
+                    for j in range(len(lidx)):
+                        p[lidx[j]] = p[lidx[j]] - dl[i][j]
+                    trial.append(p)
+                tevals = [four_param_curve(curves[i]['lnx'],curves[i]['y'],trial[i],curves[i].get('w',[])) \
+                          for i in range(len(curves))]
+                tsse = sum([e[2] for e in tevals])
+                if tsse <= sse:
+                    converged = sse - tsse <= tol*sse
+                    params = trial
+                    evals = tevals
+                    sse = tsse
+                    lam = max(lam/10.0,1.0e-12)
+                    break
+            lam = lam*10.0
+            if lam > 1.0e12:
+                stalled = 1
+                break
+    fitted = [(p[0], p[1], math.exp(p[2]), p[3]) for p in params]
+    return fitted, [e[2] for e in evals], iteration, converged
+
+
+def damped(M,lam):
+
+    """The Levenberg-Marquardt damped copy of a block of the normal equations, with its
+       diagonal scaled by 1+lam"""
+
+    D = []
+    for i in range(len(M)):
+        row = M[i][:]
+        row[i] = row[i]*(1.0 + lam) + 1.0e-12
+        D.append(Matfunc.Vec(row))
+    return Matfunc.Mat(D)
+
+
+def regression_params(model,p):
+
+    """The values the nonlinear regression fits for the parameters p of a curve model: the
+       natural logs of those named in the model's logscale, so that the regression cannot
+       step them to zero or below, and the others as they are"""
+
+    q = []
+    n = 0
+    while n < len(model.names):
+        if model.names[n] in model.logscale:
+            q.append(math.log(p[n]))
+        else:
+            q.append(p[n])
+        n = n + 1
+    return q
+
+
+def model_params(model,q):
+
+    """The parameters of a curve model from the values q fitted by the nonlinear regression. The
+       logs are held within +-700, so that a wild step of the regression cannot give 0 or inf"""
+
+    p = []
+    n = 0
+    while n < len(model.names):
+        if model.names[n] in model.logscale:
+            p.append(math.exp(min(max(q[n],-700.0),700.0)))
+        else:
+            p.append(q[n])
+        n = n + 1
+    return p
+
+
+def model_residuals(q,model,x,y,w=None):
+
+    """Residuals (model - data) of a curve model at the regression values q, the function given
+       to the nonlinear regression, each multiplied by the square root of its weight if an array
+       of those, w, is given"""
+
+    profiler.count('leastsq residual calls')
+    profiler.count('model evaluations',len(x))
+    p = model_params(model,q)
+    if w is None:
+        return model.evaluate(x,p) - Numeric.array(y)
+    return w*(model.evaluate(x,p) - Numeric.array(y))
+
+
+def model_jacobian(q,model,x,y,w=None):
+
+    """Jacobian of the residuals of a curve model with respect to the regression values q, one
+       row per parameter, given to the nonlinear regression (with col_deriv set), weighted as the
+       residuals are. The row of a parameter fitted as its log is the model's row times the
+       parameter, since dy/dln(c) = c*dy/dc"""
+
+    profiler.count('leastsq jacobian calls')
+    p = model_params(model,q)
+    jac = model.jacobian(x,p)
+    n = 0
+    while n < len(model.names):
+        if model.names[n] in model.logscale:
+            jac[n] = jac[n]*p[n]
+        n = n + 1
+    if w is None:
+        return jac
+    return w*jac
+
+
+def robust_weights(resid,loss,nparams=0):
+
+    """Iteratively reweighted least-squares weights of residuals under the Huber or Tukey
+       (biweight) loss, with the residuals scaled by their median absolute value / 0.6745
+       (a robust estimate of their standard deviation), corrected for the nparams fitted
+       parameters. Returns the weights and the scaled residuals; the weights are all 1 if
+       the scale is 0"""
+
+    absres = map(abs,resid)
+    order = absres[:]
+    order.sort()
+    mid = len(order)/2
+    if len(order) % 2:
+        scale = order[mid]/0.6745
+    else:
+        scale = (order[mid-1] + order[mid])/(2.0*0.6745)
+    if scale <= 0.0:
+        return [1.0]*len(resid), [0.0]*len(resid)
+    if len(resid) > nparams:
+        scale = scale*math.sqrt(float(len(resid))/(len(resid)-nparams))
+    k = robust_losses[loss]
+    weights = []
+    scaled = []
+    for r in absres:
+        u = r/scale
+        if loss == 'huber':
+            w = min(1.0,k/max(u,1.0e-300))
+        elif u < k:
+            w = (1.0 - (u/k)*(u/k))**2
+        else:
+            w = 0.0
+        weights.append(w)
+        scaled.append(u)
+    return weights, scaled
+
+
+def robust_fit(model,params,x,y,options):
+
+    """Refit a curve model from least-squares parameters by iteratively reweighted least
+       squares under the loss of the options ('huber' or 'tukey'). Each pass weights the
+       data points by their current residuals (robust_weights) and solves the weighted
+       problem with the same residual and Jacobian functions as the first fit, until no
+       fitted response moves by more than the tolerance times the range of the responses
+       (a test in the units of the data, which a near-zero parameter cannot hold up) or
+       after maxiter passes. A pass that would leave too few weighted points to fix the
+       parameters, or fails or gives no ED50, ends the refit with the parameters before it.
+       Returns the parameters, the final weights, the indexes of the points whose scaled
+       residual exceeds the cutoff (the outliers), the number of weighted solves and 1 if
+       the refit was stopped by maxiter before it converged, otherwise 0"""
+
+    loss = options['loss']
+    yrange = max(max(y) - min(y),1.0e-12)
+    yfit = model.evaluate(x,params)
+    solves = 0
+    capped = 0
+    while 1:
+        resid = model_residuals(regression_params(model,params),model,x,y)
+        (weights, scaled) = robust_weights(resid,loss,len(params))
+        if solves >= options['maxiter']:
+            capped = 1
+            break
+        if len([w for w in weights if w > 0.0]) <= len(params):
+            break
+        profiler.count('robust reweighted solves')
+        rootw = Numeric.sqrt(weights)
+        try:
+            fp = scipy.optimize.minpack.leastsq(model_residuals,regression_params(model,params), \
+                                                args=(model,x,y,rootw),Dfun=model_jacobian,col_deriv=1)
+            trial = model_params(model,map(float,fp[0]))
+            for value in trial:
+                if math.isnan(value) or math.isinf(value):
+                    raise ValueError("Reweighted regression diverged")
+            if model.ed50(trial) == None:
+                raise ValueError("Reweighted regression gave no ED50")
+        except:
+            break
+        solves = solves + 1
+        tfit = model.evaluate(x,trial)
+        change = max(abs(tfit - yfit))/yrange
+        params = trial
+        yfit = tfit
+        if change < options['tol']:
+            resid = model_residuals(regression_params(model,params),model,x,y)
+            (weights, scaled) = robust_weights(resid,loss,len(params))
+            break
+    outliers = [n for n in range(len(scaled)) if scaled[n] > options['cutoff']]
+    return params, weights, outliers, solves, capped
+
+
+def dose_exponent(x,b,c):
+
+    """The logs b*ln(x/c) of the terms (x/c)**b of the logistic models over an array of doses,
+       held within +-700 as in four_param_curve, so that their exponentials neither overflow
+       nor give 0/0 far out on the curve"""
+
+    return Numeric.minimum(Numeric.maximum(b*(Numeric.log(x) - math.log(c)),-700.0),700.0)
+
+
+class CurveModel:
+
+    """A nonlinear dose-response model fitted by least squares. A model names its parameters
+       (names, with display labels), evaluates itself over a whole array of doses at once,
+       gives the analytic Jacobian of that evaluation, seeds its own starting values and
+       gives its ED50. Its fit is kept in each molecule record under key as a dictionary of
+       the parameter values, 'fit' (0 not fitted, 1 unstable regression, 2 fitted), 'yfit',
+       'metrics' and, after a robust fit, the 'weights' of the data points and the indexes
+       of the 'outliers'. Registered models (see curve_models) appear in the Data Model and
+       Graph menus, on the graph, in the fitted data table and in the exported results.
+
+       A subclass provides, with p the parameter values in the order of names and x an array
+       of doses:
+         evaluate(x,p)   the responses at the doses
+         jacobian(x,p)   an array of the derivatives of the responses with respect to each
+                         parameter in turn, one row per parameter
+         seed(console)   starting values for the console's current molecule, or None if
+                         there are none (the seeding search was cancelled)
+         ed50(p)         the dose giving the response midway between the asymptotes, or None
+                         if the parameters give no finite, positive dose
+       Parameters named in logscale must be positive and are fitted as their natural logs
+       (see regression_params), so evaluate and jacobian never see them zero or negative"""
+
+    key = ''
+    title = ''
+    label = ''
+    short = ''
+    tag = ''
+    colour = 'black'
+    names = []
+    labels = []
+    logscale = []
+    seeding = 'the initial estimates'
+
+    def empty(self):
+
+        """The record entry of a model not yet fitted"""
+
+        fit = {'fit':0, 'yfit':[], 'metrics':{}, 'weights':[], 'outliers':[]}
+        for name in self.names:
+            fit[name] = None
+        return fit
+
+    def params(self,fit):
+
+        """The parameter values of a fit, in the order of names"""
+
+        return [fit[name] for name in self.names]
+
+    def fit(self,console):
+
+        """Fit the model to the console's current molecule and redraw the graph"""
+
+        if console.curve_fit(self):
+            console.draw_graph()
+
+
+class FourParamModel(CurveModel):
+
+    """The 4-parameter model y = d + (a-d)/(1 + (x/c)**b), seeded by the console's
+       initialization search"""
+
+    key = 'four_param'
+    title = '4-Parameter'
+    label = 'Four-parameter'
+    short = '4Par'
+    tag = '4PL'
+    colour = 'dark green'
+    names = ['a', 'b', 'c', 'd']
+    labels = ['a (ymin)', 'b (slope)', 'c (ED50)', 'd (ymax)']
+    logscale = ['c']
+    seeding = '4-D initialization search'
+
+    def evaluate(self,x,p):
+        (a, b, c, d) = p
+        return d + (a-d)/(1.0 + Numeric.exp(dose_exponent(x,b,c)))
+
+    def jacobian(self,x,p):
+
+        """With s = 1/(1 + t), t = (x/c)**b: dy/da = s, dy/dd = 1-s and, with
+           w = (a-d)*s*s*t = (a-d)*s*(1-s), dy/db = -w*ln(x/c) and dy/dc = w*b/c"""
+
+        (a, b, c, d) = p
+        s = 1.0/(1.0 + Numeric.exp(dose_exponent(x,b,c)))
+        w = (a-d)*s*(1.0-s)
+        return Numeric.array([s, -w*Numeric.log(x/c), w*b/c, 1.0-s])
+
+    def seed(self,console):
+        return console.fourp_search()
+
+    def ed50(self,p):
+        return p[2]
+
+    def fit(self,console):
+
+        """Fit with the progress of the initialization search shown in a dialog"""
+
+        console.fit_fourp()
+
+
+class FiveParamModel(CurveModel):
+
+    """The asymmetric 5-parameter model y = d + (a-d)/(1 + (x/c)**b)**e, which is the
+       4-parameter model when e = 1. It starts from the molecule's 4-parameter fit, if
+       there is one, with e = 1"""
+
+    key = 'five_param'
+    title = '5-Parameter'
+    label = 'Five-parameter'
+    short = '5Par'
+    tag = '5PL'
+    colour = 'purple'
+    names = ['a', 'b', 'c', 'd', 'e']
+    labels = ['a (ymin)', 'b (slope)', 'c', 'd (ymax)', 'e (asym)']
+    logscale = ['c']
+    seeding = 'the 4-parameter model'
+
+    def evaluate(self,x,p):
+        (a, b, c, d, e) = p
+        lnu = Numeric.log(1.0 + Numeric.exp(dose_exponent(x,b,c)))
+        return d + (a-d)*Numeric.exp(Numeric.minimum(-e*lnu,700.0))
+
+    def jacobian(self,x,p):
+
+        """With t = (x/c)**b, u = 1 + t and s = u**-e: dy/da = s, dy/dd = 1-s,
+           dy/de = -(a-d)*s*ln(u) and, with w = (a-d)*e*s*t/u, dy/db = -w*ln(x/c)
+           and dy/dc = w*b/c"""
+
+        (a, b, c, d, e) = p
+        z = dose_exponent(x,b,c)
+        lnu = Numeric.log(1.0 + Numeric.exp(z))
+        s = Numeric.exp(Numeric.minimum(-e*lnu,700.0))
+        w = (a-d)*e*s/(1.0 + Numeric.exp(-z))
+        return Numeric.array([s, -w*Numeric.log(x/c), w*b/c, 1.0-s, -(a-d)*s*lnu])
+
+    def seed(self,console):
+        four_param = console.get_current('four_param')
+        if four_param['fit']:
+            return four_param_model.params(four_param) + [1.0]
+        xdata = console.get_current('xdata')
+        ydata = console.get_current('ydata')
+        edguess = console.get_current('edguess')
+        if edguess != 0.0:
+            c = 10.0**edguess
+        else:
+            c = xdata[len(xdata)/2]
+        return [ydata[0], 1.0, c, ydata[-1], 1.0]
+
+    def ed50(self,p):
+
+        """None for the e <= 0 or tiny e that unconstrained regression can leave on noisy data"""
+
+        (a, b, c, d, e) = p
+        if e <= 0.0 or c <= 0.0:
+            return None
+        try:
+            return c*(2.0**(1.0/e) - 1.0)**(1.0/b)
+        except (OverflowError, ZeroDivisionError):
+            return None
+
+
+global four_param_model, curve_models
+four_param_model = FourParamModel()
+curve_models = [four_param_model, FiveParamModel()]
+
+
+def register_model(model):
 
+    """Add a curve model to those offered for fitting. Register models before the
+       console is created, so that its menus include them"""
 
+    curve_models.append(model)
@@ -0,0 +1,321 @@
+
+"""
+Module: Abebench, end-to-end timing of the ABE data modeling pipeline
+
+Generates a synthetic plate with Abeplate and drives a headless Abe console
+through the same steps a user clicks through for every molecule: load the
+XML file, seed the ED50 estimate, fit each registered curve model (the
+4-parameter model first, then the 5-parameter model), fit the polynomial
+and export the results table, optionally followed by a global fit of the
+whole plate with some parameters shared. Each stage is timed, and the fitted
+ED50 values are compared with the true ones used to generate the data, so
+that a faster pipeline which fits the wrong ED50s fails the run.
+
+Usage:  python Abebench.py [options]
+
+Canvas drawing needs a display and is not part of the timings.
+"""
+
+import os
+import sys
+import math
+import time
+import json
+import tempfile
+import optparse
+import StringIO
+import Abe
+import Abeplate
+
+
+class HeadlessError(Exception):
+
+    """Errors that the console reported in its error dialogs"""
+
+
+class Inert:
+
+    """Stands in for the console's Tk widgets and variables: every call does nothing"""
+
+    def __getattr__(self,name):
+        return self
+
+    def __call__(self,*args,**kw):
+        return self
+
+    def __setitem__(self,key,value):
+        pass
+
+
+class HeadlessConsole(Abe.Console):
+
+    """An ABE console without a Tk window. The activity log and the text of any
+       error dialogs are kept as lists of strings and graph drawing is skipped"""
+
+    def __init__(self,graphpixels=600):
+        self.gsize = graphpixels
+        self.log = []
+        self.errors = []
+        self.status = Inert()
+        self.graph = Inert()
+        self.picker = None
+        self.fourp_defaults = Abe.default_fourp_options.copy()
+        self.fourp_options = Abe.default_fourp_options.copy()
+        self.root_options = Abe.default_root_options.copy()
+        self.robust_options = Abe.default_robust_options.copy()
+        self.workdir = os.getcwd()
+        self.helpfile = None
+        self.initialize_data()
+
+    def initialize_data(self):
+
+        """Start a new session; there is no canvas to clear"""
+
+        self.new_session()
+
+    def update_display(self,iolist,fmt='%s\n',tag='output'):
+        self.log.append(fmt % iolist)
+
+    def update_status(self,stext):
+        pass
+
+    def whoops(self,errtext):
+        self.errors.append(errtext)
+
+    def check(self):
+
+        """Raise HeadlessError if any error dialogs have been shown, and clear them"""
+
+        if self.errors:
+            errors = self.errors
+            self.errors = []
+            raise HeadlessError('\n'.join(errors))
+
+    def draw_graph(self):
+        pass
+
+    def fourp_progress(self):
+        pass
+
+
+def seed_ed50(logx,ydata):
+
+    """Estimate log10(ED50) as the point where the data first cross the middle of their
+       range, interpolating linearly in log dose; this replaces the click on the graph"""
+
+    ymid = (max(ydata) + min(ydata)) / 2.0
+    n = 1
+    while n < len(logx):
+        y0 = ydata[n-1] - ymid
+        y1 = ydata[n] - ymid
+        if y0 == 0.0:
+            return logx[n-1]
+        if y0*y1 < 0.0:
+            return logx[n-1] + (logx[n]-logx[n-1]) * y0/(y0-y1)
+        n = n + 1
+    return (logx[0] + logx[-1]) / 2.0
+
+
+def run_pipeline(console,xmlfile,polydeg,shared=None):
+
+    """Run every stage over every molecule on the plate, returning the seconds spent in each.
+       A polydeg of 'auto' chooses each molecule's degree by cross-validation; a list of
+       shared parameters adds a global 4-parameter fit of the plate after the others.
+       The polynomials of the whole plate are solved for their ED50s in one batch"""
+
+    stages = {'load':0.0, 'seed':0.0, 'poly':0.0, 'export':0.0}
+    for model in Abe.curve_models:
+        stages[model.tag] = 0.0
+    start = time.time()
+    console.read_data(xmlfile)
+    stages['load'] = time.time() - start
+    console.check()
+    for key in console.molecule_list:
+        console.select(key)
+        start = time.time()
+        edguess = seed_ed50(console.get_current('logx'),console.get_current('ydata'))
+        console.put_current('edguess',edguess)
+        four_param = console.get_current('four_param')
+        if four_param['c'] == None:
+            four_param['c'] = 10**edguess
+        stages['seed'] = stages['seed'] + time.time() - start
+        console.fourp_kill = 0
+        console.pccomplete = 0
+        for model in Abe.curve_models:
+            start = time.time()
+            console.curve_fit(model)
+            stages[model.tag] = stages[model.tag] + time.time() - start
+        start = time.time()
+        if polydeg == 'auto':
+            console.auto_degree()
+        else:
+            console.put_current('polydeg',polydeg)
+        console.poly_fit()
+        stages['poly'] = stages['poly'] + time.time() - start
+        console.check()
+    start = time.time()
+    console.find_roots(console.molecule_list,Abe.default_precision)
+    stages['poly'] = stages['poly'] + time.time() - start
+    console.check()
+    if shared:
+        start = time.time()
+        console.fit_global(console.molecule_list,shared)
+        stages['global'] = time.time() - start
+        console.check()
+    start = time.time()
+    console.write_results(StringIO.StringIO())
+    stages['export'] = time.time() - start
+    return stages
+
+
+def ed50_errors(console,truth):
+
+    """Errors in log10(ED50) of the curve models, the polynomial and any global fit against
+       the true values, leaving out the fits that gave no ED50"""
+
+    errors = {'poly':[]}
+    for model in Abe.curve_models:
+        errors[model.tag] = []
+    if console.index[console.molecule_list[0]]['global'] != None:
+        errors['global'] = []
+    for (bioassay, mol) in console.molecule_list:
+        record = console.index[(bioassay,mol)]
+        true_ed50 = math.log10(truth[mol]['c'])
+        for model in Abe.curve_models:
+            ed50 = model.ed50(model.params(record[model.key]))
+            if ed50 != None:
+                errors[model.tag].append(math.log10(ed50) - true_ed50)
+        if record['edfit'] != 0.0:
+            errors['poly'].append(record['edfit'] - true_ed50)
+        if errors.has_key('global'):
+            errors['global'].append(math.log10(record['global']['c']) - true_ed50)
+    return errors
+
+
+def outlier_counts(console,model,truth):
+
+    """The numbers of true outliers that a model's robust fits flagged and of other points
+       that they flagged wrongly. The plate is written in dose order, so the points of a
+       plate without replicates and the wells of one with them are numbered as written"""
+
+    found = wrong = 0
+    for (bioassay, mol) in console.molecule_list:
+        bad = truth[mol]['outliers']
+        for n in console.index[(bioassay,mol)][model.key]['outliers']:
+            if n in bad:
+                found = found + 1
+            else:
+                wrong = wrong + 1
+    return found, wrong
+
+
+def main(argv=None):
+
+    """Benchmark the pipeline on a synthetic plate and check the fitted ED50 values"""
+
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-m','--molecules',type='int',default=8,help='number of molecules on the plate')
+    parser.add_option('-p','--points',type='int',default=12,help='doses per dilution series')
+    parser.add_option('-n','--noise',type='float',default=0.02,help='noise SD as a fraction of |d-a|')
+    parser.add_option('-a',type='float',default=5.0,help='true a (ymin)')
+    parser.add_option('-b',type='float',default=1.0,help='true b (slope)')
+    parser.add_option('-c',type='float',default=1.0,help='true c (ED50) at the centre of the doses')
+    parser.add_option('-d',type='float',default=100.0,help='true d (ymax)')
+    parser.add_option('--seed',type='int',default=1,help='random seed for the plate')
+    parser.add_option('--outliers',type='int',default=0,help='outlying points per molecule on the plate')
+    parser.add_option('-r','--replicates',type='int',default=1,help='replicate wells per dose on the plate')
+    parser.add_option('--robust',default='none',choices=['none','huber','tukey'], \
+                      help="fit the curve models robustly with the 'huber' or 'tukey' loss")
+    parser.add_option('--degree',default='5', \
+                      help="degree of the fitted polynomial, or 'auto' to choose it by cross-validation")
+    parser.add_option('--shared',default=None, \
+                      help="also fit the plate globally with these parameters shared, e.g. 'a,b,d'")
+    parser.add_option('--tolerance',type='float',default=0.1, \
+                      help='largest acceptable error in log10(ED50) for the curve model fits')
+    parser.add_option('--poly-tolerance',type='float',default=0.25, \
+                      help='largest acceptable error in log10(ED50) for the polynomial fit')
+    parser.add_option('-o','--output',default=None,help='write the results as JSON to this file')
+    parser.add_option('--profile',action='store_true',default=False, \
+                      help="report the console's profiling timers and counters")
+    opts, args = parser.parse_args(argv)
+    if opts.degree != 'auto':
+        try:
+            opts.degree = int(opts.degree)
+        except ValueError:
+            parser.error("--degree must be a number or 'auto'")
+    if opts.shared:
+        opts.shared = opts.shared.split(',')
+        if len(opts.shared) > 3 or [p for p in opts.shared if not p in ('a','b','c','d')]:
+            parser.error("--shared must list one to three of a, b, c and d")
+    Abe.profiler.reset()
+    Abe.profiler.on = opts.profile
+    fd, xmlfile = tempfile.mkstemp(suffix='.xml')
+    os.close(fd)
+    try:
+        start = time.time()
+        truth = Abeplate.write_plate(xmlfile,molecules=opts.molecules,points=opts.points, \
+                    noise=opts.noise,a=opts.a,b=opts.b,c=opts.c,d=opts.d,seed=opts.seed, \
+                    outliers=opts.outliers,replicates=opts.replicates)
+        generate = time.time() - start
+        console = HeadlessConsole()
+        console.robust_options['loss'] = opts.robust
+        stages = run_pipeline(console,xmlfile,opts.degree,opts.shared)
+    finally:
+        os.remove(xmlfile)
+    errors = ed50_errors(console,truth)
+    nmol = len(console.molecule_list)
+    print "Plate: %d molecules x %d points x %d replicates, noise %.3f, %d outliers each (generated in %.3fs)" % \
+          (nmol,opts.points,opts.replicates,opts.noise,opts.outliers,generate)
+    total = 0.0
+    for stage in ['load','seed'] + [model.tag for model in Abe.curve_models] + ['poly','global','export']:
+        if not stages.has_key(stage):
+            continue
+        total = total + stages[stage]
+        print "%-8s %10.4fs %10.3f ms/molecule" % (stage,stages[stage],1000.0*stages[stage]/nmol)
+    print "%-8s %10.4fs %10.1f molecules/s" % ('total',total,nmol/total)
+    failed = 0
+    limits = [(model.tag,opts.tolerance) for model in Abe.curve_models]
+    for model, limit in limits + [('poly',opts.poly_tolerance),('global',opts.tolerance)]:
+        if not errors.has_key(model):
+            continue
+        if len(errors[model]) < nmol:
+            print "%-8s no ED50 for %d of %d molecules" % (model,nmol-len(errors[model]),nmol)
+        if len(errors[model]) == 0:
+            continue
+        worst = max(map(abs,errors[model]))
+        mean = sum(map(abs,errors[model])) / len(errors[model])
+        print "%-8s ED50 error in log10 units: mean %.4f, max %.4f (limit %.4f)" % (model,mean,worst,limit)
+        if worst > limit:
+            failed = 1
+    fitted = {}
+    for model in Abe.curve_models:
+        fitted[model.tag] = len([key for key in console.molecule_list if console.index[key][model.key]['fit'] == 2])
+        print "%s regressions converged: %d of %d" % (model.tag,fitted[model.tag],nmol)
+    if opts.robust != 'none':
+        for model in Abe.curve_models:
+            (found, wrong) = outlier_counts(console,model,truth)
+            print "%s outliers flagged: %d of %d true, %d false (%s loss)" % \
+                  (model.tag,found,nmol*opts.outliers,wrong,opts.robust)
+    if opts.shared:
+        record = console.index[console.molecule_list[0]]
+        print "Global fit sharing %s converged: %s" % (','.join(opts.shared),record['global']['fit'] and 'yes' or 'no')
+    if opts.profile:
+        print "\nProfile timers and counters:"
+        for line in Abe.profiler.report():
+            print line
+    if opts.output:
+        results = {'molecules':nmol, 'points':opts.points, 'noise':opts.noise, 'degree':opts.degree, 'shared':opts.shared, \
+                   'replicates':opts.replicates, 'outliers':opts.outliers, 'robust':opts.robust, \
+                   'seconds':stages, 'ed50_log10_errors':errors, 'converged':fitted}
+        if opts.profile:
+            results['profile'] = {'timers':Abe.profiler.timers, 'calls':Abe.profiler.calls, \
+                                  'counters':Abe.profiler.counters}
+        json.dump(results,open(opts.output,'w'),indent=1,sort_keys=True)
+    if failed:
+        print >> sys.stderr, "FAILED: fitted ED50 values are outside the accepted tolerance"
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
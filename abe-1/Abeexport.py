@@ -0,0 +1,332 @@
+
+"""
+Module: Abeexport, streaming writers for the ABE results table
+
+Every fitted model of every molecule is one row of a fixed schema:
+
+    bioassay      the bioassay id
+    molecule      the molecule id
+    model         the tag of a registered curve model (Abe.curve_models), '4PL' or
+                  '5PL', for its nonlinear regression, the tag followed by ' search'
+                  where the regression was unstable and the parameters are its
+                  starting values, '4PL global' (the global fit with shared
+                  parameters) or 'poly' (the fitted polynomial)
+    a b c d e     the 4-parameter model y = d + (a-d)/(1 + (x/c)**b) or the
+                  5-parameter model y = d + (a-d)/(1 + (x/c)**b)**e; e is missing
+                  for the 4-parameter models and all are missing for 'poly'
+    ED50          the ED50 of the model
+    residual      the residual sum of squares (SSE) of the model
+    RMSE          the root mean square residual, sqrt(SSE/n)
+    R2            the coefficient of determination
+    AIC BIC       the least-squares information criteria n*ln(SSE/n) + 2k and
+                  n*ln(SSE/n) + k*ln(n) for n points and k parameters
+    coefficients  the polynomial coefficients in log10(dose), constant term first;
+                  empty for the curve models
+    outliers      the data points (numbered from 1) flagged as outliers by a
+                  robust fit of a curve model, or on a plate with replicates the
+                  wells of the data file; empty otherwise
+
+Rows are written as they are produced and only one row group of the binary
+format is ever held in memory, so the size of the plate does not matter.
+
+Two formats are written:
+
+    text      delimited text with a header row of the column names (tab or comma
+              delimited). Missing values are empty fields and the coefficients are
+              one field of space separated numbers.
+
+    columnar  a compact binary column store, little-endian throughout:
+
+                  'ABEC'                       magic
+                  uint32 n, n bytes            JSON header {"version":1, "columns":[[name,type],...]}
+                  row groups, each:
+                      uint32 nrows             0 marks the end of the file
+                      every column in order:
+                          'string'  one character, then either
+                                    'P': nrows x uint32 byte lengths and the UTF-8 bytes
+                                    'B', 'H' or 'I': a dictionary of the distinct
+                                    strings (uint32 count, uint32 byte lengths, UTF-8
+                                    bytes) and nrows indexes into it as uint8, uint16
+                                    or uint32 respectively
+                          'float'   a bitmap of the rows that have a value, least
+                                    significant bit first, then the float64 values
+                          'floats'  nrows x uint16 counts, then the float64 values
+
+              Repeated strings (bioassays, models) cost one index each and missing
+              values cost one bit, so a file is a fraction of the size of the text
+              at full precision. read_columnar reads it back.
+
+Usage:  python Abeexport.py results.abec    (prints a columnar file as text)
+"""
+
+import sys
+import csv
+import json
+import struct
+
+
+global columns
+columns = [('bioassay','string'), ('molecule','string'), ('model','string'), \
+           ('a','float'), ('b','float'), ('c','float'), ('d','float'), ('e','float'), ('ED50','float'), \
+           ('residual','float'), ('RMSE','float'), ('R2','float'), ('AIC','float'), ('BIC','float'), \
+           ('coefficients','floats'), ('outliers','floats')]
+
+magic = 'ABEC'
+group_rows = 4096
+
+
+def text_field(value):
+
+    """The delimited text form of one value of a row"""
+
+    if value == None:
+        return ''
+    if isinstance(value,float):
+        return '%.10g' % value
+    if isinstance(value,unicode):
+        return value.encode('utf-8')
+    if isinstance(value,list) or isinstance(value,tuple):
+        return ' '.join(['%.10g' % v for v in value])
+    return str(value)
+
+
+def pack_strings(values):
+
+    """The columnar encoding of a row group's strings: a dictionary of the distinct
+       strings and an index for each row, unless every string is different"""
+
+    codes = {}
+    distinct = []
+    for value in values:
+        if not codes.has_key(value):
+            codes[value] = len(distinct)
+            distinct.append(value)
+    if len(distinct) == len(values):
+        return ['P', struct.pack('<%dI' % len(values),*map(len,values)), ''.join(values)]
+    if len(distinct) <= 0x100:
+        width = 'B'
+    elif len(distinct) <= 0x10000:
+        width = 'H'
+    else:
+        width = 'I'
+    return [width, struct.pack('<I',len(distinct)), struct.pack('<%dI' % len(distinct),*map(len,distinct)), \
+            ''.join(distinct), struct.pack('<%d%s' % (len(values),width),*[codes[v] for v in values])]
+
+
+def pack_floats(values):
+
+    """The columnar encoding of a row group's numbers: a bitmap of the rows that have
+       a value and the values themselves"""
+
+    bits = [0] * ((len(values)+7)/8)
+    present = []
+    n = 0
+    while n < len(values):
+        if values[n] != None:
+            bits[n/8] = bits[n/8] | (1 << (n%8))
+            present.append(values[n])
+        n = n + 1
+    return [struct.pack('<%dB' % len(bits),*bits), struct.pack('<%dd' % len(present),*present)]
+
+
+class TextWriter:
+
+    """Writes rows as delimited text with a header row"""
+
+    def __init__(self,outfile,delimiter='\t'):
+        self.writer = csv.writer(outfile,delimiter=delimiter,lineterminator='\n')
+        self.writer.writerow([name for (name, kind) in columns])
+
+    def write(self,row):
+        self.writer.writerow([text_field(value) for value in row])
+
+    def close(self):
+        pass
+
+
+class ColumnarWriter:
+
+    """Writes rows in the binary columnar format, one row group at a time"""
+
+    def __init__(self,outfile,rows=group_rows):
+        self.outfile = outfile
+        self.rows = rows
+        self.group = []
+        header = json.dumps({'version':1, 'columns':columns})
+        outfile.write(magic + struct.pack('<I',len(header)) + header)
+
+    def write(self,row):
+        self.group.append(row)
+        if len(self.group) >= self.rows:
+            self.flush()
+
+    def flush(self):
+
+        """Write the buffered rows as a row group"""
+
+        nrows = len(self.group)
+        if nrows == 0:
+            return
+        chunks = [struct.pack('<I',nrows)]
+        n = 0
+        while n < len(columns):
+            kind = columns[n][1]
+            values = [row[n] for row in self.group]
+            if kind == 'string':
+                chunks.extend(pack_strings([text_field(v) for v in values]))
+            elif kind == 'float':
+                chunks.extend(pack_floats(values))
+            else:
+                values = [v or [] for v in values]
+                flat = [x for v in values for x in v]
+                chunks.append(struct.pack('<%dH' % nrows,*map(len,values)))
+                chunks.append(struct.pack('<%dd' % len(flat),*flat))
+            n = n + 1
+        self.outfile.write(''.join(chunks))
+        self.group = []
+
+    def close(self):
+        self.flush()
+        self.outfile.write(struct.pack('<I',0))
+
+
+global formats
+formats = {'text':lambda outfile: TextWriter(outfile,'\t'), \
+           'csv':lambda outfile: TextWriter(outfile,','), \
+           'columnar':ColumnarWriter}
+
+global extensions
+extensions = {'.txt':'text', '.tsv':'text', '.csv':'csv', '.abec':'columnar'}
+
+
+def format_for(filename):
+
+    """The export format for a file name, from its extension (tab delimited text if unknown)"""
+
+    dot = filename.rfind('.')
+    if dot < 0:
+        return 'text'
+    return extensions.get(filename[dot:].lower(),'text')
+
+
+def write(rows,outfile,format='text'):
+
+    """Write the rows from an iterable to an open file in the named format (binary mode
+       for 'columnar') and return the number of rows written"""
+
+    writer = formats[format](outfile)
+    count = 0
+    for row in rows:
+        writer.write(row)
+        count = count + 1
+    writer.close()
+    return count
+
+
+def read_exactly(infile,nbytes):
+
+    """Read nbytes from a columnar file, failing on a truncated file"""
+
+    data = infile.read(nbytes)
+    if len(data) != nbytes:
+        raise ValueError("Truncated ABE columnar file")
+    return data
+
+
+def read_plain(infile,count):
+
+    """Read count strings stored as their byte lengths followed by their bytes"""
+
+    sizes = struct.unpack('<%dI' % count,read_exactly(infile,4*count))
+    data = read_exactly(infile,sum(sizes))
+    values = []
+    start = 0
+    for size in sizes:
+        values.append(data[start:start+size].decode('utf-8'))
+        start = start + size
+    return values
+
+
+def read_strings(infile,count):
+
+    """Read a string column of a row group"""
+
+    width = read_exactly(infile,1)
+    if width == 'P':
+        return read_plain(infile,count)
+    (size,) = struct.unpack('<I',read_exactly(infile,4))
+    distinct = read_plain(infile,size)
+    nbytes = struct.calcsize('<' + width)
+    codes = struct.unpack('<%d%s' % (count,width),read_exactly(infile,nbytes*count))
+    return [distinct[code] for code in codes]
+
+
+def read_floats(infile,count):
+
+    """Read a number column of a row group, with None for the missing values"""
+
+    bits = struct.unpack('<%dB' % ((count+7)/8),read_exactly(infile,(count+7)/8))
+    present = 0
+    for byte in bits:
+        while byte:
+            present = present + (byte & 1)
+            byte = byte >> 1
+    values = list(struct.unpack('<%dd' % present,read_exactly(infile,8*present)))
+    values.reverse()
+    column = []
+    n = 0
+    while n < count:
+        if bits[n/8] & (1 << (n%8)):
+            column.append(values.pop())
+        else:
+            column.append(None)
+        n = n + 1
+    return column
+
+
+def read_columnar(infile):
+
+    """Yield the rows of a columnar file as tuples in the order of the header's columns"""
+
+    if infile.read(4) != magic:
+        raise ValueError("Not an ABE columnar file")
+    (size,) = struct.unpack('<I',read_exactly(infile,4))
+    schema = json.loads(read_exactly(infile,size))['columns']
+    while 1:
+        (nrows,) = struct.unpack('<I',read_exactly(infile,4))
+        if nrows == 0:
+            return
+        group = []
+        for (name, kind) in schema:
+            if kind == 'string':
+                group.append(read_strings(infile,nrows))
+            elif kind == 'float':
+                group.append(read_floats(infile,nrows))
+            else:
+                sizes = struct.unpack('<%dH' % nrows,read_exactly(infile,2*nrows))
+                flat = struct.unpack('<%dd' % sum(sizes),read_exactly(infile,8*sum(sizes)))
+                values = []
+                start = 0
+                for size in sizes:
+                    values.append(list(flat[start:start+size]))
+                    start = start + size
+                group.append(values)
+        for row in zip(*group):
+            yield row
+
+
+def main(argv=None):
+
+    """Print a columnar results file as tab delimited text"""
+
+    if argv == None:
+        argv = sys.argv[1:]
+    if len(argv) != 1:
+        print >> sys.stderr, "Usage: python Abeexport.py results.abec"
+        return 2
+    write(read_columnar(open(argv[0],'rb')),sys.stdout,'text')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
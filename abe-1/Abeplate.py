@@ -0,0 +1,124 @@
+
+"""
+Module: Abeplate, synthetic bioassay plates for testing and benchmarking ABE
+
+Writes bioassay data files in the XML format read by Abe.Console.read_data:
+
+    <bioassay id="synthetic" columns="dose response err" x="dose" y="response" err="err">
+    <molecule id="M001">
+    <data> 0.01 5.213 1.9 </data>
+    ...
+    </molecule>
+    </bioassay>
+
+Each molecule is a serial dilution series whose responses follow the same
+four-parameter model that ABE fits, y = d + (a-d)/(1 + (x/c)**b), plus
+Gaussian noise, and optionally a few gross outliers (bad wells) per molecule.
+The true parameters for every molecule, and the outlying points, are returned
+with the data so that fitted ED50 values can be checked against them.
+
+Usage:  python Abeplate.py [options] plate.xml
+"""
+
+import random
+import sys
+import optparse
+
+
+def four_param_y(x,a,b,c,d):
+
+    """The four-parameter dose-response model fitted by ABE"""
+
+    return d + ( (a-d)/(1 + (x/c)**b) )
+
+
+def make_plate(molecules=8,points=12,noise=0.02,a=5.0,b=1.0,c=1.0,d=100.0,spread=1.0, \
+               dilution=3.0,seed=None,bioassay='synthetic',outliers=0,outlier_size=0.3,replicates=1):
+
+    """Return the XML text of a synthetic plate and a dictionary of the true 4-parameter
+       values {'a','b','c','d'} for each molecule id. The doses are a dilution series of
+       the given number of points centred on c; each molecule's ED50 is c shifted by a
+       random amount of up to spread/2 decades either way. The noise standard deviation
+       is the fraction noise of the response range |d-a| and is written as the err column.
+       Every dose is measured in the given number of replicate wells, each with its own
+       noise. Each molecule then has outliers of its wells, chosen at random, moved up or
+       down by the fraction outlier_size of |d-a|; their indexes in the order written
+       are listed in the true values as 'outliers'"""
+
+    rnd = random.Random(seed)
+    sd = noise * abs(d-a)
+    doses = []
+    for k in range(points):
+        doses.append(c * dilution**(k - (points-1)/2.0))
+    lines = ['<?xml version="1.0"?>', \
+             '<bioassay id="%s" columns="dose response err" x="dose" y="response" err="err">' % bioassay]
+    truth = {}
+    for m in range(molecules):
+        mol = "M%03d" % (m+1)
+        cm = c * 10.0**rnd.uniform(-spread/2.0,spread/2.0)
+        xs = []
+        ys = []
+        for x in doses:
+            for r in range(replicates):
+                xs.append(x)
+                ys.append(four_param_y(x,a,b,cm,d) + rnd.gauss(0.0,sd))
+        bad = []
+        if outliers:
+            bad = rnd.sample(range(len(xs)),outliers)
+            bad.sort()
+            for k in bad:
+                ys[k] = ys[k] + rnd.choice((-1.0,1.0)) * outlier_size * abs(d-a)
+        truth[mol] = {'a':a, 'b':b, 'c':cm, 'd':d, 'outliers':bad}
+        lines.append('<molecule id="%s">' % mol)
+        for k in range(len(xs)):
+            lines.append('<data> %.8g %.6f %.6f </data>' % (xs[k],ys[k],sd))
+        lines.append('</molecule>')
+    lines.append('</bioassay>')
+    return '\n'.join(lines) + '\n', truth
+
+
+def write_plate(xmlfile,**options):
+
+    """Write a synthetic plate to the named file and return the true parameters"""
+
+    xml, truth = make_plate(**options)
+    out = open(xmlfile,'w')
+    out.write(xml)
+    out.close()
+    return truth
+
+
+def main(argv=None):
+
+    """Write a plate from the command line options and list the true ED50 values"""
+
+    parser = optparse.OptionParser(usage='%prog [options] plate.xml')
+    parser.add_option('-m','--molecules',type='int',default=8,help='number of molecules on the plate')
+    parser.add_option('-p','--points',type='int',default=12,help='doses per dilution series')
+    parser.add_option('-n','--noise',type='float',default=0.02,help='noise SD as a fraction of |d-a|')
+    parser.add_option('-a',type='float',default=5.0,help='true a (ymin)')
+    parser.add_option('-b',type='float',default=1.0,help='true b (slope)')
+    parser.add_option('-c',type='float',default=1.0,help='true c (ED50) at the centre of the doses')
+    parser.add_option('-d',type='float',default=100.0,help='true d (ymax)')
+    parser.add_option('--spread',type='float',default=1.0,help='decades of ED50 variation between molecules')
+    parser.add_option('--dilution',type='float',default=3.0,help='dilution factor between doses')
+    parser.add_option('--seed',type='int',default=None,help='random seed')
+    parser.add_option('--outliers',type='int',default=0,help='outlying points per molecule')
+    parser.add_option('-r','--replicates',type='int',default=1,help='replicate wells per dose')
+    parser.add_option('--outlier-size',type='float',default=0.3,help='outlier displacement as a fraction of |d-a|')
+    opts, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('a single output file is required')
+    truth = write_plate(args[0],molecules=opts.molecules,points=opts.points,noise=opts.noise, \
+                        a=opts.a,b=opts.b,c=opts.c,d=opts.d,spread=opts.spread, \
+                        dilution=opts.dilution,seed=opts.seed,outliers=opts.outliers, \
+                        outlier_size=opts.outlier_size,replicates=opts.replicates)
+    mols = truth.keys()
+    mols.sort()
+    for mol in mols:
+        print "%s  c(ED50) = %12.6f" % (mol,truth[mol]['c'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
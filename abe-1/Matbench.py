@@ -0,0 +1,252 @@
+'''Benchmark and regression suite for the Matfunc kernels
+
+   Times mmul, qr, solve, inverse, lu, eigs, hessenberg, polyfit and Table.map at several sizes on
+   seeded hilb/rand inputs, and records the median time of n runs, peak memory and residual accuracy
+   for each.  Results are written as JSON; when a baseline file is present every result is compared
+   against it and any slowdown, memory growth or loss of accuracy beyond the allowed slack is
+   reported as a regression and the run exits with status 1.  Each repeat also times a fixed
+   calibration loop, and times are compared after scaling the baseline by the ratio of the two
+   runs' calibration times for that kernel, which takes out how busy the machine was; a kernel that
+   still looks slower is timed again, and only a slowdown that repeats is a regression.
+
+   Usage:  python Matbench.py [-r repeats] [-o results.json] [-b baseline.json] [--save-baseline]
+
+   The stored baseline was recorded on one machine; timings are only comparable on the same
+   hardware, so record a fresh one with --save-baseline before using the suite elsewhere.'''
+
+import sys, os, time, random, json, optparse
+import Matfunc
+from Matfunc import Vec, Mat, Square, hilb, rand, eye, polyfit
+
+TIMESLACK, MEMSLACK, ERRSLACK = 1.5, 1.5, 10.0   # Allowed ratios to the baseline before failing
+TIMEFLOOR, MEMFLOOR, ERRFLOOR = .005, 1024, 1e-12  # Differences below these (s, KB, abs) are noise
+
+def maxabs( t ):
+    'Largest absolute element of a Vec or Matrix'
+    return max( map(abs, t.flatten()) )
+
+def randvec( n ):
+    return Vec( [random.random() for i in range(n)] )
+
+def symmetric( n ):
+    'Random symmetric matrix, so that eigs has real eigenvalues to find'
+    A = rand(n)
+    return Mat( A + A.tr(), Square )
+
+# Each kernel is (name, sizes, setup, run, residual):  setup(n) builds the inputs from a seeded
+# generator, run(*inputs) is the timed call and residual(inputs, result) measures its accuracy
+
+def _qrres( (A,), (Q, R) ):
+    return max( maxabs(Q.mmul(R) - A), maxabs(Q.tr().mmul(Q) - eye(A.cols)) )
+
+def _eigres( (A,), lam ):
+    'Eigenvalues must reproduce the trace and the Frobenius norm (sum of squares) of a symmetric A'
+    frob = sum( [e*e for e in A.flatten()] )
+    return max( abs(lam.sum() - A.trace()), abs(lam.dot(lam) - frob) / frob )
+
+def _hessres( (A,), (H, Q) ):
+    below = [abs(H[i][j]) for i in range(2, H.rows) for j in range(i-1)]
+    return max( [maxabs(Q.mmul(H).mmul(Q.tr()) - A)] + below )
+
+def _polysetup( n ):
+    x = Vec( [i / (n - 1.0) for i in range(n)] )
+    return (x, Vec([Vec([4, -3, 2, 1]).polyval(e) for e in x]))
+
+KERNELS = [
+    ('mmul',  (20, 40, 80),
+        lambda n: (rand(n), rand(n)),
+        lambda A, B: A.mmul(B),
+        lambda (A, B), C: maxabs( C.mmul(Vec([1.0]*B.cols)) - A.mmul(B.mmul(Vec([1.0]*B.cols))) )),
+    ('qr',  (10, 20, 40),
+        lambda n: (rand(n),),
+        lambda A: A.qr(),
+        _qrres),
+    ('solve',  (10, 20, 40),
+        lambda n: (rand(n), randvec(n)),
+        lambda A, b: A.solve(b),
+        lambda (A, b), x: maxabs( A.mmul(x) - b )),
+    ('solve_hilb',  (4, 6, 8),
+        lambda n: (hilb(n), hilb(n).mmul(Vec([1.0]*n))),
+        lambda A, b: A.solve(b),
+        lambda (A, b), x: maxabs( x - 1.0 )),                    # Forward error, true x is all ones
+    ('inverse',  (10, 20, 40),
+        lambda n: (rand(n),),
+        lambda A: A.inverse(),
+        lambda (A,), Ainv: maxabs( A.mmul(Ainv) - eye(A.rows) )),
+    ('lu',  (10, 20, 40),
+        lambda n: (rand(n),),
+        lambda A: A.lu(),
+        lambda (A,), (L, U): maxabs( L.mmul(U) - A )),
+    ('eigs',  (4, 8, 16),
+        lambda n: (symmetric(n),),
+        lambda A: A.eigs(),
+        _eigres),
+    ('hessenberg',  (10, 20, 40),
+        lambda n: (rand(n),),
+        lambda A: A.hessenberg(WithQ=1),
+        _hessres),
+    ('polyfit',  (10, 40, 160),
+        _polysetup,
+        lambda x, y: polyfit((x, y), degree=3),
+        lambda xy, p: maxabs( p - Vec([4, -3, 2, 1]) )),
+    ('map',  (1000, 10000, 100000),
+        lambda n: (randvec(n), randvec(n)),
+        lambda a, b: a*2.0 + b,
+        lambda (a, b), c: max( [abs(c[i] - (a[i]*2.0 + b[i])) for i in range(len(a))] )),
+    ]
+
+def _peakkb():
+    'Peak resident set of this process in KB, or None where the resource module is unavailable'
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    if sys.platform == 'darwin': peak = peak // 1024        # Reported in bytes rather than KB
+    return peak
+
+def median( values ):
+    values = sorted( values )
+    mid = len(values) // 2
+    if len(values) % 2: return values[mid]
+    return (values[mid-1] + values[mid]) / 2.0
+
+def calibrate():
+    'Time of a fixed pure Python loop, the yardstick for how fast the machine is running just now'
+    start = time.time()
+    total = 0.0
+    for k in xrange(50000): total += k * 0.5
+    return time.time() - start
+
+def measure( (name, sizes, setup, run, residual), n, repeats ):
+    '''Median time over the repeats, the median calibration time taken alongside them, peak memory
+    growth and residual for one kernel at one size'''
+    before = _peakkb()
+    times, yardstick = [], []
+    for i in range(repeats):
+        random.seed( n )
+        inputs = setup( n )               # Fresh inputs each time so that the qr cache never hits
+        yardstick.append( calibrate() )
+        start = time.time()
+        result = run( *inputs )
+        times.append( time.time() - start )
+    after = _peakkb()
+    if before is not None: after = after - before
+    return {'kernel': name, 'n': n, 'seconds': median( times ), 'calibration': median( yardstick ),
+            'peak_kb': after, 'residual': float( residual(inputs, result) )}
+
+def isolated( kernel, n, repeats ):
+    '''Run measure in a forked child so that the peak memory figure belongs to this kernel alone
+    rather than to the largest kernel run so far.  Falls back to running in-process without fork'''
+    if not hasattr(os, 'fork'): return measure( kernel, n, repeats )
+    rd, wr = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close( rd )
+        try:
+            out = json.dumps( measure(kernel, n, repeats) )
+        except Exception, e:
+            out = json.dumps( {'kernel': kernel[0], 'n': n, 'error': '%s: %s' % (e.__class__.__name__, e)} )
+        os.write( wr, out )
+        os._exit( 0 )
+    os.close( wr )
+    chunks = []
+    while 1:
+        chunk = os.read( rd, 65536 )
+        if not chunk: break
+        chunks.append( chunk )
+    os.close( rd )
+    os.waitpid( pid, 0 )
+    return json.loads( ''.join(chunks) )
+
+def runall( repeats=7, kernels=KERNELS, log=sys.stdout ):
+    'Measure every kernel at every size and return the results document'
+    results = []
+    for kernel in kernels:
+        for n in kernel[1]:
+            r = isolated( kernel, n, repeats )
+            results.append( r )
+            if 'error' in r:
+                print >> log, '%-12s %7d   ERROR %s' % (r['kernel'], n, r['error'])
+            else:
+                print >> log, '%-12s %7d %10.5fs %8s KB   residual %.3g' % (r['kernel'], n,
+                    r['seconds'], r['peak_kb'] is None and '-' or r['peak_kb'], r['residual'])
+    return {'matfunc': Matfunc.Version, 'python': sys.version.split()[0], 'platform': sys.platform,
+            'repeats': repeats, 'results': results}
+
+def compare( results, baseline ):
+    '''List of (kernel, n, message) for results that are slower, larger or less accurate than baseline.
+    Baseline times are scaled by the ratio of the two runs' calibration times where both have one'''
+    old = dict( [((r['kernel'], r['n']), r) for r in baseline['results']] )
+    problems = []
+    for r in results['results']:
+        key = (r['kernel'], r['n'])
+        label = '%s n=%d' % key
+        if 'error' in r:
+            problems.append( key + ('%s failed: %s' % (label, r['error']),) )
+            continue
+        if key not in old or 'error' in old[key]: continue
+        b = old[key]
+        bsec = b['seconds']
+        if r.get('calibration') and b.get('calibration'):
+            bsec = bsec * r['calibration'] / b['calibration']
+        if r['seconds'] > bsec * TIMESLACK and r['seconds'] - bsec > TIMEFLOOR:
+            problems.append( key + ('%s time %.5fs vs baseline %.5fs' % (label, r['seconds'], bsec),) )
+        if r['peak_kb'] is not None and b['peak_kb'] is not None and \
+           r['peak_kb'] > b['peak_kb'] * MEMSLACK and r['peak_kb'] - b['peak_kb'] > MEMFLOOR:
+            problems.append( key + ('%s peak memory %d KB vs baseline %d KB' % (label, r['peak_kb'], b['peak_kb']),) )
+        if not r['residual'] <= max( b['residual'] * ERRSLACK, ERRFLOOR ):
+            problems.append( key + ('%s residual %.3g vs baseline %.3g' % (label, r['residual'], b['residual']),) )
+    return problems
+
+def recheck( results, problems ):
+    '''Time the kernels named in problems again and keep the run with the lower time relative to
+    its calibration, so that a slowdown only stands if it repeats'''
+    kernels = dict( [(k[0], k) for k in KERNELS] )
+    flagged = dict( [((name, n), 1) for name, n, message in problems] )
+    for r in results['results']:
+        key = (r['kernel'], r['n'])
+        if key in flagged and 'error' not in r:
+            again = isolated( kernels[key[0]], key[1], results['repeats'] )
+            if 'error' in again: continue
+            if again['seconds'] / again['calibration'] < r['seconds'] / r['calibration']:
+                r['seconds'], r['calibration'] = again['seconds'], again['calibration']
+
+def main( argv=None ):
+    here = os.path.dirname( os.path.abspath(__file__) )
+    parser = optparse.OptionParser( usage='%prog [options]' )
+    parser.add_option( '-r', '--repeats', type='int', default=7, help='timed runs per case, the median is kept' )
+    parser.add_option( '-o', '--output', default=os.path.join(here, 'Matbench_results.json'),
+                       help='where to write the results' )
+    parser.add_option( '-b', '--baseline', default=os.path.join(here, 'Matbench_baseline.json'),
+                       help='baseline to compare against' )
+    parser.add_option( '--save-baseline', action='store_true', default=False,
+                       help='store these results as the new baseline instead of comparing' )
+    parser.add_option( '--checks', action='store_true', default=False,
+                       help="time with Matfunc's pre and post condition asserts enabled" )
+    opts, args = parser.parse_args( argv )
+    Matfunc.NPRE = Matfunc.NPOST = opts.checks and 0 or 1
+    results = runall( opts.repeats )
+    json.dump( results, open(opts.output, 'w'), indent=1, sort_keys=True )
+    if opts.save_baseline:
+        json.dump( results, open(opts.baseline, 'w'), indent=1, sort_keys=True )
+        print 'Baseline saved to', opts.baseline
+        return 0
+    if not os.path.exists( opts.baseline ):
+        print 'No baseline at %s; run with --save-baseline to record one' % opts.baseline
+        return 0
+    baseline = json.load( open(opts.baseline) )
+    problems = compare( results, baseline )
+    if problems:
+        recheck( results, problems )
+        json.dump( results, open(opts.output, 'w'), indent=1, sort_keys=True )
+        problems = compare( results, baseline )
+    for name, n, p in problems:  print >> sys.stderr, 'REGRESSION:', p
+    if problems:
+        print >> sys.stderr, '%d regression(s) against %s' % (len(problems), opts.baseline)
+        return 1
+    print 'No regressions against', opts.baseline
+    return 0
+
+if __name__ == '__main__':
+    sys.exit( main() )
@@ -4,8 +4,11 @@
    Revision In Use:  'File %n, Ver %v, Date %f'                             '''
 Version = 'File MATFUNC.PY, Ver 182, Date 3-Mar-2002,6:30:14'
 
-import operator, math, random
+import operator, math, random, itertools
 NPRE, NPOST = 0, 0                    # Disables pre and post condition checks
+LAZY = 0                              # Defers Table arithmetic into fused expressions
+LAZYDEPTH = 32                        # Deepest deferred expression before it is forced, see Lazy
+ABSTOL, RELTOL = .000001, 0.0         # Default tolerances for Table equality, see Table.isclose
 
 def iszero(z):  return abs(z) < .000001
 def getreal(z):
@@ -41,6 +44,8 @@ class Table(list):
         '''Apply a unary operator to every element in the matrix or a binary operator to corresponding
         elements in two arrays.  If the dimensions are different, broadcast the smaller dimension over
         the larger (i.e. match a scalar to every element in a vector or a vector to a matrix).'''
+        if LAZY and (not hasattr(rhs,'dim') or rhs.dim == self.dim):   # Deferred, see Lazy
+            return _defer( op, self, rhs )
         if rhs is None:                                                 # Unary case
             return self.dim==1 and self.__class__( map(op, self) ) or self.__class__( [elem.map(op) for elem in self] )
         elif not hasattr(rhs,'dim'):                                    # List / Scalar op
@@ -65,10 +70,11 @@ class Table(list):
     def real( self ): return self.map( getreal  )
     def imag( self ): return self.map( getimag )
     def flatten( self ):
-        if self.dim == 1: return self
-        return reduce( lambda cum, e: e.flatten().concat(cum), self, [] )
+        'Iterate over every element in row order, O(size) overall'
+        if self.dim == 1: return iter(self)
+        return itertools.chain( *[elem.flatten() for elem in self] )
     def prod( self ):  return reduce(operator.mul, self.flatten(), 1.0)
-    def sum( self ):  return reduce(operator.add, self.flatten(), 0.0)
+    def sum( self ):  return sum(self.flatten(), 0.0)
     def exists( self, predicate ):
         for elem in self.flatten():
             if predicate(elem):
@@ -79,7 +85,107 @@ class Table(list):
             if not predicate(elem):
                 return 0
         return 1
-    def __eq__( self, rhs ):  return (self - rhs).forall( iszero )
+    def isclose( self, rhs, abstol=None, reltol=None ):
+        '''True when every element is within abstol + reltol*max(|a|,|b|) of its counterpart in rhs, a
+        scalar or Table broadcast as in map.  Both operands are walked together with no difference
+        table and the walk stops at the first mismatch.  Tolerances default to ABSTOL and RELTOL'''
+        if abstol is None: abstol = ABSTOL
+        if reltol is None: reltol = RELTOL
+        if not hasattr(rhs,'dim') or self.dim > rhs.dim: pairs = itertools.izip( self, itertools.repeat(rhs) )
+        elif self.dim < rhs.dim: pairs = itertools.izip( itertools.repeat(self), rhs )
+        elif len(self) != len(rhs): return 0
+        else: pairs = itertools.izip( self, rhs )
+        if self.dim > 1 or hasattr(rhs,'dim') and rhs.dim > 1:
+            for a, b in pairs:
+                if not a.isclose( b, abstol, reltol ): return 0
+        elif reltol:
+            for a, b in pairs:
+                if not abs(a - b) < abstol + reltol * max(abs(a), abs(b)): return 0
+        else:
+            for a, b in pairs:
+                if not abs(a - b) < abstol: return 0
+        return 1
+    def __eq__( self, rhs ):  return self.isclose( rhs )
+    def __ne__( self, rhs ):  return not self.isclose( rhs )
+
+class Lazy(object):
+    '''An elementwise expression over same-shape Tables and scalars whose evaluation is deferred.
+    Operators extend the expression tree.  Indexing, iteration, printing, reductions or any other
+    Table method force it, computing every element in one fused pass with no temporaries.  The
+    leaf Tables are only read when the expression is forced, so they must not be changed before
+    then, and an unforced expression is not itself a Table.  A tree deeper than LAZYDEPTH is
+    forced as soon as it is built, so long chains such as a running sum stay shallow'''
+    def __init__( self, op, lhs, rhs=None ):
+        self.op, self.lhs, self.rhs, self.value = op, lhs, rhs, None
+        self.dim = lhs.dim
+        self.depth = 1 + max( _depth(lhs), _depth(rhs) )
+    def force( self ):
+        'Evaluate the expression once and cache the resulting Table'
+        if self.value is None:
+            leaves = []
+            kernel = self._kernel( leaves )
+            self.value = _fuse( lambda *elems: kernel(elems), leaves )
+            self.op = self.lhs = self.rhs = None
+        return self.value
+    def _kernel( self, leaves ):
+        'A function of one tuple of leaf elements that evaluates the expression there, one call per node'
+        op, lhs = self.op, _termkernel( self.lhs, leaves )
+        if self.rhs is None: return lambda elems: op( lhs(elems) )
+        rhs = _termkernel( self.rhs, leaves )
+        return lambda elems: op( lhs(elems), rhs(elems) )
+    def map( self, op, rhs=None ):
+        if not hasattr(rhs,'dim') or rhs.dim == self.dim: return _defer( op, self, rhs )
+        return self.force().map( op, rhs )
+    def __mul__( self, rhs ):  return self.map( operator.mul, rhs )
+    def __div__( self, rhs ):  return self.map( operator.div, rhs )
+    def __sub__( self, rhs ):  return self.map( operator.sub, rhs )
+    def __add__( self, rhs ):  return self.map( operator.add, rhs )
+    def __rmul__( self, lhs ):  return self*lhs
+    def __rdiv__( self, lhs ):  return self*(1.0/lhs)
+    def __rsub__( self, lhs ):  return -(self-lhs)
+    def __radd__( self, lhs ):  return self+lhs
+    def __abs__( self ): return self.map( abs )
+    def __neg__( self ): return self.map( operator.neg )
+    def conjugate( self ): return self.map( getconj )
+    def real( self ): return self.map( getreal  )
+    def imag( self ): return self.map( getimag )
+    def __len__( self ):  return len( self.force() )
+    def __iter__( self ):  return iter( self.force() )
+    def __getitem__( self, i ):  return self.force()[i]
+    def __setitem__( self, i, value ):  self.force()[i] = value
+    def __getslice__( self, i, j ):  return self.force()[i:j]
+    def __str__( self ):  return str( self.force() )
+    def __repr__( self ):  return repr( self.force() )
+    def __eq__( self, rhs ):  return self.force() == rhs
+    def __ne__( self, rhs ):  return self.force() != rhs
+    def __getattr__( self, name ):  return getattr( self.force(), name )
+
+def _defer( op, lhs, rhs ):
+    'A Lazy node for op, or its value straight away once the tree would be deeper than LAZYDEPTH'
+    node = Lazy( op, lhs, rhs )
+    if node.depth > LAZYDEPTH: return node.force()
+    return node
+
+def _depth( term ):
+    if isinstance(term, Lazy) and term.value is None: return term.depth
+    return 0
+
+def _termkernel( term, leaves ):
+    'The kernel of one operand of a Lazy node, appending any Table it reads from to leaves'
+    if isinstance(term, Lazy):
+        if term.value is None: return term._kernel( leaves )
+        term = term.value
+    if not hasattr(term, 'dim'): return lambda elems: term
+    leaves.append( term )
+    k = len(leaves) - 1
+    return lambda elems: elems[k]
+
+def _fuse( func, leaves ):
+    'Apply func across corresponding elements of equal-shape tables, keeping the first one\'s classes'
+    first = leaves[0]
+    assert NPRE or [len(t) for t in leaves] == [len(first)] * len(leaves), 'Table operation requires len sizes to agree'
+    if first.dim == 1: return first.__class__( map(func, *leaves) )
+    return first.__class__( [_fuse(func, rows) for rows in zip(*leaves)] )
 
 class Vec(Table):
     def dot( self, otherVec ):  return reduce(operator.add, map(operator.mul, self, otherVec), 0.0)
@@ -108,6 +214,36 @@ class Vec(Table):
         degree = len(self) / 2
         num, den = self[:degree+1], self[degree+1:] + [1]
         return num.polyval(x) / den.polyval(x)
+    def chebval( self, x, low=-1, high=1 ):
+        'Clenshaw evaluation of the Chebyshev series Vec([c0,c1,...,cn]) at x, for a series fitted over [low,high]'
+        t = (2.0*x - low - high) / (high - low)
+        b1 = b2 = 0.0
+        for c in self[:0:-1]:
+            b1, b2 = 2.0*t*b1 - b2 + c, b1
+        return t*b1 - b2 + self[0]
+    def chebder( self, low=-1, high=1 ):
+        'Chebyshev series of the derivative (with respect to x) of a series fitted over [low,high]'
+        n = len(self) - 1
+        if n < 1: return Vec([0.0])
+        d = [0.0] * (n+2)
+        for k in range(n, 0, -1): d[k-1] = d[k+1] + 2.0*k*self[k]
+        d[0] = d[0] / 2.0
+        scale = 2.0 / (high - low)
+        return Vec( [e*scale for e in d[:n]] )
+    def cheb2poly( self, low=-1, high=1 ):
+        'Monomial coefficients in x (highest power first, as from polyfit) of a Chebyshev series fitted over [low,high]'
+        a, b = 2.0/(high-low), -(0.0+high+low)/(high-low)        # t = a*x + b
+        tprev, tcur = [1.0], [b, a]
+        p = [self[0]] + [0.0] * (len(self)-1)
+        for k in range(1, len(self)):
+            for i in range(len(tcur)): p[i] += self[k] * tcur[i]
+            tnext = [-e for e in tprev] + [0.0, 0.0]
+            for i in range(len(tcur)):
+                tnext[i] += 2.0*b*tcur[i]
+                tnext[i+1] += 2.0*a*tcur[i]
+            tprev, tcur = tcur, tnext
+        p.reverse()
+        return Vec( p )
 
 class Matrix(Table):
     __slots__ = ['size', 'rows', 'cols']
@@ -127,8 +263,8 @@ class Matrix(Table):
     def trace( self ): return self.diag().sum()
     def mmul( self, other ):
         'Matrix multiply by another matrix or a column vector '
-        if other.dim==2: return Mat( map(self.mmul, other.tr()) ).tr()
         assert NPRE or self.cols == len(other)
+        if other.dim==2: return Mat( map(Vec, _mmulinto(self, other, [[] for row in self])) )
         return Vec( map(other.dot, self) )
     def augment( self, otherMat ):
         'Make a new matrix with the two original matrices laid side by side'
@@ -142,7 +278,7 @@ class Matrix(Table):
             v, beta = R.tr()[i].house(i)
             R -= v.outer( R.tr().mmul(v)*beta )
         for i in range(1,min(n,m)): R[i][:i] = [0] * i
-        R = Mat(R[:n])
+        R = Mat(R[:n], m>=n and UpperTri or None)
         if ROnly: return R
         Q = R.tr().solve(self.tr()).tr()       # Rt Qt = At    nn  nm  = nm
         self.qr = lambda r=0, c=`self`: not r and c==`self` and (Q,R) or Matrix.qr(self,r) #Cache result
@@ -156,9 +292,12 @@ class Matrix(Table):
         return R.solve( Q.tr().mmul(b) )
     def solve( self, b ):
         'Divide matrix into a column vector or matrix and iterate to improve the solution'
-        if b.dim==2: return Mat( map(self.solve, b.tr()) ).tr()
         assert NPRE or self.rows == len(b), 'Matrix row count %d must match vector length %d' % (self.rows, len(b))
         x = self._solve( b )
+        if b.dim==2: return Mat( map(self._refine, b.tr(), x.tr()) ).tr()
+        return self._refine( b, x )
+    def _refine( self, b, x ):
+        'Iterative refinement of a solution x to self.mmul(x)==b for a single column vector'
         diff = b - self.mmul(x)
         maxdiff = diff.dot(diff)
         for i in range(10):
@@ -182,32 +321,91 @@ class Square(Matrix):
                 assert U[i][i] != 0.0, 'LU requires non-zero elements on the diagonal'
                 L[j][i] = m = 1.0 * U[j][i] / U[i][i]
                 U[j] -= U[i] * m
-        assert NPOST or isinstance(L,LowerTri) and isinstance(U,UpperTri) and L*U==self
+        L, U = Mat(L, LowerTri), Mat(U, UpperTri)
+        assert NPOST or isinstance(L,LowerTri) and isinstance(U,UpperTri) and L.mmul(U)==self
         return L, U
     def __pow__( self, exp ):
         'Raise a square matrix to an integer power (i.e. A**3 is the same as A.mmul(A.mmul(A))'
+        return self.power( exp )
+    def power( self, exp, Diagonalize=0 ):
+        '''Integer power by iterative binary exponentiation that reuses the same three n-by-n buffers.
+        With Diagonalize, use A**k == V*diag(eigs**k)*inv(V) at a cost independent of k.  This needs
+        real, distinct eigenvalues and falls back to squaring when the decomposition does not check out
+        or the eigenvalue iteration does not settle (as it never does on complex conjugate pairs)'''
         assert NPRE or exp==int(exp) and exp>0, 'Matrix powers only defined for positive integers not %s' % exp
+        exp = int(exp)
         if exp == 1: return self
-        if exp&1: return self.mmul(self ** (exp-1))
-        sqrme = self ** (exp/2)
-        return sqrme.mmul(sqrme)
+        if Diagonalize:
+            result = self._diagpower( exp )
+            if result is not None: return result
+        n = self.rows
+        result, base, work = None, [list(row) for row in self], [[] for i in range(n)]
+        while 1:
+            if exp & 1:
+                if result is None: result = [list(row) for row in base]
+                else: result, work = _mmulinto(result, base, work), result
+            exp >>= 1
+            if not exp: break
+            base, work = _mmulinto(base, base, work), base
+        return Mat( map(Vec, result) )
+    def _diagpower( self, exp ):
+        'Power through an eigendecomposition of self, or None when self is not safely diagonalizable'
+        n = self.rows
+        try:
+            lams = list( self.eigs( MaxIter=50 ) )
+            for i in range(n):
+                for j in range(i):
+                    if iszero( (lams[i]-lams[j]) / (1.0 + abs(lams[i])) ): return None
+            H, Q = self.hessenberg( WithQ=1 )
+            V = Mat( [Q.mmul(_hessnull(H, lam)) for lam in lams] ).tr()
+            Vinv = V.inverse()
+        except (AssertionError, ArithmeticError):
+            return None
+        if not Mat( [row * Vec(lams) for row in V] ).mmul( Vinv ) == self: return None
+        powers = Vec( [lam ** exp for lam in lams] )
+        return Mat( [row * powers for row in V] ).mmul( Vinv )
     def det( self ):  return self.qr( ROnly=1 ).det()
     def inverse( self ):  return self.solve( eye(self.rows) )
-    def hessenberg( self ):
-        '''Householder reduction to Hessenberg Form (zeroes below the diagonal)
-        while keeping the same eigenvalues as self.'''
-        for i in range(self.cols-2):
-            v, beta = self.tr()[i].house(i+1)
-            self -= v.outer( self.tr().mmul(v)*beta )
-            self -= self.mmul(v).outer(v*beta)
-        return self
-    def eigs( self ):
-        'Estimate principal eigenvalues using the QR with shifts method'
+    def hessenberg( self, WithQ=0 ):
+        '''Householder reduction to Hessenberg Form (zeroes below the subdiagonal)
+        while keeping the same eigenvalues as self.  Each reflector is applied in place
+        to the trailing block of one working copy.  With WithQ, also return the
+        accumulated orthogonal transform so that Q.mmul(H).mmul(Q.tr())==self'''
+        n = self.rows
+        H = [list(row) for row in self]
+        Q = WithQ and [[float(i==j) for j in range(n)] for i in range(n)] or []
+        for k in range(n-2):
+            for i in range(k+2, n):
+                if H[i][k]: break
+            else: continue                              # Column already reduced
+            v, beta = Vec([row[k] for row in H]).house(k+1)
+            for j in range(k, n):                       # H = (I - beta v v') H on rows k+1..
+                s = 0.0
+                for i in range(k+1, n): s += v[i] * H[i][j]
+                s *= beta
+                for i in range(k+1, n): H[i][j] -= v[i] * s
+            for row in H + Q:                           # H = H (I - beta v v') on cols k+1..
+                s = 0.0
+                for j in range(k+1, n): s += row[j] * v[j]
+                s *= beta
+                for j in range(k+1, n): row[j] -= s * v[j]
+            for i in range(k+2, n): H[i][k] = 0.0
+        H = self.__class__( map(Vec, H) )
+        if WithQ: return H, Square( map(Vec, Q) )
+        return H
+    def eigs( self, MaxIter=0 ):
+        '''Estimate principal eigenvalues using the QR with shifts method.  With MaxIter, raise
+        ArithmeticError when an eigenvalue has not split off after that many shifted steps; real
+        shifts never split a complex conjugate pair, so without a limit such matrices loop forever'''
         origTrace, origDet = self.trace(), self.det()
         self = self.hessenberg()
         eigvals = Vec([])
         for i in range(self.rows-1,0,-1):
+            steps = 0
             while not self[i][:i].forall(iszero):
+                steps += 1
+                if MaxIter and steps > MaxIter:
+                    raise ArithmeticError, 'QR iteration did not converge (complex eigenvalues?)'
                 shift = eye(i+1) * self[i][i]
                 q, r = (self - shift).qr()
                 self = r.mmul(q) + shift
@@ -224,27 +422,290 @@ class Triangular(Square):
 
 class UpperTri(Triangular):
     def _solve( self, b ):
-        'Solve an upper triangular matrix using backward substitution'
-        x = Vec([])
-        for i in range(self.rows-1, -1, -1):
-            assert NPRE or self[i][i], 'Backsub requires non-zero elements on the diagonal'
-            x.insert(0, (b[i] - x.dot(self[i][i+1:])) / self[i][i] )
-        return x
+        '''Solve an upper triangular matrix using backward substitution into a preallocated
+        result.  A matrix b is treated as a block of right-hand sides (one per column)'''
+        n = self.rows
+        x = [0.0] * n
+        for i in range(n-1, -1, -1):
+            row = self[i]
+            assert NPRE or row[i], 'Backsub requires non-zero elements on the diagonal'
+            if b.dim == 2:
+                acc = list(b[i])
+                for j in range(i+1, n):
+                    if row[j]: acc = map(lambda a, c, r=row[j]: a - r*c, acc, x[j])
+                x[i] = Vec( [a / row[i] for a in acc] )
+            else:
+                s = 0.0
+                for j in range(i+1, n): s += x[j] * row[j]
+                x[i] = (b[i] - s) / row[i]
+        return b.dim == 2 and Mat(x) or Vec(x)
 
 class LowerTri(Triangular):
     def _solve( self, b ):
-        'Solve a lower triangular matrix using forward substitution'
-        x = Vec([])
+        '''Solve a lower triangular matrix using forward substitution into a preallocated
+        result.  A matrix b is treated as a block of right-hand sides (one per column)'''
+        n = self.rows
+        x = [0.0] * n
+        for i in range(n):
+            row = self[i]
+            assert NPRE or row[i], 'Forward sub requires non-zero elements on the diagonal'
+            if b.dim == 2:
+                acc = list(b[i])
+                for j in range(i):
+                    if row[j]: acc = map(lambda a, c, r=row[j]: a - r*c, acc, x[j])
+                x[i] = Vec( [a / row[i] for a in acc] )
+            else:
+                s = 0.0
+                for j in range(i): s += x[j] * row[j]
+                x[i] = (b[i] - s) / row[i]
+        return b.dim == 2 and Mat(x) or Vec(x)
+
+class Sparse(Matrix):
+    '''Matrix in compressed sparse row form: the nonzeros of row i have column numbers
+    indices[indptr[i]:indptr[i+1]] and values values[indptr[i]:indptr[i+1]].  Indexing and
+    iteration yield dense read-only copies of the rows so Table methods still work, while
+    mmul, tr, solve and zero-preserving elementwise operations touch only the nonzeros'''
+    dim = 2
+    def __init__( self, elems, size=None ):
+        'Form a sparse matrix from a list of dense rows, or from (i, j, value) triples and a size'
+        if size is None:
+            size = len(elems), len(elems[0])
+            elems = [(i, j, elems[i][j]) for i in range(size[0]) for j in range(size[1]) if elems[i][j]]
+        m, n = size
+        rowmaps = [{} for i in range(m)]
+        for i, j, e in elems:
+            assert NPRE or 0 <= i < m and 0 <= j < n, 'Sparse index (%d,%d) outside %s' % (i, j, `size`)
+            rowmaps[i][j] = rowmaps[i].get(j, 0) + e
+        self.indptr, self.indices, self.values = [0], [], []
+        for row in rowmaps:
+            cols = row.keys()
+            cols.sort()
+            for j in cols:
+                if row[j]:
+                    self.indices.append( j )
+                    self.values.append( row[j] )
+            self.indptr.append( len(self.indices) )
+        self.size = self.rows, self.cols = m, n
+    def __len__( self ):  return self.rows
+    def __getitem__( self, i ):
+        'Dense copy of row i'
+        if i < 0: i += self.rows
+        if not 0 <= i < self.rows: raise IndexError, 'Sparse row index out of range'
+        row = [0] * self.cols
+        for k in range(self.indptr[i], self.indptr[i+1]): row[self.indices[k]] = self.values[k]
+        return Vec( row )
+    def __getslice__( self, i, j ):
+        return [self[k] for k in range(self.rows)[i:j]]
+    def __iter__( self ):
+        for i in range(self.rows): yield self[i]
+    def __repr__( self ):
+        return 'Sparse(%s, %s)' % (`self.triples()`, `self.size`)
+    def nnz( self ):  return len(self.values)
+    def sum( self ):  return sum(self.values, 0.0)
+    def triples( self ):
+        'List the nonzeros as (i, j, value) in row order'
+        return [(i, self.indices[k], self.values[k]) for i in range(self.rows) for k in range(self.indptr[i], self.indptr[i+1])]
+    def dense( self ):  return Mat( list(self) )
+    def diag( self ):
+        d = [0] * min(self.size)
+        for i, j, e in self.triples():
+            if i == j: d[i] = e
+        return Vec( d )
+    def tr( self ):
+        'Transpose by a counting sort on the column numbers in O(nnz) time'
+        m, n = self.size
+        indptr = [0] * (n+1)
+        for j in self.indices: indptr[j+1] += 1
+        for j in range(n): indptr[j+1] += indptr[j]
+        nxt, indices, values = indptr[:-1], [0] * self.nnz(), [0] * self.nnz()
+        for i in range(m):
+            for k in range(self.indptr[i], self.indptr[i+1]):
+                j = self.indices[k]
+                indices[nxt[j]], values[nxt[j]] = i, self.values[k]
+                nxt[j] += 1
+        return _csr( indptr, indices, values, (n, m) )
+    def isclose( self, rhs, abstol=None, reltol=None ):
+        'Compare with another Sparse of the same size over the union of their nonzeros only'
+        if not isinstance(rhs, Sparse) or rhs.size != self.size:
+            return Matrix.isclose( self, rhs, abstol, reltol )
+        if abstol is None: abstol = ABSTOL
+        if reltol is None: reltol = RELTOL
+        others = {}
+        for i, j, e in rhs.triples(): others[i, j] = e
+        pairs = [(e, others.pop((i, j), 0)) for i, j, e in self.triples()] + [(0, e) for e in others.values()]
+        for a, b in pairs:
+            if not abs(a - b) < abstol + reltol * max(abs(a), abs(b)): return 0
+        return 1
+    def issymmetric( self ):
+        t = self.tr()
+        return t.indptr == self.indptr and t.indices == self.indices and Vec(t.values) == Vec(self.values)
+    def mmul( self, other ):
+        'Multiply by a column vector (returns a Vec), a Sparse matrix (returns a Sparse) or a dense matrix'
+        assert NPRE or self.cols == len(other)
+        indptr, indices, values = self.indptr, self.indices, self.values
+        if isinstance(other, Sparse):
+            triples = []
+            for i in range(self.rows):
+                for k in range(indptr[i], indptr[i+1]):
+                    e, j = values[k], indices[k]
+                    for l in range(other.indptr[j], other.indptr[j+1]):
+                        triples.append( (i, other.indices[l], e * other.values[l]) )
+            return Sparse( triples, (self.rows, other.cols) )
+        if hasattr(other, 'dim') and other.dim == 2:
+            out = []
+            for i in range(self.rows):
+                acc = [0.0] * len(other[0])
+                for k in range(indptr[i], indptr[i+1]):
+                    acc = map(lambda a, b, e=values[k]: a + e*b, acc, other[indices[k]])
+                out.append( Vec(acc) )
+            return Mat( out )
+        out = [0.0] * self.rows
         for i in range(self.rows):
-            assert NPRE or self[i][i], 'Forward sub requires non-zero elements on the diagonal'
-            x.append( (b[i] - x.dot(self[i][:i])) / self[i][i] )
+            s = 0.0
+            for k in range(indptr[i], indptr[i+1]): s += values[k] * other[indices[k]]
+            out[i] = s
+        return Vec( out )
+    def map( self, op, rhs=None ):
+        '''Elementwise operations that send zero to zero (scaling, negation, abs, adding another
+        Sparse of the same size, ...) stay sparse.  Anything else is carried out densely'''
+        if not hasattr(rhs, 'dim'):
+            f = rhs is None and op or (lambda e, op=op, rhs=rhs: op(e, rhs))
+            try:
+                keep = not f(0)
+            except ZeroDivisionError:
+                keep = 0
+            if keep: return Sparse( [(i, j, f(e)) for i, j, e in self.triples()], self.size )
+        elif isinstance(rhs, Sparse) and rhs.size == self.size and not op(0, 0):
+            pairs = {}
+            for i, j, e in self.triples(): pairs[i, j] = [e, 0]
+            for i, j, e in rhs.triples(): pairs.setdefault( (i, j), [0, 0] )[1] = e
+            return Sparse( [(i, j, op(a, b)) for (i, j), (a, b) in pairs.items()], self.size )
+        return self.dense().map( op, rhs )
+    def solve( self, b, tol=1e-10, maxiter=None ):
+        '''Iterative solution of self.mmul(x)==b using only matrix-vector products: conjugate gradients
+        for symmetric matrices (GMRES if that stalls), restarted GMRES for other square matrices and
+        conjugate gradients on the normal equations (least squares) for rectangular ones'''
+        if b.dim==2: return Mat( [self.solve(col, tol, maxiter) for col in b.tr()] ).tr()
+        assert NPRE or self.rows == len(b), 'Matrix row count %d must match vector length %d' % (self.rows, len(b))
+        if self.rows != self.cols:
+            t = self.tr()
+            return _cg( lambda v: t.mmul(self.mmul(v)), t.mmul(b), tol, maxiter )
+        x = None
+        if self.issymmetric():
+            x = _cg( self.mmul, b, tol, maxiter )
+            r = b - self.mmul(x)
+        if x is None or r.norm() > tol * max(1.0, Vec(b).norm()) * 100:
+            x = _gmres( self.mmul, b, tol, maxiter )
+        assert NPOST or self.mmul(x) == b
         return x
 
-def Mat( elems ):
-    'Factory function to create a new matrix.'
+def _mmulinto( a, b, out ):
+    'Multiply kernel: overwrite the rows of out with a*b.  out may be the same buffer as a but not b'
+    cols, mul = zip(*b), operator.mul
+    for arow, orow in zip(a, out):
+        orow[:] = [sum(map(mul, arow, col), 0.0) for col in cols]
+    return out
+
+def _hessnull( H, lam ):
+    'Inverse iteration for a unit null vector of H - lam*I where H is upper Hessenberg; O(n**2)'
+    n = len(H)
+    U = [list(row) for row in H]
+    for i in range(n): U[i][i] -= lam
+    tiny = 1e-14 * max( [1.0] + [abs(e) for row in U for e in row] )
+    steps = []
+    for k in range(n-1):                        # LU with partial pivoting on the one subdiagonal
+        swap = abs(U[k+1][k]) > abs(U[k][k])
+        if swap: U[k], U[k+1] = U[k+1], U[k]
+        if abs(U[k][k]) < tiny: U[k][k] = tiny
+        m = U[k+1][k] / U[k][k]
+        for j in range(k+1, n): U[k+1][j] -= m * U[k][j]
+        steps.append( (swap, m) )
+    if abs(U[n-1][n-1]) < tiny: U[n-1][n-1] = tiny
+    x = [1.0] * n
+    for it in range(2):
+        for k in range(n-1):
+            swap, m = steps[k]
+            if swap: x[k], x[k+1] = x[k+1], x[k]
+            x[k+1] -= m * x[k]
+        for i in range(n-1, -1, -1):
+            row, s = U[i], x[i]
+            for j in range(i+1, n): s -= row[j] * x[j]
+            x[i] = s / row[i]
+        x = Vec(x).normalize()
+    return x
+
+def _csr( indptr, indices, values, size ):
+    'Wrap compressed sparse row arrays that are already sorted and free of zeros'
+    s = Sparse.__new__( Sparse )
+    s.indptr, s.indices, s.values = indptr, indices, values
+    s.size = s.rows, s.cols = size
+    return s
+
+def _cg( matvec, b, tol=1e-10, maxiter=None ):
+    'Conjugate gradients for a symmetric positive definite operator known only through matvec'
+    n = len(b)
+    x, r = [0.0] * n, [0.0 + e for e in b]
+    p, rr = r[:], Vec(r).dot(r)
+    stop = tol * tol * max(rr, 1.0)
+    for it in range(maxiter or 10*n):
+        if rr <= stop: break
+        q = matvec( Vec(p) )
+        pq = Vec(p).dot(q)
+        if not pq: break
+        alpha = rr / pq
+        x = [a + alpha*c for a, c in zip(x, p)]
+        r = [a - alpha*c for a, c in zip(r, q)]
+        rrnew = Vec(r).dot(r)
+        p = [a + (rrnew/rr)*c for a, c in zip(r, p)]
+        rr = rrnew
+    return Vec( x )
+
+def _gmres( matvec, b, tol=1e-10, maxiter=None, restart=30 ):
+    'Restarted GMRES with Givens rotations for a general square operator known only through matvec'
+    n = len(b)
+    x, its = [0.0] * n, 0
+    maxiter = maxiter or 10*n
+    bnorm = max( Vec(b).norm(), 1.0 )
+    while its < maxiter:
+        r = [e - a for e, a in zip(b, matvec(Vec(x)))]
+        beta = Vec(r).norm()
+        if beta <= tol * bnorm: break
+        V, H, cs, sn, g = [[e / beta for e in r]], [], [], [], [beta]
+        for j in range(min(restart, n)):
+            its += 1
+            w, h = list( matvec(Vec(V[j])) ), []
+            for v in V:                                 # Modified Gram-Schmidt
+                hij = Vec(w).dot(v)
+                h.append( hij )
+                w = [a - hij*c for a, c in zip(w, v)]
+            hnext = Vec(w).norm()
+            h.append( hnext )
+            for i in range(j):                          # Earlier rotations
+                h[i], h[i+1] = cs[i]*h[i] + sn[i]*h[i+1], cs[i]*h[i+1] - sn[i]*h[i]
+            d = math.hypot( h[j], h[j+1] )
+            cs.append( h[j] / d )
+            sn.append( h[j+1] / d )
+            h[j], h[j+1] = d, 0.0
+            g.append( -sn[j] * g[j] )
+            g[j] = cs[j] * g[j]
+            H.append( h )
+            if abs(g[j+1]) <= tol * bnorm or not hnext or its >= maxiter: break
+            V.append( [e / hnext for e in w] )
+        y = [0.0] * len(H)
+        for i in range(len(H)-1, -1, -1):
+            s = g[i]
+            for l in range(i+1, len(H)): s -= H[l][i] * y[l]
+            y[i] = s / H[i][i]
+        for l in range(len(H)): x = [a + y[l]*c for a, c in zip(x, V[l])]
+    return Vec( x )
+
+def Mat( elems, kind=None ):
+    '''Factory function to create a new matrix.  Callers that already know the structure pass
+    its class as kind (Matrix, Square, UpperTri, LowerTri or Sparse) to skip the triangle scans'''
+    if kind is not None: return kind(elems)
     m, n = len(elems), len(elems[0])
     if m != n: return Matrix(elems)
-    if n <= 1: return Square(elems)
+    if n <= 1: return UpperTri(elems)          # Solved by division, not by a QR that would recurse
     for i in range(1, len(elems)):
         if not iszero( max(map(abs, elems[i][:i])) ):
             break
@@ -275,29 +736,213 @@ def polyfit( (xvec, yvec), degree=2 ):
     'Solves Vandermonde design matrix for approximating polynomial coefficients'
     return Mat([ [x**n for n in range(degree,-1,-1)] for x in xvec ]).solve(yvec)
 
+def funfits( (xvec, yvecs), basisfuns ):
+    'funfit for many y-vectors sampled at the same xvec.  Returns a matrix with one row of coefficients per y-vector'
+    return _fitmany( Mat([ map(form,xvec) for form in basisfuns ]).tr(), yvecs )
+
+def polyfits( (xvec, yvecs), degree=2 ):
+    'polyfit for many y-vectors sampled at the same xvec.  Returns a matrix with one row of coefficients per y-vector'
+    return _fitmany( Mat([ [x**n for n in range(degree,-1,-1)] for x in xvec ]), yvecs )
+
+def _fitmany( design, yvecs ):
+    '''Least squares solutions for a block of right-hand sides that share one design matrix: a single QR
+    factorization, one multi-RHS triangular solve and one block step of iterative refinement'''
+    Q, R = design.qr()
+    Qt, Y = Q.tr(), Mat(yvecs).tr()
+    X = R._solve( Qt.mmul(Y) )
+    X = X + R._solve( Qt.mmul(Y - design.mmul(X)) )
+    return X.tr()
+
+def chebfit( (xvec, yvec), degree=2, low=None, high=None ):
+    '''Least squares coefficients c0..cn of the Chebyshev series sum(c[k]*T[k](t)) where t maps [low,high]
+    (by default the range of xvec) onto [-1,1].  Far better conditioned than the Vandermonde system in
+    polyfit; evaluate with Vec.chebval and convert with Vec.cheb2poly'''
+    if low is None: low = min(xvec)
+    if high is None: high = max(xvec)
+    return chebdesign( xvec, degree, low, high ).solve(yvec)
+
+def chebdesign( xvec, degree, low, high ):
+    '''Design matrix whose rows are T[0](t)..T[degree](t) built by the three-term recurrence.  Data sets sampled
+    at the same xvec can share one: its solve factors it once and reuses the cached QR for every yvec'''
+    rows = []
+    for x in xvec:
+        t = (2.0*x - low - high) / (high - low)
+        row = [1.0, t]
+        for k in range(2, degree+1): row.append( 2.0*t*row[-1] - row[-2] )
+        rows.append( Vec(row[:degree+1]) )
+    return Mat( rows )
+
+def chebselect( (xvec, yvec), maxdegree, low=None, high=None, mindegree=1, criterion='gcv', design=None ):
+    '''Choose the degree of a chebfit by generalized cross validation (criterion='gcv') or leave-one-out
+    cross validation ('loo'), both in closed form, for every degree from mindegree to maxdegree out of one
+    QR factorization: the design for degree d is the first d+1 columns of the maxdegree design, so all the
+    fits share Q and the leading blocks of R.  Returns (degree, coefficients, scores) where scores maps each
+    degree to its criterion, or None for a degree the data cannot score.  A chebdesign of xvec for maxdegree
+    may be passed in to share its factorization with other data sets sampled at the same xvec'''
+    assert NPRE or criterion in ('gcv', 'loo')
+    if low is None: low = min(xvec)
+    if high is None: high = max(xvec)
+    A = design
+    if A is None: A = chebdesign( xvec, maxdegree, low, high )
+    m = A.rows
+    Q, R = A.qr()
+    Qt = Q.tr()
+    y = Vec( yvec )
+    z = Qt.mmul( y )
+    e = y - Q.mmul( z )                                # Residuals of degree d, from maxdegree down
+    h = Vec( [row.dot(row) for row in Q] )             # Leverages (hat matrix diagonal) of degree d
+    scores = {}
+    for d in range(maxdegree, mindegree-1, -1):
+        p = d + 1
+        sse = e.dot( e )
+        if m <= p:
+            scores[d] = None
+        elif criterion == 'gcv':
+            scores[d] = m * sse / (m - p)**2
+        elif max( h ) >= 1.0 - 1e-10:
+            scores[d] = None
+        else:
+            scores[d] = sum( [(ei / (1.0 - hi))**2 for ei, hi in zip(e, h)] ) / m
+        e = e + Qt[d] * z[d]
+        h = h - Qt[d] * Qt[d]
+    scored = [(scores[d], d) for d in scores if scores[d] is not None]
+    assert NPRE or scored, 'Too few points to score any degree'
+    best = min( scored )[1]
+    p = best + 1
+    Rd = Mat( [Vec(row[:p]) for row in R[:p]], UpperTri )
+    Ad = Mat( [Vec(row[:p]) for row in A] )
+    c = Rd._solve( z[:p] )
+    c = c + Rd._solve( Mat(Qt[:p]).mmul(y - Ad.mmul(c)) )    # One step of iterative refinement
+    return best, c, scores
+
+def chebroots( series, low=-1, high=1, tol=1e-12, maxiter=60, WithSteps=0 ):
+    '''Real roots of a batch of Chebyshev series inside their ranges [low,high] (one pair for all, or lists of
+    lows and highs).  Returns one ascending Vec of roots per series.  All the series are sampled together, by
+    a single mmul, on a grid of Chebyshev points wide enough to separate roots of the highest degree; each
+    sign change is then refined by Newton steps safeguarded by bisection, at most maxiter of them, so the
+    search always ends.  Roots of even multiplicity, where the series touches zero without crossing, are
+    not sign changes and are not returned.  With WithSteps, also return the total number of Newton and
+    bisection steps taken'''
+    if not hasattr(low, '__len__'): low, high = [low] * len(series), [high] * len(series)
+    ncoef = max( map(len, series) )
+    npts = max( 16, 4*ncoef )
+    grid = [-math.cos(math.pi*j/npts) for j in range(npts+1)]
+    T = chebdesign( grid, ncoef-1, -1.0, 1.0 )
+    C = Mat( [Vec(list(c) + [0.0]*(ncoef-len(c))) for c in series] )
+    values = C.mmul( T.tr() )
+    roots, steps = [], 0
+    for c, v, lo, hi in zip(series, values, low, high):
+        c = Vec( c )
+        dc = c.chebder()
+        found = []
+        for j in range(npts):
+            if v[j] == 0.0:
+                if j > 0 and v[j-1]*v[j+1] < 0.0: found.append( grid[j] )
+            elif v[j]*v[j+1] < 0.0:
+                t, n = _chebroot( c, dc, grid[j], grid[j+1], v[j], tol, maxiter )
+                found.append( t )
+                steps += n
+        roots.append( Vec([((hi-lo)*t + hi + lo) / 2.0 for t in found]) )
+    if WithSteps: return roots, steps
+    return roots
+
+def _chebroot( c, dc, a, b, fa, tol, maxiter ):
+    '''Root of the Chebyshev series c in t, bracketed by a < b with c(a)=fa of opposite sign to c(b),
+    and the number of Newton or bisection steps taken'''
+    t = (a + b) / 2.0
+    for i in range(maxiter):
+        f = c.chebval( t )
+        if f == 0.0: return t, i
+        if (f < 0.0) == (fa < 0.0): a, fa = t, f
+        else: b = t
+        d = dc.chebval( t )
+        step = d and t - f/d
+        if not d or not a < step < b: step = (a + b) / 2.0      # Bisect where Newton leaves the bracket
+        if abs(step - t) <= tol * (1.0 + abs(t)) or b - a <= tol: return step, i + 1
+        t = step
+    return t, maxiter
+
+def blockarrow( A, B, C, a, c ):
+    '''Solve the symmetric block arrow system whose first block row is [A B[0] B[1] ...] and whose other block
+    rows are [B[i].tr() C[i]], with right hand sides a (first) and c[i], by the Schur complement of the diagonal
+    blocks C[i].  Only the blocks are ever stored, so work and storage grow linearly with the number of blocks
+    where the dense system would grow cubically.  A and the C[i] must be positive definite (as normal equations
+    are): every block is solved by Cholesky, whose accuracy does not depend on the size of the entries, and an
+    ArithmeticError is raised when a pivot is not positive.  Returns (x, [y0, y1, ...])'''
+    assert NPRE or len(B) == len(C) == len(c)
+    CiBt = [_cholsolve( Ci, Bi.tr() ) for Bi, Ci in zip(B, C)]
+    Cic = [_cholsolve( Ci, ci ) for Ci, ci in zip(C, c)]
+    S, r = A, a
+    for Bi, X, v in zip(B, CiBt, Cic):
+        S = S - Bi.mmul( X )
+        r = r - Bi.mmul( v )
+    x = _cholsolve( S, r )
+    return x, [v - X.mmul(x) for X, v in zip(CiBt, Cic)]
+
+def _cholsolve( M, b ):
+    'Solve the symmetric positive definite M against a vector or a block of right-hand side columns b'
+    n = len(M)
+    L = [[0.0] * n for i in range(n)]
+    for j in range(n):
+        d = M[j][j] - sum([e*e for e in L[j][:j]], 0.0)
+        if not d > 0.0: raise ArithmeticError, 'Cholesky needs a positive definite matrix'
+        L[j][j] = d = math.sqrt(d)
+        for i in range(j+1, n):
+            L[i][j] = (M[i][j] - sum(map(operator.mul, L[i][:j], L[j][:j]), 0.0)) / d
+    cols = b.dim == 2 and [list(col) for col in b.tr()] or [list(b)]
+    for y in cols:
+        for i in range(n):                      # L y = b, then L' x = y, in place
+            y[i] = (y[i] - sum(map(operator.mul, L[i][:i], y[:i]), 0.0)) / L[i][i]
+        for i in range(n-1, -1, -1):
+            y[i] = (y[i] - sum([L[k][i]*y[k] for k in range(i+1, n)], 0.0)) / L[i][i]
+    if b.dim == 2: return Mat( map(Vec, cols) ).tr()
+    return Vec( cols[0] )
+
 def ratfit( (xvec, yvec), degree=2 ):
     'Solves design matrix for approximating rational polynomial coefficients (a*x**2 + b*x + c)/(d*x**2 + e*x + 1)'
     return Mat([[x**n for n in range(degree,-1,-1)]+[-y*x**n for n in range(degree,0,-1)] for x,y in zip(xvec,yvec)]).solve(yvec)
 
-def genmat(m, n, func):
+def genmat(m, n, func, kind=None):
+    'Matrix with Elem[j][i]=func(i,j).  Pass kind to skip the structure scan in Mat'
     if not n: n=m
-    return Mat([ [func(i,j) for i in range(n)] for j in range(m) ])
+    return Mat([ Vec([func(i,j) for i in range(n)]) for j in range(m) ], kind)
+
+def _genkind(m, n, square):
+    'The class Mat would pick for an m-by-n generated matrix whose square form is of class square'
+    if m != n: return Matrix
+    if n <= 1: return UpperTri
+    return square
 
 def zeroes(m=1, n=None):
     'Zero matrix with side length m-by-m or m-by-n.'
-    return genmat(m,n, lambda i,j: 0)
+    n = n or m
+    return _genkind(m, n, UpperTri)( [Vec([0] * n) for j in range(m)] )
 
 def eye(m=1, n=None):
     'Identity matrix with side length m-by-m or m-by-n'
-    return genmat(m,n, lambda i,j: i==j)
+    n = n or m
+    rows = [Vec([0] * n) for j in range(m)]
+    for i in range(min(m, n)): rows[i][i] = 1
+    return _genkind(m, n, UpperTri)( rows )
 
 def hilb(m=1, n=None):
     'Hilbert matrix with side length m-by-m or m-by-n.  Elem[i][j]=1/(i+j+1)'
-    return genmat(m,n, lambda i,j: 1.0/(i+j+1.0))
+    n = n or m
+    recips = [1.0/k for k in range(1, m+n)]
+    return _genkind(m, n, Square)( [Vec(recips[j:j+n]) for j in range(m)] )
 
 def rand(m=1, n=None):
     'Random matrix with side length m-by-m or m-by-n'
-    return genmat(m,n, lambda i,j: random.random())
+    n, rnd = n or m, random.random
+    return _genkind(m, n, Square)( [Vec([rnd() for i in range(n)]) for j in range(m)] )
+
+def sparse(m=1, n=None, entries=()):
+    'Sparse m-by-m or m-by-n matrix from (i, j, value) triples.  Repeated positions are summed'
+    return Sparse( entries, (m, n or m) )
+
+def speye(m=1, n=None):
+    'Sparse identity matrix with side length m-by-m or m-by-n'
+    return sparse( m, n, [(i, i, 1) for i in range(min(m, n or m))] )
 
 if __name__ == '__main__':
     import cmath